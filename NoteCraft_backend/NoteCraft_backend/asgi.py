@@ -13,4 +13,22 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'NoteCraft_backend.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+
+async def application(scope, receive, send):
+    """
+    The Django application plus the ASGI lifespan protocol, which Django does
+    not handle: on shutdown the worker's async Pinecone clients are closed.
+    """
+    if scope["type"] != "lifespan":
+        return await django_application(scope, receive, send)
+    from NoteMaker.ai_module import aclose_async_clients
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await aclose_async_clients()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
@@ -69,7 +69,9 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
-    
+    'NoteMaker.middleware.TracingMiddleware',
+    'NoteMaker.middleware.ServerTimingMiddleware',
+    'NoteMaker.middleware.AdmissionMiddleware',
 ]
 #CORS_ALLOW_ALL_ORIGINS = True  # Allow all origins (not safe for production)
 
@@ -104,6 +106,7 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'NoteCraft_backend.wsgi.application'
+ASGI_APPLICATION = 'NoteCraft_backend.asgi.application'
 
 CACHES = {
     'default': {
@@ -112,15 +115,17 @@ CACHES = {
         'TIMEOUT': 86400, 
     }
 }
-# CELERY_BROKER_URL = os.getenv('REDIS_URL')
-# CELERY_RESULT_BACKEND = CELERY_BROKER_URL
-
-# Local development settings (No Docker/Redis)
-CELERY_TASK_ALWAYS_EAGER = True
+# With a broker (e.g. CELERY_BROKER_URL=redis://redis:6379/0 and the celery
+# container) tasks run on the worker and uploads return once the file is stored.
+# Without one (local development, no Docker/Redis) tasks run eagerly inside the
+# request, so an upload blocks until its document is indexed.
+CELERY_BROKER_URL = os.getenv('CELERY_BROKER_URL') or 'memory://'
+CELERY_RESULT_BACKEND = os.getenv('CELERY_RESULT_BACKEND') or (
+    os.getenv('CELERY_BROKER_URL') or 'file:///' + str(BASE_DIR / 'celery_results').replace('\\', '/')
+)
+CELERY_TASK_ALWAYS_EAGER = os.getenv('CELERY_TASK_ALWAYS_EAGER', str(not os.getenv('CELERY_BROKER_URL'))) == 'True'
 CELERY_TASK_EAGER_PROPAGATES = True
 CELERY_TASK_STORE_EAGER_RESULT = True
-CELERY_BROKER_URL = 'memory://'
-CELERY_RESULT_BACKEND = 'file:///' + str(BASE_DIR / 'celery_results').replace('\\', '/')
 
 CELERY_ACCEPT_CONTENT = ['json']
 CELERY_TASK_SERIALIZER = 'json'
@@ -223,6 +228,8 @@ CORS_ALLOW_HEADERS = [
     "x-csrftoken",
     "x-requested-with",
 ]
+# Lets the frontend read per-stage latencies (NoteMaker.middleware.ServerTimingMiddleware)
+CORS_EXPOSE_HEADERS = ["Server-Timing", "Retry-After"]
 
 if not DEBUG:
     SECURE_SSL_REDIRECT = True
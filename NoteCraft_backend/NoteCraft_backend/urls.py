@@ -31,6 +31,7 @@ urlpatterns = [
     path('api/login/', LoginView.as_view(), name='login'),
     path('search_pdfs/',ListDocumentView.as_view()),
     path('ask_ai/', AskAIView.as_view(), name='ask_ai'),
+    path('ask_ai/stream/', AskAIStreamView.as_view(), name='ask_ai_stream'),
     path('conversations/', ConversationListCreateView.as_view(), name='conversation-list-create'),
     path('conversations/<int:id>/', ConversationDetailView.as_view(), name='conversation-detail'),
     path('conversations/<int:conversation_id>/messages/', MessageListView.as_view(), name='message-list'),
@@ -40,4 +41,5 @@ urlpatterns = [
     path('auth-status/', AuthStatusView.as_view(), name="auth-status"),
     path('task_status/<str:task_id>/', TaskStatusView.as_view(), name='task_status'),
     path('cancel_task/', CancelTaskView.as_view(), name='cancel_task'),
+    path('metrics/', MetricsView.as_view(), name='metrics'),
 ]
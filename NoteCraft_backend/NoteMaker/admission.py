@@ -0,0 +1,418 @@
+"""
+Admission control for the expensive AI endpoints.
+
+Each endpoint class (ask_ai, generate_note, modify) has:
+
+- a token bucket per user: ADMISSION_<CLASS>_RATE_PER_MINUTE requests with
+  bursts of ADMISSION_<CLASS>_BURST;
+- an in-flight budget per user (ADMISSION_<CLASS>_USER_INFLIGHT) and for all
+  users together (ADMISSION_<CLASS>_MAX_INFLIGHT).
+
+Anonymous callers are keyed by client IP ("ip:<address>"), so they share the
+same limits and the global budget always applies.
+
+A request that would wait at most ADMISSION_QUEUE_SECONDS for a token or a
+free slot is held that long; otherwise it is rejected with a retry-after
+estimate (AdmissionMiddleware answers 429 with a Retry-After header). A
+request rejected for lack of a slot gets its token back, so retrying after a
+429 does not drain the bucket.
+
+State lives in Redis, so the limits hold across uvicorn workers: buckets are
+hashes updated by a Lua script, and in-flight requests are leases in sorted
+sets scored by expiry, so a crashed worker cannot leak a slot for longer than
+ADMISSION_LEASE_SECONDS. Without Redis, the same limits are enforced per
+process.
+
+A generate_note lease is handed over to the Celery task (Lease.detach) and
+freed by release_task() when the task finishes, so the budget counts running
+notes tasks rather than the instant it takes to enqueue one.
+
+This module does not import Django.
+"""
+import asyncio
+import math
+import os
+import threading
+import time
+import uuid
+
+from . import tracing
+from .embedding_cache import get_redis, mark_redis_failed
+
+ADMISSION_ENABLED = os.getenv("ADMISSION_ENABLED", "True") == "True"
+# Longest a request is held waiting for a token or a slot before it is rejected
+ADMISSION_QUEUE_SECONDS = float(os.getenv("ADMISSION_QUEUE_SECONDS", "2"))
+ADMISSION_LEASE_SECONDS = int(os.getenv("ADMISSION_LEASE_SECONDS", "300"))
+# A detached generate_note lease outlives the request until its task ends
+ADMISSION_TASK_LEASE_SECONDS = int(os.getenv("ADMISSION_TASK_LEASE_SECONDS", "600"))
+ADMISSION_POLL_SECONDS = 0.1
+# Key anonymous callers by the first X-Forwarded-For address (behind a proxy that sets it)
+ADMISSION_TRUST_FORWARDED_FOR = os.getenv("ADMISSION_TRUST_FORWARDED_FOR", "False") == "True"
+
+KEY_PREFIX = "notecraft:admission"
+
+# class -> (rate per minute, burst, per-user in-flight, global in-flight)
+_DEFAULT_LIMITS = {
+    "ask_ai": (20, 5, 2, 32),
+    "generate_note": (4, 2, 1, 8),
+    "modify": (20, 5, 2, 16),
+}
+
+
+class Limits:
+
+    def __init__(self, endpoint: str, rate_per_minute, burst, user_inflight, max_inflight):
+        prefix = f"ADMISSION_{endpoint.upper()}"
+        self.rate_per_minute = float(os.getenv(f"{prefix}_RATE_PER_MINUTE", str(rate_per_minute)))
+        self.burst = float(os.getenv(f"{prefix}_BURST", str(burst)))
+        self.user_inflight = int(os.getenv(f"{prefix}_USER_INFLIGHT", str(user_inflight)))
+        self.max_inflight = int(os.getenv(f"{prefix}_MAX_INFLIGHT", str(max_inflight)))
+
+    @property
+    def rate(self) -> float:
+        return self.rate_per_minute / 60
+
+
+LIMITS = {endpoint: Limits(endpoint, *defaults) for endpoint, defaults in _DEFAULT_LIMITS.items()}
+
+
+class Rejected(Exception):
+    """The request is over its limit; retry_after is in whole seconds."""
+
+    def __init__(self, endpoint: str, reason: str, retry_after: float):
+        super().__init__(f"{endpoint} {reason}")
+        self.endpoint = endpoint
+        self.reason = reason
+        self.retry_after = max(1, math.ceil(retry_after))
+
+
+# --- stats ---
+
+_stats = {endpoint: {"admitted": 0, "queued": 0, "rejected_rate": 0, "rejected_inflight": 0, "inflight": 0}
+          for endpoint in LIMITS}
+_stats_lock = threading.Lock()
+
+
+def _count(endpoint: str, name: str, delta: int = 1):
+    with _stats_lock:
+        _stats[endpoint][name] += delta
+
+
+def admission_stats() -> dict:
+    """Counters per endpoint class, plus the global in-flight count when Redis is up."""
+    with _stats_lock:
+        stats = {f"{endpoint}_{name}": value for endpoint, values in _stats.items() for name, value in values.items()}
+    for endpoint, limits in LIMITS.items():
+        stats[f"{endpoint}_max_inflight"] = limits.max_inflight
+    client = get_redis()
+    if client is not None:
+        try:
+            now = time.time()
+            pipe = client.pipeline(transaction=False)
+            for endpoint in LIMITS:
+                pipe.zcount(_inflight_key(endpoint), now, "+inf")
+            for endpoint, count in zip(LIMITS, pipe.execute()):
+                stats[f"{endpoint}_global_inflight"] = count
+        except Exception as e:
+            mark_redis_failed(e)
+    return stats
+
+
+# --- token bucket ---
+
+# Returns {admitted, seconds}: the wait before the reserved token is due, or
+# the time until one would be available when the wait exceeds ARGV[3]
+_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local max_wait = tonumber(ARGV[3])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or burst
+local ts = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+local wait = 0
+if tokens < 1 then wait = (1 - tokens) / rate end
+local admitted = 0
+if wait <= max_wait then
+  tokens = tokens - 1
+  admitted = 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 60)
+return {admitted, tostring(wait)}
+"""
+
+# Gives back a token taken by a request that was then rejected, up to the burst
+_REFUND_SCRIPT = """
+local tokens = tonumber(redis.call('HGET', KEYS[1], 'tokens'))
+if tokens then
+  redis.call('HSET', KEYS[1], 'tokens', tostring(math.min(tonumber(ARGV[1]), tokens + 1)))
+end
+return 1
+"""
+
+# user key -> [tokens, last refill], without Redis
+_local_buckets = {}
+_local_lock = threading.Lock()
+
+
+def _take_token(client, endpoint: str, user: str, limits: Limits, max_wait: float) -> tuple:
+    """Reserves a token; returns (admitted, seconds to wait before using it or until retrying)."""
+    if limits.rate <= 0:
+        return True, 0.0
+    key = f"{KEY_PREFIX}:bucket:{endpoint}:{user}"
+    if client is not None:
+        try:
+            admitted, wait = client.eval(_BUCKET_SCRIPT, 1, key, limits.rate, limits.burst, max_wait)
+            return bool(admitted), float(wait)
+        except Exception as e:
+            mark_redis_failed(e)
+
+    with _local_lock:
+        now = time.monotonic()
+        tokens, refilled = _local_buckets.get(key, (limits.burst, now))
+        tokens = min(limits.burst, tokens + (now - refilled) * limits.rate)
+        wait = (1 - tokens) / limits.rate if tokens < 1 else 0.0
+        if wait <= max_wait:
+            tokens -= 1
+        _local_buckets[key] = (tokens, now)
+        return wait <= max_wait, wait
+
+
+def _refund_token(client, endpoint: str, user: str, limits: Limits):
+    if limits.rate <= 0:
+        return
+    key = f"{KEY_PREFIX}:bucket:{endpoint}:{user}"
+    if client is not None:
+        try:
+            client.eval(_REFUND_SCRIPT, 1, key, limits.burst)
+            return
+        except Exception as e:
+            mark_redis_failed(e)
+
+    with _local_lock:
+        if key in _local_buckets:
+            tokens, refilled = _local_buckets[key]
+            _local_buckets[key] = (min(limits.burst, tokens + 1), refilled)
+
+
+# --- in-flight leases ---
+
+# Adds ARGV[3] to the set when fewer than ARGV[1] unexpired leases are held
+_LEASE_SCRIPT = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+if redis.call('ZCARD', KEYS[1]) >= tonumber(ARGV[1]) then
+  return 0
+end
+redis.call('ZADD', KEYS[1], now + tonumber(ARGV[2]), ARGV[3])
+if redis.call('TTL', KEYS[1]) < tonumber(ARGV[2]) then
+  redis.call('EXPIRE', KEYS[1], tonumber(ARGV[2]))
+end
+return 1
+"""
+
+# lease set key -> {lease id: expiry}, without Redis
+_local_leases = {}
+
+
+def _inflight_key(endpoint: str, user: str = None) -> str:
+    if user is None:
+        return f"{KEY_PREFIX}:inflight:{endpoint}"
+    return f"{KEY_PREFIX}:inflight:{endpoint}:user:{user}"
+
+
+def _try_lease(client, set_key: str, limit: int, lease_id: str) -> bool:
+    if client is not None:
+        try:
+            return bool(client.eval(_LEASE_SCRIPT, 1, set_key, limit, ADMISSION_LEASE_SECONDS, lease_id))
+        except Exception as e:
+            mark_redis_failed(e)
+
+    with _local_lock:
+        now = time.monotonic()
+        leases = {k: v for k, v in _local_leases.get(set_key, {}).items() if v > now}
+        _local_leases[set_key] = leases
+        if len(leases) >= limit:
+            return False
+        leases[lease_id] = now + ADMISSION_LEASE_SECONDS
+        return True
+
+
+def _drop_lease(set_key: str, lease_id: str):
+    client = get_redis()
+    if client is not None:
+        try:
+            client.zrem(set_key, lease_id)
+            return
+        except Exception as e:
+            mark_redis_failed(e)
+    with _local_lock:
+        _local_leases.get(set_key, {}).pop(lease_id, None)
+
+
+def _extend_lease(set_key: str, lease_id: str, seconds: int):
+    # XX: a lease already released (task finished first) is not re-added
+    client = get_redis()
+    if client is not None:
+        try:
+            client.zadd(set_key, {lease_id: time.time() + seconds}, xx=True)
+            if client.ttl(set_key) < seconds:
+                client.expire(set_key, seconds)
+            return
+        except Exception as e:
+            mark_redis_failed(e)
+    with _local_lock:
+        leases = _local_leases.get(set_key, {})
+        if lease_id in leases:
+            leases[lease_id] = time.monotonic() + seconds
+
+
+def _task_key(task_id: str) -> str:
+    return f"{KEY_PREFIX}:task:{task_id}"
+
+
+# task id -> lease set keys of detached leases, without Redis
+_local_tasks = {}
+
+
+class Lease:
+    """An admitted request's in-flight slots; release() frees them, detach() hands them to a task."""
+
+    def __init__(self, endpoint: str, user: str):
+        self.id = str(uuid.uuid4())
+        self.endpoint = endpoint
+        self.keys = [_inflight_key(endpoint, user), _inflight_key(endpoint)]
+        self.done = False
+
+    def detach(self) -> str:
+        """
+        Keeps the slots after the request ends; they are freed by
+        release_task(lease id) or when they expire. Returns the lease id,
+        to be used as the Celery task id.
+        """
+        if self.done:
+            return self.id
+        self.done = True
+        _count(self.endpoint, "inflight", -1)
+        client = get_redis()
+        stored = False
+        if client is not None:
+            try:
+                # The task may run in another process, which finds the keys here
+                client.rpush(_task_key(self.id), *self.keys)
+                client.expire(_task_key(self.id), ADMISSION_TASK_LEASE_SECONDS)
+                stored = True
+            except Exception as e:
+                mark_redis_failed(e)
+        if not stored:
+            with _local_lock:
+                _local_tasks[self.id] = list(self.keys)
+        for key in self.keys:
+            _extend_lease(key, self.id, ADMISSION_TASK_LEASE_SECONDS)
+        return self.id
+
+    def release(self):
+        if self.done:
+            return
+        self.done = True
+        _count(self.endpoint, "inflight", -1)
+        for key in self.keys:
+            _drop_lease(key, self.id)
+
+
+def release_task(task_id: str):
+    """Frees the slots of the lease detached to the task task_id, if any."""
+    with _local_lock:
+        keys = _local_tasks.pop(task_id, None)
+    client = get_redis()
+    if keys is None and client is not None:
+        try:
+            keys = [key.decode() for key in client.lrange(_task_key(task_id), 0, -1)]
+            client.delete(_task_key(task_id))
+        except Exception as e:
+            mark_redis_failed(e)
+    for key in keys or ():
+        _drop_lease(key, task_id)
+
+
+def _admit_step(lease: Lease):
+    """
+    One attempt to get the lease's slots. Returns None when admitted, or the
+    Rejected to raise if the queueing deadline passes first.
+    """
+    client = get_redis()
+    endpoint = lease.endpoint
+    limits = LIMITS[endpoint]
+    user_key, global_key = lease.keys
+    if not _try_lease(client, user_key, limits.user_inflight, lease.id):
+        return Rejected(endpoint, "user in-flight limit", ADMISSION_QUEUE_SECONDS)
+    if not _try_lease(client, global_key, limits.max_inflight, lease.id):
+        _drop_lease(user_key, lease.id)
+        return Rejected(endpoint, "global in-flight limit", ADMISSION_QUEUE_SECONDS)
+    return None
+
+
+async def aadmit(endpoint: str, user: str) -> Lease:
+    """
+    Waits up to ADMISSION_QUEUE_SECONDS for a token and in-flight slots.
+    Returns the Lease to release when the request is done; raises Rejected.
+    """
+    deadline = time.monotonic() + ADMISSION_QUEUE_SECONDS
+    admitted, wait = await asyncio.to_thread(_take_token, get_redis(), endpoint, user, LIMITS[endpoint], ADMISSION_QUEUE_SECONDS)
+    if not admitted:
+        _count(endpoint, "rejected_rate")
+        raise Rejected(endpoint, "rate limit", wait)
+    queued = wait > 0
+    if queued:
+        await asyncio.sleep(wait)
+
+    lease = Lease(endpoint, user)
+    while True:
+        rejected = await asyncio.to_thread(_admit_step, lease)
+        if rejected is None:
+            break
+        if time.monotonic() + ADMISSION_POLL_SECONDS > deadline:
+            _count(endpoint, "rejected_inflight")
+            await asyncio.to_thread(_refund_token, get_redis(), endpoint, user, LIMITS[endpoint])
+            raise rejected
+        queued = True
+        await asyncio.sleep(ADMISSION_POLL_SECONDS)
+    return _admitted(lease, queued)
+
+
+def admit(endpoint: str, user: str) -> Lease:
+    """Sync version of aadmit, for WSGI deployments."""
+    deadline = time.monotonic() + ADMISSION_QUEUE_SECONDS
+    admitted, wait = _take_token(get_redis(), endpoint, user, LIMITS[endpoint], ADMISSION_QUEUE_SECONDS)
+    if not admitted:
+        _count(endpoint, "rejected_rate")
+        raise Rejected(endpoint, "rate limit", wait)
+    queued = wait > 0
+    if queued:
+        time.sleep(wait)
+
+    lease = Lease(endpoint, user)
+    while True:
+        rejected = _admit_step(lease)
+        if rejected is None:
+            break
+        if time.monotonic() + ADMISSION_POLL_SECONDS > deadline:
+            _count(endpoint, "rejected_inflight")
+            _refund_token(get_redis(), endpoint, user, LIMITS[endpoint])
+            raise rejected
+        queued = True
+        time.sleep(ADMISSION_POLL_SECONDS)
+    return _admitted(lease, queued)
+
+
+def _admitted(lease: Lease, queued: bool) -> Lease:
+    _count(lease.endpoint, "admitted")
+    _count(lease.endpoint, "inflight")
+    if queued:
+        _count(lease.endpoint, "queued")
+    tracing.set_attributes({"admission.endpoint": lease.endpoint, "admission.queued": queued})
+    return lease
@@ -1,21 +1,60 @@
+import asyncio
 import os
-import tempfile
+import threading
+import time
 import requests
-import uuid
+import weakref
+from asgiref.sync import sync_to_async
+from concurrent.futures import ThreadPoolExecutor, wait
 from dotenv import load_dotenv
-from langchain_community.document_loaders import PyPDFLoader
-from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain_openai import ChatOpenAI
-from pinecone import Pinecone
+from pinecone import Pinecone, PineconeAsyncio
 from django.conf import settings
 #from langchain.schema import HumanMessage, SystemMessage
 from langchain_core.messages import HumanMessage, SystemMessage
 from .prompts import EXPANSION_PROMPT, SYSTEM_PROMPT
+from .embedding_cache import get_embeddings, aget_embeddings, cache_stats
+from .answer_cache import get_index_generation, lookup_answer, store_answer, bump_index_generation
+from .context_packer import count_tokens, pack_context
+from . import llm_gateway
+from .glossary import expansion_stats, extract_search_queries, record_expansion
+from . import docstore, lexical_index, metrics
+from .metrics import stage, submit_in_context
+from .vector_store import aclose_vector_store, get_vector_store
+from .pdf_ingest import ingest_pdf
+from .chunk_embedding_cache import chunk_cache_stats
+from .namespaces import GENERAL_NAMESPACE, route_query
+from .sql_router import answer_structured
 load_dotenv()
 
-# Initialize Pinecone
+# Query expansion only returns a short keyword list, so give up on it early
+EXPANSION_TIMEOUT_SECONDS = float(os.getenv("EXPANSION_TIMEOUT_SECONDS", "15"))
+# The raw query is searched while the LLM expansion runs. With SPECULATIVE_SKIP_EXPANSION,
+# a raw-query vector match at or above the threshold answers without waiting for expansion
+SPECULATIVE_SKIP_EXPANSION = os.getenv("SPECULATIVE_SKIP_EXPANSION", "False") == "True"
+SPECULATIVE_CONFIDENCE_THRESHOLD = float(os.getenv("SPECULATIVE_CONFIDENCE_THRESHOLD", "0.6"))
+EXPANSION_MAX_CONCURRENCY = int(os.getenv("EXPANSION_MAX_CONCURRENCY", "4"))
+
+# Initialize Pinecone (embeddings); vectors are stored through vector_store
 PINECONE_API_KEY = os.getenv("PINECONE_API_KEY")
-INDEX_NAME = "teamfight-tactics-knowledges"
+
+# Concurrent search settings
+# SEARCH_MAX_CONCURRENCY caps in-flight vector store queries per process (shared by all requests)
+# SEARCH_DEADLINE_SECONDS bounds the whole search stage; slower sub-queries are dropped
+SEARCH_MAX_CONCURRENCY = int(os.getenv("SEARCH_MAX_CONCURRENCY", "8"))
+SEARCH_DEADLINE_SECONDS = float(os.getenv("SEARCH_DEADLINE_SECONDS", "5"))
+# Matches per sub-query from each retriever; RRF makes deep dense lists unnecessary
+SEARCH_TOP_K = int(os.getenv("SEARCH_TOP_K", "30"))
+LEXICAL_TOP_K = int(os.getenv("LEXICAL_TOP_K", "30"))
+
+_search_executor = ThreadPoolExecutor(
+    max_workers=SEARCH_MAX_CONCURRENCY,
+    thread_name_prefix="pinecone-search"
+)
+# Expansion calls get their own threads so they never hold up searches
+_expansion_executor = ThreadPoolExecutor(
+    max_workers=EXPANSION_MAX_CONCURRENCY,
+    thread_name_prefix="query-expansion"
+)
 
 if not PINECONE_API_KEY:
     print("Warning: PINECONE_API_KEY not found.")
@@ -27,206 +66,601 @@ else:
         print(f"Error initializing Pinecone: {e}")
         pc = None
 
-def get_index():
-    if not pc:
-        raise ValueError("Pinecone not initialized")
-    return pc.Index(INDEX_NAME)
+# Process-local counters shown on /metrics/
+metrics.register_gauges("embedding_cache", cache_stats)
+metrics.register_gauges("query_expansion", expansion_stats)
+metrics.register_gauges("chunk_embedding_cache", chunk_cache_stats)
+metrics.register_gauges("llm_breaker", lambda: {"open": int(llm_gateway.breaker.state != "closed")})
+
+# Async clients are bound to the event loop that created them (aiohttp sessions),
+# so keep one set per loop. Under uvicorn that is one per worker process.
+_async_clients = weakref.WeakKeyDictionary()
+
+async def get_async_clients() -> dict:
+    """
+    Returns {"pc", "semaphore"} for the running event loop: a PineconeAsyncio
+    client for embeddings and the search concurrency limit.
+    """
+    loop = asyncio.get_running_loop()
+    clients = _async_clients.get(loop)
+    if clients is None:
+        clients = {
+            "pc": PineconeAsyncio(api_key=PINECONE_API_KEY),
+            "semaphore": asyncio.Semaphore(SEARCH_MAX_CONCURRENCY)
+        }
+        _async_clients[loop] = clients
+    return clients
+
+async def aclose_async_clients():
+    """
+    Closes the running event loop's async Pinecone clients (their aiohttp
+    sessions): the embedding client and the vector store's index client.
+    """
+    clients = _async_clients.pop(asyncio.get_running_loop(), None)
+    if clients is not None:
+        try:
+            await clients["pc"].close()
+        except Exception as e:
+            print(f"Error closing async Pinecone client: {e}")
+    await aclose_vector_store()
+
+def embed_queries(queries: list) -> dict:
+    """
+    Embeds all search queries, using the query embedding cache and a single
+    Pinecone Inference call for the cache misses.
+    Returns a dict mapping each query to its vector; queries that could not be
+    embedded are left out.
+    """
+    if not queries:
+        return {}
+    vectors = get_embeddings(pc, queries, input_type="query")
+    return {q: v for q, v in zip(queries, vectors) if v is not None}
+
+def route_queries(queries: list) -> dict:
+    """Maps each search query to the namespaces it is searched in."""
+    routes = {q: route_query(q) for q in queries}
+    print(f"Namespace routes: {routes}")
+    return routes
+
+def merge_namespace_results(matches_by_query: dict, top_k: int) -> dict:
+    """Merges the matches a query got from its namespaces by score, best first."""
+    return {
+        q: sorted(matches, key=lambda m: m["score"], reverse=True)[:top_k]
+        for q, matches in matches_by_query.items()
+    }
+
+def search_concurrently(store, query_embeddings: dict, queries: list, routes: dict,
+                        top_k: int = SEARCH_TOP_K) -> dict:
+    """
+    Runs one vector store search per (query, namespace) pair in parallel under
+    an overall deadline. Returns a dict mapping each query to its matches from
+    the namespaces that finished in time; matches carry their "namespace".
+    """
+    futures = {}
+    for q in queries:
+        if q not in query_embeddings:
+            continue
+        for namespace in routes[q]:
+            futures[(q, namespace)] = submit_in_context(
+                _search_executor,
+                store.query,
+                vector=query_embeddings[q],
+                top_k=top_k,
+                namespace=namespace,
+                include_metadata=False  # Text comes from the docstore for the chunks that survive ranking
+            )
+
+    if not futures:
+        return {}
+
+    done, not_done = wait(futures.values(), timeout=SEARCH_DEADLINE_SECONDS)
+
+    results = {}
+    for (q, namespace), future in futures.items():
+        if future not in done:
+            # Drop slow searches instead of blocking the answer
+            future.cancel()
+            print(f"Search for query '{q}' in '{namespace}' exceeded {SEARCH_DEADLINE_SECONDS}s deadline, dropped")
+            continue
+        try:
+            results.setdefault(q, []).extend({**m, "namespace": namespace} for m in future.result())
+        except Exception as e:
+            print(f"Error searching for query '{q}' in '{namespace}': {e}")
+    return merge_namespace_results(results, top_k)
+
+async def aembed_queries(queries: list) -> dict:
+    """Async version of embed_queries."""
+    if not queries:
+        return {}
+    clients = await get_async_clients()
+    vectors = await aget_embeddings(clients["pc"], queries, input_type="query")
+    return {q: v for q, v in zip(queries, vectors) if v is not None}
+
+async def asearch_concurrently(query_embeddings: dict, queries: list, routes: dict,
+                              top_k: int = SEARCH_TOP_K) -> dict:
+    """Async version of search_concurrently."""
+    store = get_vector_store()
+    semaphore = (await get_async_clients())["semaphore"]
+
+    async def search_one(q, namespace):
+        async with semaphore:
+            return await store.aquery(
+                vector=query_embeddings[q],
+                top_k=top_k,
+                namespace=namespace,
+                include_metadata=False
+            )
+
+    tasks = {
+        (q, namespace): asyncio.create_task(search_one(q, namespace))
+        for q in queries if q in query_embeddings
+        for namespace in routes[q]
+    }
+    if not tasks:
+        return {}
+
+    done, pending = await asyncio.wait(tasks.values(), timeout=SEARCH_DEADLINE_SECONDS)
+
+    results = {}
+    for (q, namespace), task in tasks.items():
+        if task in pending:
+            # Drop slow searches instead of blocking the answer
+            task.cancel()
+            print(f"Search for query '{q}' in '{namespace}' exceeded {SEARCH_DEADLINE_SECONDS}s deadline, dropped")
+            continue
+        try:
+            results.setdefault(q, []).extend({**m, "namespace": namespace} for m in task.result())
+        except Exception as e:
+            print(f"Error searching for query '{q}' in '{namespace}': {e}")
+    return merge_namespace_results(results, top_k)
+
+def lexical_search(queries: list, routes: dict, top_k: int = LEXICAL_TOP_K) -> dict:
+    """
+    BM25 search in the local lexical index for every query, across its routed namespaces.
+    Returns a dict mapping each query to its matches.
+    """
+    results = {}
+    with stage("ask_ai", "lexical_search", queries=len(queries), top_k=top_k):
+        for q in queries:
+            try:
+                results[q] = lexical_index.search(q, top_k=top_k, namespaces=routes[q])
+            except Exception as e:
+                print(f"Lexical search for query '{q}' failed: {e}")
+    metrics.record_matches("ask_ai", "lexical_search", sum(len(m) for m in results.values()))
+    return results
+
+def fuse_results(queries: list, dense_results: dict, lexical_results: dict, top_k: int = SEARCH_TOP_K) -> dict:
+    """Per sub-query reciprocal rank fusion of the vector and BM25 rankings, cut to top_k."""
+    fused = {}
+    for q in queries:
+        ranked_lists = [dense_results.get(q) or [], lexical_results.get(q) or []]
+        if any(ranked_lists):
+            fused[q] = lexical_index.reciprocal_rank_fusion(ranked_lists)[:top_k]
+    return fused
+
+def hydrate_results(results_by_query: dict) -> dict:
+    """
+    Attaches chunk text to the fused matches of every sub-query with one bulk
+    docstore read. Matches whose text cannot be found are dropped.
+    """
+    unique = {}
+    for matches in results_by_query.values():
+        for match in matches:
+            unique.setdefault(match["id"], match)
+    metadata = {
+        m["id"]: m["metadata"]
+        for m in docstore.hydrate(list(unique.values()), get_vector_store())
+    }
+    return {
+        q: [{**m, "metadata": metadata[m["id"]]} for m in matches if m["id"] in metadata]
+        for q, matches in results_by_query.items()
+    }
 
 def process_pdf_from_url(pdf_url: str):
     """
     Downloads PDF from URL, processes it, and stores in vector DB
     """
     try:
-        # Create a temporary file
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as temp_file:
-            response = requests.get(pdf_url)
-            temp_file.write(response.content)
-            temp_file_path = temp_file.name
-
-        # Process the temporary file
-        process_pdf_to_vector_db(temp_file_path)
-
-        # Clean up
-        os.remove(temp_file_path)
+        response = requests.get(pdf_url)
+        response.raise_for_status()
+        process_pdf_to_vector_db(response.content)
         return True
     except Exception as e:
         print(f"Error processing PDF from URL: {e}")
         return False
 
-def process_pdf_to_vector_db(pdf_path: str):
+def process_pdf_to_vector_db(pdf, namespace: str = GENERAL_NAMESPACE, metadata: dict = None,
+                             id_prefix: str = None, on_progress=None, cache_stats=None) -> int:
     """
-    Reads PDF, splits text, and stores in Pinecone
+    Streams a PDF (path or bytes) into the vector store page by page, see
+    pdf_ingest.ingest_pdf. Returns the number of chunks.
     """
     if not pc:
         raise ValueError("Pinecone not initialized")
 
     try:
-        # 1. Load PDF
-        loader = PyPDFLoader(pdf_path)
-        documents = loader.load()
-
-        # 2. Split Text
-        text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=1000,
-            chunk_overlap=200
+        count = ingest_pdf(
+            pc, get_vector_store(), pdf, namespace,
+            metadata=metadata, id_prefix=id_prefix, on_progress=on_progress, cache_stats=cache_stats
         )
-        texts = text_splitter.split_documents(documents)
-
-        # 3. Vectorize and Store in Pinecone
-        index = get_index()
-        
-        # Batch process to avoid hitting limits
-        batch_size = 96 
-        print(f"Processing {len(texts)} chunks for Pinecone...")
-        
-        for i in range(0, len(texts), batch_size):
-            batch = texts[i:i+batch_size]
-            batch_texts = [t.page_content for t in batch]
-            
-            # Generate embeddings using Pinecone Inference API
-            # Using llama-text-embed-v2 as in myutils.py
-            embeddings_response = pc.inference.embed(
-                model="llama-text-embed-v2",
-                inputs=batch_texts,
-                parameters={"input_type": "passage"}
-            )
-            
-            vectors = []
-            for j, embedding_data in enumerate(embeddings_response):
-                doc_id = str(uuid.uuid4())
-                
-                # Prepare metadata
-                metadata = {
-                    "text": batch_texts[j],
-                    "source": batch[j].metadata.get("source", pdf_path),
-                    "page": batch[j].metadata.get("page", 0)
-                }
-                
-                vectors.append({
-                    "id": doc_id,
-                    "values": embedding_data['values'],
-                    "metadata": metadata
-                })
-            
-            # Upsert to Pinecone (default namespace)
-            index.upsert(vectors=vectors)
-            
-        print(f"Successfully added {pdf_path} to Pinecone knowledge base")
-        return True
+        # Cached answers may be stale now
+        bump_index_generation()
+        return count
     except Exception as e:
         print(f"Error processing PDF: {e}")
         raise e
 
+def lookup_cached_answer(query: str):
+    """
+    Embeds the question and checks the semantic answer cache.
+    Returns (question_embedding, cached_entry_or_None, index_generation);
+    the generation is read first and must be passed to store_answer.
+    """
+    generation = get_index_generation()
+    question_embedding = embed_queries([query]).get(query)
+    if question_embedding is None:
+        return None, None, generation
+    cached = lookup_answer(question_embedding, generation)
+    if cached:
+        print(f"Answer cache hit (similarity {cached['similarity']:.3f}): '{cached['question']}'")
+    return question_embedding, cached, generation
+
+def local_expansion(query: str) -> list:
+    """
+    Search queries from the local TFT glossary (names, aliases, cost phrases).
+    Returns an empty list when the LLM expansion has to run instead.
+    """
+    try:
+        search_queries = extract_search_queries(query)
+    except Exception as e:
+        print(f"Glossary extraction failed: {e}")
+        search_queries = []
+    record_expansion("local" if search_queries else "fallback")
+    if search_queries:
+        print(f"Glossary search queries: {search_queries}")
+    return search_queries
+
+def get_expansion_messages(query: str) -> list:
+    # Generate search queries based on user input to capture all entities
+    return [
+        SystemMessage(content=EXPANSION_PROMPT),
+        HumanMessage(content=query)
+    ]
+
+def parse_expansion(content: str) -> list:
+    search_queries = [q.strip() for q in content.split('\n') if q.strip()]
+    print(f"Generated search queries: {search_queries}")
+    return search_queries
+
+def expand_with_llm(query: str, cancelled: threading.Event = None) -> list:
+    """
+    LLM query expansion; returns an empty list when the call fails or was
+    cancelled before it started.
+    """
+    if cancelled is not None and cancelled.is_set():
+        return []
+    try:
+        with stage("ask_ai", "expansion"):
+            expansion_response = llm_gateway.invoke(get_expansion_messages(query), timeout=EXPANSION_TIMEOUT_SECONDS,
+                                                    cancelled=cancelled)
+        return parse_expansion(expansion_response.content)
+    except Exception as e:
+        print(f"Query expansion failed: {e}")
+        return []
+
+def is_confident(top_scores: dict, query: str) -> bool:
+    """True when speculative skipping is on and the raw query's best vector match is strong enough."""
+    top_score = top_scores.get(query)
+    return SPECULATIVE_SKIP_EXPANSION and top_score is not None and top_score >= SPECULATIVE_CONFIDENCE_THRESHOLD
+
+def hybrid_search(queries: list) -> tuple:
+    """
+    Routes every query to its namespaces, then runs the BM25 search in the
+    background while all queries are embedded in one batch and every
+    (query, namespace) pair is searched in parallel. Returns (fused, top_scores):
+    the per-query RRF fusion of both rankings (without text) and the best
+    vector similarity per query.
+    """
+    routes = route_queries(queries)
+    lexical_future = submit_in_context(_search_executor, lexical_search, queries, routes)
+    with stage("ask_ai", "embed", queries=len(queries)):
+        query_embeddings = embed_queries(queries)
+
+    with stage("ask_ai", "vector_search", queries=len(queries), top_k=SEARCH_TOP_K):
+        dense_results = search_concurrently(get_vector_store(), query_embeddings, queries, routes)
+    metrics.record_matches("ask_ai", "vector_search", sum(len(m) for m in dense_results.values()))
+    try:
+        lexical_results = lexical_future.result(timeout=SEARCH_DEADLINE_SECONDS)
+    except Exception as e:
+        print(f"Lexical search dropped: {e}")
+        lexical_results = {}
+    top_scores = {q: matches[0]["score"] for q, matches in dense_results.items() if matches}
+    return fuse_results(queries, dense_results, lexical_results), top_scores
+
+def record_packed(packed: dict):
+    metrics.record_matches("ask_ai", "pack_context", len(packed["chunks"]))
+    metrics.record_tokens("ask_ai", "context", packed["tokens_used"])
+    metrics.record_tokens("ask_ai", "context_saved", packed["tokens_saved"])
+
+def retrieve_context(query: str) -> dict:
+    """
+    Expands the query, searches every sub-query and packs the context.
+    Returns {"search_queries", "packed"} where packed is the pack_context result.
+    """
+    # 1. Query Expansion / Keyword Extraction
+    # Local glossary first; the LLM expansion call only runs when it finds nothing
+    search_queries = local_expansion(query)
+    if search_queries:
+        # Always include the original query as a fallback/supplement
+        if query not in search_queries:
+            search_queries.append(query)
+        results_by_query, _ = hybrid_search(search_queries)
+    else:
+        # 2. Speculative retrieval: the original query is always searched, so search it
+        #    while the expansion call is still running, then only the new terms
+        expansion_cancelled = threading.Event()
+        expansion_future = submit_in_context(_expansion_executor, expand_with_llm, query, expansion_cancelled)
+        results_by_query, top_scores = hybrid_search([query])
+        search_queries = [query]
+        if is_confident(top_scores, query):
+            # cancel() only drops the call if no expansion thread has picked it up yet.
+            # A call already sending its request keeps its thread until the response or
+            # EXPANSION_TIMEOUT_SECONDS; the event stops it from retrying after that
+            expansion_future.cancel()
+            expansion_cancelled.set()
+            record_expansion("skipped")
+            print(f"Raw query matched with score {top_scores[query]:.3f}, not waiting for expansion")
+        else:
+            with stage("ask_ai", "expansion_wait"):
+                expansion = expansion_future.result()
+            extra_queries = [q for q in dict.fromkeys(expansion) if q != query]
+            if extra_queries:
+                extra_results, _ = hybrid_search(extra_queries)
+                results_by_query.update(extra_results)
+                search_queries = extra_queries + [query]
+
+    with stage("ask_ai", "hydrate"):
+        results_by_query = hydrate_results(results_by_query)
+
+    # Pack the prompt context: dedup across sub-queries, MMR selection within the token budget
+    with stage("ask_ai", "pack_context"):
+        packed = pack_context(results_by_query, search_queries)
+    record_packed(packed)
+    print(f"Context packed: {len(packed['chunks'])} chunks, {packed['tokens_used']} tokens, ~{packed['tokens_saved']} tokens saved")
+
+    return {"search_queries": search_queries, "packed": packed}
+
+def build_answer_messages(query: str, context_text: str) -> list:
+    if not context_text:
+        context_text = "No relevant context found in the knowledge base."
+
+    # 3. Construct Prompt for Final Answer
+    system_prompt = SYSTEM_PROMPT
+    
+    user_prompt = f"""
+    【参考资料】：
+    {context_text}
+    
+    用户问题：{query}
+    """
+    
+    return [
+        SystemMessage(content=system_prompt),
+        HumanMessage(content=user_prompt)
+    ]
+
 def query_ai(query: str):
     """
     Queries the AI with the given question using RAG (Pinecone + OpenRouter)
     """
     try:
+        # Exact lists and attribute lookups come straight from the entity tables
+        with stage("ask_ai", "sql_router"):
+            structured = answer_structured(query)
+        if structured:
+            return structured
+
         if not pc:
             raise ValueError("Pinecone not initialized")
 
-        # Initialize LLM first (needed for query expansion)
-        open_router_key = os.getenv("OPEN_ROUTER_API_KEY")
-        if not open_router_key:
-            raise ValueError("OPEN_ROUTER_API_KEY not found in environment variables")
+        # 0. Semantic answer cache: reuse the answer of a near-identical earlier question
+        with stage("ask_ai", "answer_cache"):
+            question_embedding, cached, generation = lookup_cached_answer(query)
+        if cached:
+            return {
+                "answer": cached["answer"],
+                "sources": cached["sources"],
+                "cached": True
+            }
 
-        print(f"Initializing ChatOpenAI with model: deepseek-chat")
+        packed = retrieve_context(query)["packed"]
+        messages = build_answer_messages(query, packed["context_text"])
         
-        llm = ChatOpenAI(
-            model="deepseek-chat", 
-            api_key=open_router_key,
-            base_url="https://api.deepseek.com",
-            temperature=0
-        )
+        # 4. Invoke LLM
+        with stage("ask_ai", "llm_answer"):
+            response = llm_gateway.invoke(messages)
+        metrics.record_llm_usage("ask_ai", response)
 
-        # 1. Query Expansion / Keyword Extraction
-        # Generate search queries based on user input to capture all entities
-        expansion_prompt = EXPANSION_PROMPT
+        # Only cache answers that were grounded in retrieved context
+        if question_embedding is not None and packed["chunks"]:
+            with stage("ask_ai", "answer_cache_store"):
+                store_answer(query, question_embedding, response.content, packed["sources"], generation)
         
-        expansion_messages = [
-            SystemMessage(content=expansion_prompt),
-            HumanMessage(content=query)
-        ]
-        
-        search_queries = []
-        try:
-            # Use a separate try-except for expansion to not fail the whole request
-            expansion_response = llm.invoke(expansion_messages)
-            search_queries = [q.strip() for q in expansion_response.content.split('\n') if q.strip()]
-            print(f"Generated search queries: {search_queries}")
-        except Exception as e:
-            print(f"Query expansion failed: {e}")
+        return {
+            "answer": response.content,
+            "sources": packed["sources"],
+            "context_tokens": packed["tokens_used"],
+            "tokens_saved": packed["tokens_saved"]
+        }
+    except Exception as e:
+        print(f"AI Query Error: {e}")
+        raise e
 
-        # Always include the original query as a fallback/supplement
+async def alookup_cached_answer(query: str):
+    """Async version of lookup_cached_answer."""
+    generation = await asyncio.to_thread(get_index_generation)
+    question_embedding = (await aembed_queries([query])).get(query)
+    if question_embedding is None:
+        return None, None, generation
+    cached = await asyncio.to_thread(lookup_answer, question_embedding, generation)
+    if cached:
+        print(f"Answer cache hit (similarity {cached['similarity']:.3f}): '{cached['question']}'")
+    return question_embedding, cached, generation
+
+async def aexpand_with_llm(query: str) -> list:
+    """Async version of expand_with_llm."""
+    try:
+        with stage("ask_ai", "expansion"):
+            expansion_response = await llm_gateway.ainvoke(get_expansion_messages(query), timeout=EXPANSION_TIMEOUT_SECONDS)
+        return parse_expansion(expansion_response.content)
+    except Exception as e:
+        print(f"Query expansion failed: {e}")
+        return []
+
+async def ahybrid_search(queries: list) -> tuple:
+    """Async version of hybrid_search."""
+    routes = route_queries(queries)
+    lexical_task = asyncio.create_task(asyncio.to_thread(lexical_search, queries, routes))
+    with stage("ask_ai", "embed", queries=len(queries)):
+        query_embeddings = await aembed_queries(queries)
+    with stage("ask_ai", "vector_search", queries=len(queries), top_k=SEARCH_TOP_K):
+        dense_results = await asearch_concurrently(query_embeddings, queries, routes)
+    metrics.record_matches("ask_ai", "vector_search", sum(len(m) for m in dense_results.values()))
+    try:
+        lexical_results = await asyncio.wait_for(lexical_task, timeout=SEARCH_DEADLINE_SECONDS)
+    except Exception as e:
+        print(f"Lexical search dropped: {e}")
+        lexical_results = {}
+    top_scores = {q: matches[0]["score"] for q, matches in dense_results.items() if matches}
+    return fuse_results(queries, dense_results, lexical_results), top_scores
+
+async def aretrieve_context(query: str) -> dict:
+    """Async version of retrieve_context."""
+    search_queries = local_expansion(query)
+    if search_queries:
         if query not in search_queries:
             search_queries.append(query)
-            
-        # 2. Search Pinecone for each query
-        index = get_index()
-        seen_ids = set()
-        all_matches = []
-        
-        for q in search_queries:
-            try:
-                # Embed Query
-                query_embedding = pc.inference.embed(
-                    model="llama-text-embed-v2",
-                    inputs=[q],
-                    parameters={"input_type": "query"}
-                )[0]['values']
-                
-                # Search Pinecone
-                results = index.query(
-                    vector=query_embedding,
-                    top_k=100, # 降低到合理值，避免响应缓慢和Token消耗过大
-                    include_metadata=True
-                )
-                
-                if results.matches:
-                    for match in results.matches:
-                        if match.id not in seen_ids:
-                            seen_ids.add(match.id)
-                            all_matches.append(match)
-            except Exception as e:
-                print(f"Error searching for query '{q}': {e}")
+        results_by_query, _ = await ahybrid_search(search_queries)
+    else:
+        expansion_task = asyncio.create_task(aexpand_with_llm(query))
+        results_by_query, top_scores = await ahybrid_search([query])
+        search_queries = [query]
+        if is_confident(top_scores, query):
+            # Cancelling closes the in-flight LLM request
+            expansion_task.cancel()
+            record_expansion("skipped")
+            print(f"Raw query matched with score {top_scores[query]:.3f}, not waiting for expansion")
+        else:
+            with stage("ask_ai", "expansion_wait"):
+                expansion = await expansion_task
+            extra_queries = [q for q in dict.fromkeys(expansion) if q != query]
+            if extra_queries:
+                extra_results, _ = await ahybrid_search(extra_queries)
+                results_by_query.update(extra_results)
+                search_queries = extra_queries + [query]
 
-        # Sort by score and take top K
-        # We do NOT sort and slice globally anymore to prevent one topic dominating the results.
-        # We keep all unique matches from all sub-queries.
-        final_matches = all_matches
-        
-        context_text = ""
-        sources = []
-        for match in final_matches:
-            if match.metadata and "text" in match.metadata:
-                context_text += match.metadata["text"] + "\n\n"
-                sources.append(match.metadata.get("source", "unknown"))
-        
-        if not context_text:
-            context_text = "No relevant context found in the knowledge base."
+    with stage("ask_ai", "hydrate"):
+        results_by_query = await asyncio.to_thread(hydrate_results, results_by_query)
+
+    # Token counting and pairwise dedup are CPU-bound; keep them off the event loop
+    with stage("ask_ai", "pack_context"):
+        packed = await asyncio.to_thread(pack_context, results_by_query, search_queries)
+    record_packed(packed)
+    print(f"Context packed: {len(packed['chunks'])} chunks, {packed['tokens_used']} tokens, ~{packed['tokens_saved']} tokens saved")
+
+    return {"search_queries": search_queries, "packed": packed}
+
+async def aquery_ai(query: str):
+    """
+    Async version of query_ai: embedding, search and LLM calls are awaited, so
+    one ASGI worker can hold many requests in flight.
+    """
+    try:
+        with stage("ask_ai", "sql_router"):
+            structured = await sync_to_async(answer_structured)(query)
+        if structured:
+            return structured
+
+        if not pc:
+            raise ValueError("Pinecone not initialized")
+
+        with stage("ask_ai", "answer_cache"):
+            question_embedding, cached, generation = await alookup_cached_answer(query)
+        if cached:
+            return {
+                "answer": cached["answer"],
+                "sources": cached["sources"],
+                "cached": True
+            }
+
+        packed = (await aretrieve_context(query))["packed"]
+        with stage("ask_ai", "llm_answer"):
+            response = await llm_gateway.ainvoke(build_answer_messages(query, packed["context_text"]))
+        metrics.record_llm_usage("ask_ai", response)
+
+        if question_embedding is not None and packed["chunks"]:
+            with stage("ask_ai", "answer_cache_store"):
+                await asyncio.to_thread(store_answer, query, question_embedding, response.content, packed["sources"], generation)
 
-        # 3. Construct Prompt for Final Answer
-        system_prompt = SYSTEM_PROMPT
-        
-        user_prompt = f"""
-        【参考资料】：
-        {context_text}
-        
-        用户问题：{query}
-        """
-        
-        messages = [
-            SystemMessage(content=system_prompt),
-            HumanMessage(content=user_prompt)
-        ]
-        
-        # 4. Invoke LLM
-        response = llm.invoke(messages)
-        
         return {
             "answer": response.content,
-            "sources": list(set(sources))
+            "sources": packed["sources"],
+            "context_tokens": packed["tokens_used"],
+            "tokens_saved": packed["tokens_saved"]
         }
     except Exception as e:
         print(f"AI Query Error: {e}")
         raise e
+
+async def astream_query_ai(query: str):
+    """
+    Streaming variant of aquery_ai. Yields (event, data) tuples:
+    "retrieval" once the context is ready, "sources", one "token" per answer
+    chunk as the model produces it, and finally "done".
+    """
+    with stage("ask_ai", "sql_router"):
+        structured = await sync_to_async(answer_structured)(query)
+    if structured:
+        yield "retrieval", {"route": "sql"}
+        yield "sources", structured["sources"]
+        yield "token", structured["answer"]
+        yield "done", {"cached": False, "route": "sql"}
+        return
+
+    if not pc:
+        raise ValueError("Pinecone not initialized")
+
+    with stage("ask_ai", "answer_cache"):
+        question_embedding, cached, generation = await alookup_cached_answer(query)
+    if cached:
+        yield "retrieval", {"cached": True}
+        yield "sources", cached["sources"]
+        yield "token", cached["answer"]
+        yield "done", {"cached": True}
+        return
+
+    retrieval = await aretrieve_context(query)
+    packed = retrieval["packed"]
+    yield "retrieval", {
+        "search_queries": retrieval["search_queries"],
+        "chunks": len(packed["chunks"]),
+        "context_tokens": packed["tokens_used"],
+        "tokens_saved": packed["tokens_saved"]
+    }
+    yield "sources", packed["sources"]
+
+    answer_parts = []
+    started = time.perf_counter()
+    with stage("ask_ai", "llm_answer"):
+        async for chunk in llm_gateway.astream(build_answer_messages(query, packed["context_text"])):
+            if chunk.content:
+                if not answer_parts:
+                    metrics.observe_stage("ask_ai", "llm_first_token", time.perf_counter() - started)
+                answer_parts.append(chunk.content)
+                yield "token", chunk.content
+    metrics.record_tokens("ask_ai", "completion", count_tokens("".join(answer_parts)))
+
+    # Only cache complete answers that were grounded in retrieved context
+    if question_embedding is not None and packed["chunks"]:
+        await asyncio.to_thread(store_answer, query, question_embedding, "".join(answer_parts), packed["sources"], generation)
+    yield "done", {"cached": False}
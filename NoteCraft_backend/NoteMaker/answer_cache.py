@@ -0,0 +1,226 @@
+"""
+Semantic answer cache for /ask_ai/.
+
+Answers are stored together with the embedding of the question that produced
+them. A new question is answered from the cache when its cosine similarity to
+a stored question reaches ANSWER_CACHE_THRESHOLD.
+
+Entries are partitioned by the knowledge index generation. Every re-upsert of
+the index (upsert scripts, PDF ingestion) calls bump_index_generation(), which
+makes all earlier entries unreachable; they then expire through their TTL.
+An answer is stored under the generation read before its retrieval ran, and
+dropped if the index changed while it was being generated.
+
+Entries live in Redis when REDIS_URL is set, mirrored into process memory so a
+lookup only transfers the entries added since the last lookup. Without Redis
+the cache and the generation counter are per process.
+
+This module does not import Django so the offline scripts can bump the
+generation counter.
+"""
+import json
+import os
+import threading
+import uuid
+
+import numpy as np
+
+from .embedding_cache import get_redis, mark_redis_failed
+
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "True") == "True"
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95"))
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "1000"))
+ANSWER_CACHE_TTL_SECONDS = int(os.getenv("ANSWER_CACHE_TTL_SECONDS", str(24 * 3600)))
+
+GENERATION_KEY = "notecraft:index_generation"
+
+_local_generation = 0
+_lock = threading.Lock()
+
+
+def get_index_generation() -> int:
+    client = get_redis()
+    if client is not None:
+        try:
+            value = client.get(GENERATION_KEY)
+            return int(value) if value is not None else 0
+        except Exception as e:
+            mark_redis_failed(e)
+    return _local_generation
+
+
+def bump_index_generation() -> int:
+    """
+    Invalidates all cached answers. Call after any upsert into the knowledge index.
+    """
+    global _local_generation
+    with _lock:
+        _local_generation += 1
+    client = get_redis()
+    if client is not None:
+        try:
+            return int(client.incr(GENERATION_KEY))
+        except Exception as e:
+            mark_redis_failed(e)
+    return _local_generation
+
+
+def _keys(generation: int):
+    prefix = f"notecraft:answer_cache:{generation}"
+    return f"{prefix}:order", f"{prefix}:vectors", f"{prefix}:entries", f"{prefix}:pushed"
+
+
+# Returns {pushed, id...}: the total number of entries ever pushed to the order
+# list followed by the ids pushed after the first ARGV[1] of them, newest first.
+# Reads both atomically so an entry pushed in between is neither lost nor
+# fetched twice.
+_NEW_IDS_SCRIPT = """
+local pushed = tonumber(redis.call('GET', KEYS[2]) or '0')
+local count = math.min(pushed - tonumber(ARGV[1]), tonumber(ARGV[2]))
+local result = {pushed}
+if count > 0 then
+    for _, id in ipairs(redis.call('LRANGE', KEYS[1], 0, count - 1)) do
+        table.insert(result, id)
+    end
+end
+return result
+"""
+
+
+def _unit(vector) -> np.ndarray:
+    v = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(v)
+    return v / norm if norm else v
+
+
+class _Mirror:
+    """In-process copy of the entries of one generation."""
+
+    def __init__(self, generation: int):
+        self.generation = generation
+        self.ids = []
+        self.entries = {}
+        self.known = set()
+        self.matrix = None
+        self.synced = 0  # number of remote pushes already pulled
+
+    def add(self, entry_id: str, vector: np.ndarray, entry: dict):
+        self.known.add(entry_id)
+        self.ids.append(entry_id)
+        self.entries[entry_id] = entry
+        row = vector.reshape(1, -1)
+        self.matrix = row if self.matrix is None else np.vstack([self.matrix, row])
+        if len(self.ids) > ANSWER_CACHE_MAX_ENTRIES:
+            del self.entries[self.ids.pop(0)]
+            self.matrix = self.matrix[1:]
+
+    def sync(self, client, generation: int):
+        """Pulls entries added by other processes since the last sync."""
+        order_key, vectors_key, entries_key, pushed_key = _keys(generation)
+        result = client.eval(_NEW_IDS_SCRIPT, 2, order_key, pushed_key, self.synced, ANSWER_CACHE_MAX_ENTRIES)
+        pushed = int(result[0])
+        if pushed < self.synced:
+            # The counter expired and restarted; resume from its new value
+            self.synced = pushed
+            return
+        self.synced = pushed
+        remote_ids = [i.decode() for i in result[1:]]
+        remote_ids.reverse()  # LPUSH order -> oldest first
+        new_ids = [i for i in remote_ids if i not in self.known]
+        if not new_ids:
+            return
+        vectors = client.hmget(vectors_key, new_ids)
+        entries = client.hmget(entries_key, new_ids)
+        for entry_id, packed, raw in zip(new_ids, vectors, entries):
+            if packed is None or raw is None:
+                continue
+            self.add(entry_id, np.frombuffer(packed, dtype=np.float32), json.loads(raw))
+
+    def best_match(self, vector: np.ndarray):
+        if self.matrix is None or self.matrix.shape[1] != vector.shape[0]:
+            return None, 0.0
+        scores = self.matrix @ vector
+        best = int(np.argmax(scores))
+        return self.entries[self.ids[best]], float(scores[best])
+
+
+_mirror = _Mirror(generation=-1)
+
+
+def _current_mirror(generation: int) -> _Mirror:
+    global _mirror
+    if _mirror.generation != generation:
+        _mirror = _Mirror(generation)
+    return _mirror
+
+
+def lookup_answer(question_vector, generation: int = None):
+    """
+    Returns the cached {"question", "answer", "sources", "similarity"} of the
+    most similar stored question, or None if nothing reaches the threshold.
+    generation defaults to the current index generation.
+    """
+    if not ANSWER_CACHE_ENABLED:
+        return None
+    vector = _unit(question_vector)
+    if generation is None:
+        generation = get_index_generation()
+    with _lock:
+        mirror = _current_mirror(generation)
+        client = get_redis()
+        if client is not None:
+            try:
+                mirror.sync(client, generation)
+            except Exception as e:
+                mark_redis_failed(e)
+        entry, similarity = mirror.best_match(vector)
+    if entry is None or similarity < ANSWER_CACHE_THRESHOLD:
+        return None
+    return {**entry, "similarity": similarity}
+
+
+def store_answer(question: str, question_vector, answer: str, sources: list, generation: int = None):
+    """
+    Caches an answer. generation is the index generation read before the
+    answer's context was retrieved; if the index has been re-upserted since,
+    the answer may be stale and is not stored.
+    """
+    if not ANSWER_CACHE_ENABLED:
+        return
+    current = get_index_generation()
+    if generation is not None and generation != current:
+        print(f"Answer cache: index changed during the request (generation {generation} -> {current}), not storing")
+        return
+    generation = current
+    vector = _unit(question_vector)
+    entry = {"question": question, "answer": answer, "sources": sources}
+    entry_id = uuid.uuid4().hex
+    with _lock:
+        _current_mirror(generation).add(entry_id, vector, entry)
+
+    client = get_redis()
+    if client is None:
+        return
+    order_key, vectors_key, entries_key, pushed_key = _keys(generation)
+    try:
+        pipe = client.pipeline(transaction=True)
+        pipe.hset(vectors_key, entry_id, vector.tobytes())
+        pipe.hset(entries_key, entry_id, json.dumps(entry, ensure_ascii=False))
+        # The push and its counter change together so readers can fetch only
+        # the head of the list they have not seen yet
+        pipe.lpush(order_key, entry_id)
+        pipe.incr(pushed_key)
+        for key in (order_key, vectors_key, entries_key, pushed_key):
+            pipe.expire(key, ANSWER_CACHE_TTL_SECONDS)
+        pipe.execute()
+
+        # Evict the oldest entries beyond the size limit
+        evicted = client.lrange(order_key, ANSWER_CACHE_MAX_ENTRIES, -1)
+        if evicted:
+            pipe = client.pipeline(transaction=False)
+            pipe.ltrim(order_key, 0, ANSWER_CACHE_MAX_ENTRIES - 1)
+            pipe.hdel(vectors_key, *evicted)
+            pipe.hdel(entries_key, *evicted)
+            pipe.execute()
+    except Exception as e:
+        mark_redis_failed(e)
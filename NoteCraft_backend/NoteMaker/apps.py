@@ -4,3 +4,9 @@ from django.apps import AppConfig
 class NotemakerConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'NoteMaker'
+
+    def ready(self):
+        # Runs in the web workers and in the Celery worker
+        from .tracing import instrument_celery, setup_tracing
+        setup_tracing()
+        instrument_celery()
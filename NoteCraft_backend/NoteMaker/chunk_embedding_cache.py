@@ -0,0 +1,178 @@
+"""
+Content-addressed cache for passage (chunk) embeddings.
+
+Re-uploading a patched PDF or re-running the offline pipeline re-embeds every
+chunk although most of the text is unchanged. embed_passages() looks each
+chunk up by sha256(model, input_type, normalized text) in a local SQLite file
+of float32 blobs and only sends the misses to Pinecone inference.
+
+The file is shared by the web process, the Celery worker and the offline
+EmbedItemsScript; entries never expire since a text's embedding under a
+given model does not change. Query embeddings have their own cache
+(embedding_cache.py).
+
+Each run passes a CacheRunStats to collect its hit rate and the bytes of
+chunk text that did not have to be sent; process-wide totals are exported on
+/metrics/ via chunk_cache_stats().
+
+This module does not import Django.
+"""
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+from .embedding_cache import EMBED_MODEL, normalize_text, pack_vector, unpack_vector
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+CHUNK_EMBED_CACHE_ENABLED = os.getenv("CHUNK_EMBED_CACHE_ENABLED", "True") == "True"
+CHUNK_EMBED_CACHE_PATH = os.getenv("CHUNK_EMBED_CACHE_PATH", str(BACKEND_DIR / "chunk_embeddings.sqlite3"))
+
+# Pinecone inference accepts at most 96 passages per embed call
+MAX_EMBED_BATCH = 96
+# Stay below SQLite's default limit on bound parameters
+_MAX_VARIABLES = 900
+
+_local = threading.local()
+
+
+def _connect() -> sqlite3.Connection:
+    """One connection per thread; WAL lets readers run while a writer commits."""
+    conn = getattr(_local, "conn", None)
+    if conn is None or getattr(_local, "path", None) != CHUNK_EMBED_CACHE_PATH:
+        conn = sqlite3.connect(CHUNK_EMBED_CACHE_PATH, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS chunk_embeddings (
+                key TEXT PRIMARY KEY,
+                model TEXT NOT NULL,
+                input_type TEXT NOT NULL,
+                dims INTEGER NOT NULL,
+                vector BLOB NOT NULL,
+                created_at REAL NOT NULL
+            )
+        """)
+        _local.conn = conn
+        _local.path = CHUNK_EMBED_CACHE_PATH
+    return conn
+
+
+def chunk_key(text: str, model: str = EMBED_MODEL, input_type: str = "passage") -> str:
+    payload = f"{model}\0{input_type}\0{normalize_text(text)}"
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class CacheRunStats:
+    """Hits, misses and bytes saved during one ingestion or script run."""
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self._lock = threading.Lock()
+
+    def add(self, hits: int, misses: int, bytes_saved: int):
+        with self._lock:
+            self.hits += hits
+            self.misses += misses
+            self.bytes_saved += bytes_saved
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def as_dict(self) -> dict:
+        return {
+            "embed_cache_hits": self.hits,
+            "embed_cache_misses": self.misses,
+            "embed_cache_hit_rate": round(self.hit_rate, 4),
+            "embed_cache_bytes_saved": self.bytes_saved,
+        }
+
+    def summary(self) -> str:
+        return (f"chunk embedding cache: {self.hits} hits, {self.misses} misses "
+                f"({self.hit_rate:.1%} hit rate), {self.bytes_saved / 1024:.1f} KiB of text not re-embedded")
+
+
+# Process-wide totals for /metrics/
+_totals = CacheRunStats()
+
+
+def chunk_cache_stats() -> dict:
+    return _totals.as_dict()
+
+
+def _lookup(keys: list) -> dict:
+    found = {}
+    conn = _connect()
+    for i in range(0, len(keys), _MAX_VARIABLES):
+        part = keys[i:i + _MAX_VARIABLES]
+        placeholders = ",".join("?" * len(part))
+        rows = conn.execute(f"SELECT key, vector FROM chunk_embeddings WHERE key IN ({placeholders})", part)
+        found.update({key: unpack_vector(blob) for key, blob in rows})
+    return found
+
+
+def _store(entries: list, model: str, input_type: str):
+    now = time.time()
+    conn = _connect()
+    with conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO chunk_embeddings (key, model, input_type, dims, vector, created_at) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            [(key, model, input_type, len(vector), pack_vector(vector), now) for key, vector in entries]
+        )
+
+
+def embed_passages(pc, texts: list, model: str = EMBED_MODEL, input_type: str = "passage",
+                   stats: CacheRunStats = None) -> list:
+    """
+    Embedding vectors for texts, in order. Cached vectors are reused; the
+    rest are embedded with pc.inference.embed (at most 96 per call) and
+    stored. A cache read or write error only costs the cache, never the run.
+    """
+    if not CHUNK_EMBED_CACHE_ENABLED:
+        return _embed(pc, texts, model, input_type)
+
+    keys = [chunk_key(text, model, input_type) for text in texts]
+    try:
+        cached = _lookup(list(set(keys)))
+    except sqlite3.Error as e:
+        print(f"Warning: chunk embedding cache read failed: {e}")
+        cached = {}
+
+    # Identical chunks within the batch are embedded once
+    missing = {}
+    for key, text in zip(keys, texts):
+        if key not in cached and key not in missing:
+            missing[key] = text
+    if missing:
+        vectors = _embed(pc, list(missing.values()), model, input_type)
+        fresh = list(zip(missing.keys(), vectors))
+        cached.update(fresh)
+        try:
+            _store(fresh, model, input_type)
+        except sqlite3.Error as e:
+            print(f"Warning: chunk embedding cache write failed: {e}")
+
+    hits = len(texts) - len(missing)
+    bytes_saved = sum(len(text.encode("utf-8")) for text in texts) - sum(len(t.encode("utf-8")) for t in missing.values())
+    for run in (stats, _totals):
+        if run is not None:
+            run.add(hits, len(missing), bytes_saved)
+    return [cached[key] for key in keys]
+
+
+def _embed(pc, texts: list, model: str, input_type: str) -> list:
+    vectors = []
+    for i in range(0, len(texts), MAX_EMBED_BATCH):
+        response = pc.inference.embed(
+            model=model,
+            inputs=texts[i:i + MAX_EMBED_BATCH],
+            parameters={"input_type": input_type}
+        )
+        vectors.extend(list(item["values"]) for item in response)
+    return vectors
@@ -0,0 +1,184 @@
+"""
+Token-budgeted context packing for the RAG prompt.
+
+Instead of concatenating every match of every sub-query, chunks are selected by
+maximal marginal relevance (MMR) until CONTEXT_TOKEN_BUDGET is reached:
+
+- Relevance is the match score normalized by the best score of its own
+  sub-query, so every entity in the question competes on equal terms.
+- Redundancy is the character-trigram Jaccard similarity to the chunks already
+  selected; near-duplicates above CONTEXT_DEDUP_THRESHOLD are dropped outright.
+- The best chunk of every sub-query is taken first so each entity keeps
+  coverage.
+
+The per-sub-query result lists are already sorted by score, so candidates are
+pulled through a heap that holds only the current head of each list (a k-way
+merge) and MMR scores are re-evaluated lazily: a chunk's redundancy can only
+grow as more chunks are selected, so a popped chunk whose refreshed score still
+beats the next heap entry is the true MMR maximum.
+"""
+import heapq
+import os
+import re
+
+try:
+    import tiktoken
+    _encoding = tiktoken.get_encoding("cl100k_base")
+except Exception as e:
+    print(f"Warning: tiktoken unavailable, estimating tokens from characters: {e}")
+    _encoding = None
+
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "6000"))
+CONTEXT_MMR_LAMBDA = float(os.getenv("CONTEXT_MMR_LAMBDA", "0.7"))
+CONTEXT_DEDUP_THRESHOLD = float(os.getenv("CONTEXT_DEDUP_THRESHOLD", "0.8"))
+
+# Stop once less than this many tokens of budget are left
+MIN_CHUNK_TOKENS = 32
+
+_WHITESPACE_RE = re.compile(r"\s+")
+
+
+def count_tokens(text: str) -> int:
+    if _encoding is None:
+        # Rough average for mixed Chinese/English text
+        return max(1, len(text) * 2 // 3)
+    return len(_encoding.encode(text, disallowed_special=()))
+
+
+def _shingles(text: str, n: int = 3) -> frozenset:
+    text = _WHITESPACE_RE.sub("", text)
+    if len(text) <= n:
+        return frozenset([text])
+    return frozenset(text[i:i + n] for i in range(len(text) - n + 1))
+
+
+def _jaccard(a: frozenset, b: frozenset) -> float:
+    if not a or not b:
+        return 0.0
+    intersection = len(a & b)
+    return intersection / (len(a) + len(b) - intersection)
+
+
+def _match_text(match: dict) -> str:
+    return (match.get("metadata") or {}).get("text", "")
+
+
+def pack_context(results_by_query: dict, queries: list, budget: int = CONTEXT_TOKEN_BUDGET,
+                 mmr_lambda: float = CONTEXT_MMR_LAMBDA) -> dict:
+    """
+    Selects chunks from the per-sub-query result lists (each sorted by score,
+    matches as {"id", "score", "metadata"} dicts) within the token budget.
+
+    Returns {"chunks", "context_text", "sources", "tokens_used", "tokens_saved"}.
+    tokens_saved is estimated from the characters of the unique candidates that
+    were left out, using the token/char ratio of the selected chunks.
+    """
+    lists = [results_by_query.get(q) or [] for q in queries]
+    top_scores = [lst[0]["score"] if lst and lst[0]["score"] > 0 else 1.0 for lst in lists]
+
+    selected = []
+    selected_shingles = []
+    seen_ids = set()
+    tokens_used = 0
+    selected_chars = 0
+    candidate_chars = 0
+
+    def relevance(list_idx, pos):
+        return lists[list_idx][pos]["score"] / top_scores[list_idx]
+
+    def try_select(match, shingles, redundancy):
+        nonlocal tokens_used, selected_chars
+        if redundancy >= CONTEXT_DEDUP_THRESHOLD:
+            return
+        text = _match_text(match)
+        tokens = count_tokens(text)
+        if tokens_used + tokens > budget:
+            return
+        selected.append(match)
+        selected_shingles.append(shingles)
+        tokens_used += tokens
+        selected_chars += len(text)
+
+    def redundancy_of(shingles):
+        return max((_jaccard(shingles, s) for s in selected_shingles), default=0.0)
+
+    def take_candidate(list_idx, pos):
+        """Returns (match, shingles) if the match is new and has text, else None."""
+        nonlocal candidate_chars
+        match = lists[list_idx][pos]
+        if match["id"] in seen_ids:
+            return None
+        seen_ids.add(match["id"])
+        text = _match_text(match)
+        if not text:
+            return None
+        candidate_chars += len(text)
+        return match, _shingles(text)
+
+    # Coverage pass: the best chunk of every sub-query
+    next_pos = [0] * len(lists)
+    for list_idx, lst in enumerate(lists):
+        while next_pos[list_idx] < len(lst):
+            candidate = take_candidate(list_idx, next_pos[list_idx])
+            next_pos[list_idx] += 1
+            if candidate:
+                match, shingles = candidate
+                try_select(match, shingles, redundancy_of(shingles))
+                break
+
+    # Lazy MMR over a heap of list heads
+    heap = []
+    cache = {}  # (list_idx, pos) -> (match, shingles) for entries re-pushed with a refreshed score
+
+    def push_head(list_idx):
+        pos = next_pos[list_idx]
+        if pos < len(lists[list_idx]):
+            next_pos[list_idx] += 1
+            # Upper bound: redundancy can only make the score smaller
+            heapq.heappush(heap, (-mmr_lambda * relevance(list_idx, pos), list_idx, pos))
+
+    for list_idx in range(len(lists)):
+        push_head(list_idx)
+
+    while heap and budget - tokens_used >= MIN_CHUNK_TOKENS:
+        _, list_idx, pos = heapq.heappop(heap)
+        if next_pos[list_idx] == pos + 1:
+            # This entry was the list head; its successor now becomes a candidate
+            push_head(list_idx)
+
+        candidate = cache.pop((list_idx, pos), None) or take_candidate(list_idx, pos)
+        if candidate is None:
+            continue
+        match, shingles = candidate
+        redundancy = redundancy_of(shingles)
+        score = mmr_lambda * relevance(list_idx, pos) - (1 - mmr_lambda) * redundancy
+
+        if heap and score < -heap[0][0]:
+            # Stale bound: re-queue with the refreshed score
+            cache[(list_idx, pos)] = candidate
+            heapq.heappush(heap, (-score, list_idx, pos))
+            continue
+        try_select(match, shingles, redundancy)
+
+    # Estimate what the old "concatenate everything" prompt would have cost
+    for lst in lists:
+        for match in lst:
+            if match["id"] not in seen_ids:
+                seen_ids.add(match["id"])
+                candidate_chars += len(_match_text(match))
+    ratio = tokens_used / selected_chars if selected_chars else 2 / 3
+    tokens_saved = int((candidate_chars - selected_chars) * ratio)
+
+    sources = []
+    for match in selected:
+        source = (match.get("metadata") or {}).get("source", "unknown")
+        if source not in sources:
+            sources.append(source)
+
+    return {
+        "chunks": selected,
+        "context_text": "\n\n".join(_match_text(m) for m in selected),
+        "sources": sources,
+        "tokens_used": tokens_used,
+        "tokens_saved": tokens_saved,
+    }
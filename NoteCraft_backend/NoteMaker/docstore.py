@@ -0,0 +1,135 @@
+"""
+Chunk text store keyed by vector id.
+
+The vector store only holds vectors and small filterable metadata; the chunk
+text, source, page and category live here. Searches return ids and scores,
+and hydrate() fills in the text of the chunks that survived ranking with one
+bulk read, instead of shipping every candidate's text with each query.
+
+The store is a SQLite file shared by the web process, the Celery worker and
+the offline upsert script. This module does not import Django.
+"""
+import os
+import sqlite3
+import threading
+from pathlib import Path
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+DOCSTORE_PATH = os.getenv("DOCSTORE_PATH", str(BACKEND_DIR / "docstore.sqlite3"))
+
+# Fields moved out of the vector metadata into the docstore
+DOCUMENT_FIELDS = ("text", "source", "page", "category")
+
+# Stay below SQLite's default limit on bound parameters
+_MAX_VARIABLES = 900
+
+_local = threading.local()
+
+
+def _connect() -> sqlite3.Connection:
+    """One connection per thread; WAL lets readers run while a writer commits."""
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(DOCSTORE_PATH, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS documents (
+                id TEXT PRIMARY KEY,
+                namespace TEXT NOT NULL DEFAULT '',
+                text TEXT NOT NULL,
+                source TEXT,
+                page INTEGER,
+                category TEXT
+            )
+        """)
+        _local.conn = conn
+    return conn
+
+
+def split_metadata(metadata: dict) -> tuple:
+    """
+    Splits chunk metadata into (document, vector_metadata): the docstore fields
+    and what stays on the vector for filtering.
+    """
+    document = {field: metadata.get(field) for field in DOCUMENT_FIELDS}
+    if document["category"] is None:
+        document["category"] = metadata.get("type")
+    vector_metadata = {k: v for k, v in metadata.items() if k != "text"}
+    return document, vector_metadata
+
+
+def put_documents(documents: list, namespace: str = ""):
+    """Stores (or replaces) chunks given as {"id", "text", "source", "page", "category"} dicts."""
+    rows = [
+        (d["id"], namespace, d.get("text") or "", d.get("source"), d.get("page"), d.get("category"))
+        for d in documents
+    ]
+    if not rows:
+        return
+    conn = _connect()
+    with conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO documents (id, namespace, text, source, page, category) VALUES (?, ?, ?, ?, ?, ?)",
+            rows
+        )
+
+
+def get_documents(ids: list) -> dict:
+    """Returns {id: {"text", "source", "page", "category"}} for the ids that are stored."""
+    ids = list(dict.fromkeys(ids))
+    conn = _connect()
+    documents = {}
+    for i in range(0, len(ids), _MAX_VARIABLES):
+        batch = ids[i:i + _MAX_VARIABLES]
+        for row in conn.execute(
+            f"SELECT id, text, source, page, category FROM documents WHERE id IN ({','.join('?' * len(batch))})",
+            batch
+        ):
+            documents[row[0]] = dict(zip(DOCUMENT_FIELDS, row[1:]))
+    return documents
+
+
+def ids_with_prefix(prefix: str, namespace: str = "") -> list:
+    """Ids in namespace that start with prefix, e.g. the "<doc_id>_<n>" chunks of a document."""
+    escaped = prefix.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    rows = _connect().execute(
+        "SELECT id FROM documents WHERE namespace = ? AND id LIKE ? ESCAPE '\\'",
+        (namespace, escaped + "%")
+    )
+    return [row[0] for row in rows]
+
+
+def delete_documents(ids: list):
+    conn = _connect()
+    with conn:
+        conn.executemany("DELETE FROM documents WHERE id = ?", [(i,) for i in ids])
+
+
+def hydrate(matches: list, store=None, namespace: str = "") -> list:
+    """
+    Fills in the docstore fields of {"id", "score", "metadata"} matches in one
+    bulk read. Ids written before the docstore existed are fetched from the
+    vector store's metadata instead, when a store is given; a match's own
+    "namespace" key overrides the namespace argument for that fetch.
+    """
+    documents = get_documents([m["id"] for m in matches])
+    missing = {}
+    for m in matches:
+        if m["id"] not in documents:
+            missing.setdefault(m.get("namespace", namespace), []).append(m["id"])
+    if store is not None:
+        for ns, ids in missing.items():
+            try:
+                for vid, vector in store.fetch(list(dict.fromkeys(ids)), namespace=ns).items():
+                    documents[vid] = vector["metadata"]
+            except Exception as e:
+                print(f"Docstore fallback fetch failed: {e}")
+
+    hydrated = []
+    for match in matches:
+        document = documents.get(match["id"])
+        if document is None:
+            continue
+        metadata = {**(match.get("metadata") or {}), **{k: v for k, v in document.items() if v is not None}}
+        hydrated.append({**match, "metadata": metadata})
+    return hydrated
@@ -0,0 +1,303 @@
+"""
+Two-tier cache for query embeddings.
+
+Tier 1 is a bounded in-process LRU, tier 2 is the shared Redis instance
+(REDIS_URL). Vectors are stored as packed float32 bytes. Keys are built from
+the model, the input type and the normalized text, so "5费卡" and " 5费卡 "
+share one entry.
+
+This module does not import Django so the offline scripts can use it too.
+"""
+import asyncio
+import hashlib
+import os
+import re
+import threading
+import time
+import unicodedata
+from array import array
+from collections import OrderedDict
+
+from . import tracing
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+EMBED_MODEL = "llama-text-embed-v2"
+
+EMBED_CACHE_MAX_ENTRIES = int(os.getenv("EMBED_CACHE_MAX_ENTRIES", "2048"))
+EMBED_CACHE_TTL_SECONDS = int(os.getenv("EMBED_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+# After a Redis error, skip the Redis tier for this many seconds
+REDIS_RETRY_AFTER_SECONDS = 30
+
+_WHITESPACE_RE = re.compile(r"\s+")
+
+
+def normalize_text(text: str) -> str:
+    """NFKC-normalize, casefold and collapse whitespace."""
+    text = unicodedata.normalize("NFKC", text)
+    return _WHITESPACE_RE.sub(" ", text).strip().casefold()
+
+
+def cache_key(text: str, model: str = EMBED_MODEL, input_type: str = "query") -> str:
+    digest = hashlib.sha1(normalize_text(text).encode("utf-8")).hexdigest()
+    return f"embed:{model}:{input_type}:{digest}"
+
+
+def pack_vector(values) -> bytes:
+    return array("f", values).tobytes()
+
+
+def unpack_vector(data: bytes) -> list:
+    vector = array("f")
+    vector.frombytes(data)
+    return vector.tolist()
+
+
+class LRUCache:
+    """Thread-safe bounded LRU mapping keys to packed vectors."""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def __len__(self):
+        return len(self._data)
+
+
+_lru = LRUCache(EMBED_CACHE_MAX_ENTRIES)
+
+_stats = {"lru_hits": 0, "redis_hits": 0, "misses": 0}
+_stats_lock = threading.Lock()
+
+_redis_client = None
+_redis_disabled_until = 0.0
+
+
+def _count(name: str, amount: int = 1):
+    if amount:
+        with _stats_lock:
+            _stats[name] += amount
+
+
+def get_redis():
+    """
+    Returns the shared Redis client, or None when Redis is not configured or
+    recently failed.
+    """
+    global _redis_client
+    if redis is None or time.monotonic() < _redis_disabled_until:
+        return None
+    if _redis_client is None:
+        redis_url = os.getenv("REDIS_URL")
+        if not redis_url:
+            return None
+        _redis_client = redis.Redis.from_url(redis_url, socket_timeout=0.5, socket_connect_timeout=0.5)
+    return _redis_client
+
+
+def mark_redis_failed(e: Exception):
+    global _redis_disabled_until
+    print(f"Redis unavailable, using in-process caches only for {REDIS_RETRY_AFTER_SECONDS}s: {e}")
+    _redis_disabled_until = time.monotonic() + REDIS_RETRY_AFTER_SECONDS
+
+
+def _embed_uncached(pc, texts: list, model: str, input_type: str) -> list:
+    """
+    Embeds texts with one batched call, falling back to one call per text.
+    Returns a list aligned with texts; failed entries are None.
+    """
+    try:
+        response = pc.inference.embed(
+            model=model,
+            inputs=texts,
+            parameters={"input_type": input_type}
+        )
+        # Results come back in input order
+        return [embedding_data['values'] for embedding_data in response]
+    except Exception as e:
+        print(f"Batch embedding failed, falling back to per-text: {e}")
+
+    vectors = []
+    for text in texts:
+        try:
+            vectors.append(pc.inference.embed(
+                model=model,
+                inputs=[text],
+                parameters={"input_type": input_type}
+            )[0]['values'])
+        except Exception as e:
+            print(f"Error embedding '{text}': {e}")
+            vectors.append(None)
+    return vectors
+
+
+async def _aembed_uncached(apc, texts: list, model: str, input_type: str) -> list:
+    """Async version of _embed_uncached for a PineconeAsyncio client."""
+    try:
+        response = await apc.inference.embed(
+            model=model,
+            inputs=texts,
+            parameters={"input_type": input_type}
+        )
+        return [embedding_data['values'] for embedding_data in response]
+    except Exception as e:
+        print(f"Batch embedding failed, falling back to per-text: {e}")
+
+    vectors = []
+    for text in texts:
+        try:
+            response = await apc.inference.embed(
+                model=model,
+                inputs=[text],
+                parameters={"input_type": input_type}
+            )
+            vectors.append(response[0]['values'])
+        except Exception as e:
+            print(f"Error embedding '{text}': {e}")
+            vectors.append(None)
+    return vectors
+
+
+def _lookup(keys: list):
+    """
+    Reads keys from the LRU, then Redis.
+    Returns (vectors, missing) where missing holds the indexes still to embed.
+    """
+    vectors = [None] * len(keys)
+
+    # Tier 1: in-process LRU
+    missing = []
+    for i, key in enumerate(keys):
+        packed = _lru.get(key)
+        if packed is not None:
+            vectors[i] = unpack_vector(packed)
+        else:
+            missing.append(i)
+    _count("lru_hits", len(keys) - len(missing))
+
+    # Tier 2: Redis
+    client = get_redis() if missing else None
+    if client is not None:
+        try:
+            packed_values = client.mget([keys[i] for i in missing])
+            still_missing = []
+            for i, packed in zip(missing, packed_values):
+                if packed is not None:
+                    _lru.set(keys[i], packed)
+                    vectors[i] = unpack_vector(packed)
+                else:
+                    still_missing.append(i)
+            _count("redis_hits", len(missing) - len(still_missing))
+            missing = still_missing
+        except Exception as e:
+            mark_redis_failed(e)
+
+    return vectors, missing
+
+
+def _unique_missing(keys: list, missing: list) -> list:
+    """Indexes to embed; identical keys are only embedded once."""
+    unique = list(OrderedDict((keys[i], i) for i in missing).values())
+    _count("misses", len(unique))
+    return unique
+
+
+def _store(keys: list, vectors: list, missing: list, unique: list, embedded: list):
+    """Writes freshly embedded vectors to both tiers and fills them into vectors."""
+    to_store = {}
+    for i, values in zip(unique, embedded):
+        if values is None:
+            continue
+        packed = pack_vector(values)
+        _lru.set(keys[i], packed)
+        to_store[keys[i]] = packed
+    for i in missing:
+        packed = to_store.get(keys[i])
+        if packed is not None:
+            vectors[i] = unpack_vector(packed)
+
+    client = get_redis() if to_store else None
+    if client is not None:
+        try:
+            pipe = client.pipeline(transaction=False)
+            for key, packed in to_store.items():
+                pipe.set(key, packed, ex=EMBED_CACHE_TTL_SECONDS)
+            pipe.execute()
+        except Exception as e:
+            mark_redis_failed(e)
+
+
+def _embed_span(texts: list, model: str, input_type: str):
+    return tracing.client_span("embed", {
+        "gen_ai.operation.name": "embeddings",
+        "gen_ai.request.model": model,
+        "embed.input_type": input_type,
+        "embed.batch_size": len(texts),
+        "embed.cache_misses": 0,
+    })
+
+
+def get_embeddings(pc, texts: list, model: str = EMBED_MODEL, input_type: str = "query") -> list:
+    """
+    Returns embeddings for texts, aligned with the input list (None where
+    embedding failed). Cached vectors come from the LRU, then Redis; all
+    remaining texts are embedded in a single batched call and written back to
+    both tiers.
+    """
+    with _embed_span(texts, model, input_type):
+        keys = [cache_key(t, model, input_type) for t in texts]
+        vectors, missing = _lookup(keys)
+        if not missing:
+            return vectors
+
+        unique = _unique_missing(keys, missing)
+        tracing.set_attributes({"embed.cache_misses": len(unique)})
+        embedded = _embed_uncached(pc, [texts[i] for i in unique], model, input_type)
+        _store(keys, vectors, missing, unique, embedded)
+        return vectors
+
+
+async def aget_embeddings(apc, texts: list, model: str = EMBED_MODEL, input_type: str = "query") -> list:
+    """
+    Async version of get_embeddings for a PineconeAsyncio client. The blocking
+    Redis round trips run in a worker thread.
+    """
+    with _embed_span(texts, model, input_type):
+        keys = [cache_key(t, model, input_type) for t in texts]
+        vectors, missing = await asyncio.to_thread(_lookup, keys)
+        if not missing:
+            return vectors
+
+        unique = _unique_missing(keys, missing)
+        tracing.set_attributes({"embed.cache_misses": len(unique)})
+        embedded = await _aembed_uncached(apc, [texts[i] for i in unique], model, input_type)
+        await asyncio.to_thread(_store, keys, vectors, missing, unique, embedded)
+        return vectors
+
+
+def cache_stats() -> dict:
+    """Hit/miss counters since process start."""
+    with _stats_lock:
+        stats = dict(_stats)
+    lookups = stats["lru_hits"] + stats["redis_hits"] + stats["misses"]
+    stats["lru_size"] = len(_lru)
+    stats["hit_rate"] = round((stats["lru_hits"] + stats["redis_hits"]) / lookups, 4) if lookups else 0.0
+    return stats
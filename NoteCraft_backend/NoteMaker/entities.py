@@ -0,0 +1,142 @@
+"""
+Loads the scraped champion, item, augment and composition records into the
+structured entity tables (see models.py), so list and attribute questions can
+be answered with an indexed SQL query instead of a vector search.
+"""
+import json
+import re
+
+from django.db import transaction
+
+from .glossary import iter_vectors
+from .models import Augment, Champion, Composition, Item, Trait
+
+_NUMBER_RE = re.compile(r"-?\d+(?:\.\d+)?")
+
+
+def parse_number(value):
+    """"4.32" -> 4.32, "52.1%" -> 0.521, "1,234" -> 1234.0; None when not numeric."""
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    if not isinstance(value, str):
+        return None
+    match = _NUMBER_RE.search(value.replace(",", ""))
+    if not match:
+        return None
+    number = float(match.group())
+    return number / 100 if "%" in value else number
+
+
+def parse_int(value):
+    number = parse_number(value)
+    return int(number) if number is not None else None
+
+
+def parse_json(value, default):
+    """Lists and dicts may arrive JSON-encoded (UpsertItemsScript.clean_metadata)."""
+    if isinstance(value, str) and value[:1] in "[{":
+        try:
+            return json.loads(value)
+        except ValueError:
+            return default
+    return value if isinstance(value, type(default)) else default
+
+
+def _load_champion(meta: dict):
+    champion, _ = Champion.objects.update_or_create(
+        name=meta["champion_name"].strip(),
+        defaults={
+            "cost": parse_int(meta.get("cost")),
+            "base_stats": parse_json(meta.get("base_stats"), {}),
+            "avg_rank": parse_number(meta.get("avg_rank")),
+            "top4_rate": parse_number(meta.get("top4_rate")),
+            "win_rate": parse_number(meta.get("win_rate")),
+            "pick_count": parse_int(meta.get("pick_count")),
+            "recommended_items": parse_json(meta.get("recommended_items"), []),
+            "skill_description": meta.get("skill_description") or "",
+        }
+    )
+    traits = [
+        Trait.objects.get_or_create(name=name.strip())[0]
+        for name in parse_json(meta.get("traits"), []) if isinstance(name, str) and name.strip()
+    ]
+    champion.traits.set(traits)
+
+
+def _load_item(meta: dict):
+    Item.objects.update_or_create(
+        name=meta["item_name"].strip(),
+        defaults={
+            "recipe": meta.get("recipe") or "",
+            "avg_rank": parse_number(meta.get("avg_rank")),
+            "top4_rate": parse_number(meta.get("top4_rate")),
+            "win_rate": parse_number(meta.get("win_rate")),
+            "pick_count": parse_int(meta.get("pick_count")),
+            "recommended_champions": parse_json(meta.get("recommended_champions"), []),
+        }
+    )
+
+
+def _load_augment(meta: dict):
+    Augment.objects.update_or_create(
+        name=meta["name"].strip(),
+        defaults={
+            "season": meta.get("season") or "",
+            "level": parse_int(meta.get("augment_level")),
+            "quality": meta.get("quality") or "",
+            "hex_type": meta.get("hex_type") or "",
+            "effect": meta.get("effect") or "",
+        }
+    )
+
+
+def _load_composition(meta: dict, source_id: str):
+    Composition.objects.update_or_create(
+        source_id=source_id,
+        defaults={
+            "name": meta["comp_name"].strip(),
+            "tier": str(meta.get("tier") or ""),
+            "avg_rank": parse_number(meta.get("avg_rank")),
+            "top4_rate": parse_number(meta.get("top4_rate")),
+            "win_rate": parse_number(meta.get("win_rate")),
+            "pick_rate": parse_number(meta.get("pick_rate")),
+            "units": parse_json(meta.get("units"), []),
+            "traits": parse_json(meta.get("traits"), []),
+        }
+    )
+
+
+def load_tft_entities(records=None) -> dict:
+    """
+    Upserts the {"id", "metadata"} records (defaults to every scraped file the
+    glossary reads) into the entity tables. Returns the count per entity type.
+    """
+    if records is None:
+        records = iter_vectors()
+    counts = {"champion": 0, "item": 0, "augment": 0, "composition": 0, "skipped": 0}
+    with transaction.atomic():
+        for record in records:
+            meta = record.get("metadata", {})
+            record_type = str(meta.get("type", "")).lower()
+            try:
+                # Savepoint per record, so one bad record does not abort the load
+                with transaction.atomic():
+                    if record_type == "champion" and meta.get("champion_name"):
+                        _load_champion(meta)
+                    elif record_type == "item" and meta.get("item_name"):
+                        _load_item(meta)
+                    elif record_type == "augment" and meta.get("name"):
+                        _load_augment(meta)
+                    elif record_type == "composition" and meta.get("comp_name"):
+                        _load_composition(meta, record.get("id") or meta["comp_name"])
+                    else:
+                        counts["skipped"] += 1
+                        continue
+            except Exception as e:
+                print(f"Skipping {record_type} record: {e}")
+                counts["skipped"] += 1
+                continue
+            counts[record_type] += 1
+    return counts
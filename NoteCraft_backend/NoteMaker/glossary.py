@@ -0,0 +1,243 @@
+"""
+Local TFT glossary entity extractor.
+
+Builds an Aho–Corasick automaton over the champion, item, augment, trait and
+composition names found in the scraped JSON files (ChampionMessageScript,
+EquipmentMessageScript, HexMessageScript, CompsMessageScript output) plus an
+optional alias file, and turns a question into search queries in a single pass
+over the text. query_ai only falls back to the LLM expansion call when nothing
+is recognized; expansion_stats() reports how often that happens.
+
+This module does not import Django.
+"""
+import json
+import os
+import re
+import threading
+from collections import deque
+from pathlib import Path
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+PROJECT_ROOT = BACKEND_DIR.parent
+
+# Directories scanned for scraped *.json files, separated by os.pathsep.
+# datas/OriginData holds the op.gg scrapes; HexMessageScript writes hex_vectors.json to its working directory.
+TFT_GLOSSARY_DIRS = os.getenv(
+    "TFT_GLOSSARY_DIRS",
+    os.pathsep.join([str(PROJECT_ROOT / "datas" / "OriginData"), str(PROJECT_ROOT / "scripts")])
+)
+# Optional JSON file {"alias": "canonical name"} for nicknames players use
+TFT_ALIASES_FILE = os.getenv("TFT_ALIASES_FILE", str(PROJECT_ROOT / "datas" / "tft_aliases.json"))
+
+# Single characters match far too often inside other words
+MIN_NAME_LENGTH = 2
+
+# "5费卡有哪些" -> the same synonyms EXPANSION_PROMPT asks the LLM for
+_COST_RE = re.compile(r"([1-5])\s*费")
+
+
+class AhoCorasick:
+    """Multi-pattern matcher; finds every occurrence of every pattern in one scan."""
+
+    def __init__(self):
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [[]]
+
+    def add(self, pattern: str, value):
+        node = 0
+        for ch in pattern:
+            nxt = self.goto[node].get(ch)
+            if nxt is None:
+                nxt = len(self.goto)
+                self.goto[node][ch] = nxt
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append([])
+            node = nxt
+        self.output[node].append((len(pattern), value))
+
+    def build(self):
+        # Breadth-first, so fail links always point to already finished nodes
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, nxt in self.goto[node].items():
+                queue.append(nxt)
+                f = self.fail[node]
+                while f and ch not in self.goto[f]:
+                    f = self.fail[f]
+                if node:
+                    self.fail[nxt] = self.goto[f].get(ch, 0)
+                self.output[nxt] = self.output[nxt] + self.output[self.fail[nxt]]
+
+    def iter_matches(self, text: str):
+        """Yields (start, end, value) for every pattern occurrence."""
+        node = 0
+        for i, ch in enumerate(text):
+            while node and ch not in self.goto[node]:
+                node = self.fail[node]
+            node = self.goto[node].get(ch, 0)
+            for length, value in self.output[node]:
+                yield i - length + 1, i + 1, value
+
+
+def _normalize(text: str) -> str:
+    return text.casefold()
+
+
+def iter_vectors():
+    """Yields every {"id", "values", "metadata"} record of the scraped JSON files."""
+    for directory in TFT_GLOSSARY_DIRS.split(os.pathsep):
+        path = Path(directory)
+        if not path.is_dir():
+            continue
+        for file_path in sorted(path.glob("*.json")):
+            try:
+                with open(file_path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+            except Exception as e:
+                print(f"Glossary: skipping {file_path.name}: {e}")
+                continue
+            if isinstance(data, dict):
+                yield from data.get("vectors", [])
+
+
+def _names(value) -> list:
+    """Names from a str, a list of str, or a list of {"name": ...} dicts."""
+    if isinstance(value, str):
+        return [value]
+    names = []
+    if isinstance(value, list):
+        for v in value:
+            if isinstance(v, str):
+                names.append(v)
+            elif isinstance(v, dict) and isinstance(v.get("name"), str):
+                names.append(v["name"])
+    return names
+
+
+def load_entities() -> dict:
+    """Returns {name: entity_type} from the scraped records."""
+    entities = {}
+
+    def add(names, entity_type):
+        for name in _names(names):
+            name = name.strip()
+            if len(name) >= MIN_NAME_LENGTH:
+                entities.setdefault(name, entity_type)
+
+    for item in iter_vectors():
+        meta = item.get("metadata", {})
+        record_type = str(meta.get("type", "")).lower()
+        if record_type == "champion":
+            add(meta.get("champion_name"), "champion")
+            add(meta.get("traits"), "trait")
+        elif record_type == "item":
+            add(meta.get("item_name"), "item")
+        elif record_type == "augment":
+            add(meta.get("name"), "augment")
+        elif record_type == "composition":
+            add(meta.get("comp_name"), "composition")
+            add(meta.get("units"), "champion")
+            add(meta.get("traits"), "trait")
+    return entities
+
+
+def load_aliases(entities: dict) -> dict:
+    """Returns {alias: canonical name} for aliases whose target is a known entity."""
+    if not os.path.exists(TFT_ALIASES_FILE):
+        return {}
+    try:
+        with open(TFT_ALIASES_FILE, 'r', encoding='utf-8') as f:
+            aliases = json.load(f)
+    except Exception as e:
+        print(f"Glossary: failed to read aliases: {e}")
+        return {}
+    return {a: c for a, c in aliases.items() if c in entities and len(a) >= MIN_NAME_LENGTH}
+
+
+class Glossary:
+
+    def __init__(self):
+        self.entities = load_entities()
+        aliases = load_aliases(self.entities)
+        self.automaton = AhoCorasick()
+        for name in self.entities:
+            self.automaton.add(_normalize(name), name)
+        for alias, canonical in aliases.items():
+            self.automaton.add(_normalize(alias), canonical)
+        self.automaton.build()
+        print(f"Glossary loaded: {len(self.entities)} names, {len(aliases)} aliases")
+
+    def extract_entities(self, text: str) -> list:
+        """
+        Returns [(name, entity_type)] in order of appearance. Overlapping matches
+        resolve to the longest (then leftmost) one, so "潘朵拉的装备" wins over "装备".
+        """
+        matches = sorted(self.automaton.iter_matches(_normalize(text)), key=lambda m: (m[0] - m[1], m[0]))
+        taken = []
+        chosen = []
+        for start, end, name in matches:
+            if any(start < t_end and t_start < end for t_start, t_end in taken):
+                continue
+            taken.append((start, end))
+            chosen.append((start, name))
+        chosen.sort()
+
+        result = []
+        for _, name in chosen:
+            entry = (name, self.entities[name])
+            if entry not in result:
+                result.append(entry)
+        return result
+
+
+_glossary = None
+_glossary_lock = threading.Lock()
+_stats = {"local": 0, "fallback": 0, "skipped": 0}
+_stats_lock = threading.Lock()
+
+
+def get_glossary() -> Glossary:
+    global _glossary
+    if _glossary is None:
+        with _glossary_lock:
+            if _glossary is None:
+                _glossary = Glossary()
+    return _glossary
+
+
+def reload_glossary():
+    """Rebuilds the automaton after the scraped files changed."""
+    global _glossary
+    with _glossary_lock:
+        _glossary = Glossary()
+
+
+def extract_search_queries(query: str) -> list:
+    """
+    Returns search queries for the recognized entities and category phrases of
+    the question, or an empty list if nothing was recognized.
+    """
+    queries = [name for name, _ in get_glossary().extract_entities(query)]
+    for cost in dict.fromkeys(_COST_RE.findall(query)):
+        queries.extend([f"{cost}费英雄", f"{cost}费弈子"])
+    return queries
+
+
+def record_expansion(source: str):
+    """
+    source is "local" when the glossary produced queries, "fallback" for the LLM
+    and "skipped" when a fallback answered from the raw query without waiting for it.
+    """
+    with _stats_lock:
+        _stats[source] += 1
+
+
+def expansion_stats() -> dict:
+    with _stats_lock:
+        stats = dict(_stats)
+    total = stats["local"] + stats["fallback"]
+    stats["fallback_rate"] = round(stats["fallback"] / total, 4) if total else 0.0
+    return stats
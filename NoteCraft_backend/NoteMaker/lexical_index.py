@@ -0,0 +1,161 @@
+"""
+Local lexical (BM25) index over the same chunks that are upserted to Pinecone.
+
+Dense search often misses exact Chinese proper nouns such as augment names
+("潘朵拉的装备"). Chunks are tokenized into character bigrams, which need no
+word segmentation and match proper nouns exactly, and scored with BM25. The
+index is a SQLite file shared by the web process, the Celery worker and the
+offline upsert script; query_ai fuses its ranking with Pinecone's through
+reciprocal rank fusion. Only term statistics are kept here, the chunk text
+itself lives in the docstore.
+
+This module does not import Django so the offline scripts can write to it.
+"""
+import math
+import os
+import re
+import sqlite3
+import threading
+import unicodedata
+from collections import Counter
+from pathlib import Path
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+LEXICAL_INDEX_PATH = os.getenv("LEXICAL_INDEX_PATH", str(BACKEND_DIR / "lexical_index.sqlite3"))
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+RRF_K = 60
+
+_WORD_RE = re.compile(r"\w+")
+
+_local = threading.local()
+
+
+def _connect() -> sqlite3.Connection:
+    """One connection per thread; WAL lets readers run while a writer commits."""
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(LEXICAL_INDEX_PATH, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS chunk_lengths (
+                id TEXT PRIMARY KEY,
+                namespace TEXT NOT NULL DEFAULT '',
+                length INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS postings (
+                term TEXT NOT NULL,
+                chunk_id TEXT NOT NULL,
+                tf INTEGER NOT NULL,
+                PRIMARY KEY (term, chunk_id)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS postings_chunk ON postings (chunk_id);
+        """)
+        _local.conn = conn
+    return conn
+
+
+def tokenize(text: str) -> list:
+    """Character bigrams within each run of word characters; single-character runs stay unigrams."""
+    text = unicodedata.normalize("NFKC", text).casefold()
+    terms = []
+    for word in _WORD_RE.findall(text):
+        if len(word) == 1:
+            terms.append(word)
+        else:
+            terms.extend(word[i:i + 2] for i in range(len(word) - 1))
+    return terms
+
+
+def add_chunks(chunks: list, namespace: str = ""):
+    """
+    Indexes (or re-indexes) chunks given as {"id", "text"} dicts.
+    """
+    rows = []
+    postings = []
+    for chunk in chunks:
+        terms = Counter(tokenize(chunk["text"]))
+        rows.append((chunk["id"], namespace, sum(terms.values())))
+        postings.extend((term, chunk["id"], tf) for term, tf in terms.items())
+    if not rows:
+        return
+
+    conn = _connect()
+    with conn:
+        conn.executemany("DELETE FROM postings WHERE chunk_id = ?", [(r[0],) for r in rows])
+        conn.executemany(
+            "INSERT OR REPLACE INTO chunk_lengths (id, namespace, length) VALUES (?, ?, ?)",
+            rows
+        )
+        conn.executemany("INSERT INTO postings (term, chunk_id, tf) VALUES (?, ?, ?)", postings)
+
+
+def delete_chunks(ids: list):
+    conn = _connect()
+    with conn:
+        conn.executemany("DELETE FROM postings WHERE chunk_id = ?", [(i,) for i in ids])
+        conn.executemany("DELETE FROM chunk_lengths WHERE id = ?", [(i,) for i in ids])
+
+
+def search(query: str, top_k: int = 30, namespaces: tuple = ("",)) -> list:
+    """
+    BM25 search across the given namespaces. Returns [{"id", "score", "metadata"}]
+    sorted by score, in the same shape as the vector store matches; metadata is
+    empty until the docstore fills it in.
+    """
+    terms = list(dict.fromkeys(tokenize(query)))
+    if not terms:
+        return []
+
+    conn = _connect()
+    namespaces = list(namespaces)
+    ns_placeholders = ",".join("?" * len(namespaces))
+    n_docs, avg_length = conn.execute(
+        f"SELECT COUNT(*), AVG(length) FROM chunk_lengths WHERE namespace IN ({ns_placeholders})", namespaces
+    ).fetchone()
+    if not n_docs:
+        return []
+
+    placeholders = ",".join("?" * len(terms))
+    doc_freq = dict(conn.execute(
+        f"SELECT p.term, COUNT(*) FROM postings p JOIN chunk_lengths c ON c.id = p.chunk_id "
+        f"WHERE p.term IN ({placeholders}) AND c.namespace IN ({ns_placeholders}) GROUP BY p.term",
+        (*terms, *namespaces)
+    ).fetchall())
+    idf = {
+        term: math.log(1 + (n_docs - df + 0.5) / (df + 0.5))
+        for term, df in doc_freq.items()
+    }
+    if not idf:
+        return []
+
+    matched_terms = list(idf.keys())
+    scores = Counter()
+    for term, chunk_id, tf, length in conn.execute(
+        f"SELECT p.term, p.chunk_id, p.tf, c.length FROM postings p JOIN chunk_lengths c ON c.id = p.chunk_id "
+        f"WHERE p.term IN ({','.join('?' * len(matched_terms))}) AND c.namespace IN ({ns_placeholders})",
+        (*matched_terms, *namespaces)
+    ):
+        norm = BM25_K1 * (1 - BM25_B + BM25_B * length / avg_length)
+        scores[chunk_id] += idf[term] * tf * (BM25_K1 + 1) / (tf + norm)
+
+    return [
+        {"id": chunk_id, "score": score, "metadata": {}}
+        for chunk_id, score in scores.most_common(top_k)
+    ]
+
+
+def reciprocal_rank_fusion(ranked_lists: list, k: int = RRF_K) -> list:
+    """
+    Fuses several ranked match lists: score(d) = sum over lists of 1 / (k + rank).
+    The metadata of the first list containing a match is kept.
+    """
+    fused = {}
+    for matches in ranked_lists:
+        for rank, match in enumerate(matches, start=1):
+            entry = fused.get(match["id"])
+            if entry is None:
+                entry = fused[match["id"]] = {**match, "score": 0.0}
+            entry["score"] += 1.0 / (k + rank)
+    return sorted(fused.values(), key=lambda m: m["score"], reverse=True)
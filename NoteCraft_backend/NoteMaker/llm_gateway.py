@@ -0,0 +1,269 @@
+"""
+Shared gateway for all DeepSeek chat calls.
+
+Every LLM call in the backend (query_ai, the async ask_ai path,
+request_OpenRouter and therefore generate_notes_task) goes through this module:
+
+- one keep-alive httpx connection pool per process (per event loop for async),
+  so calls reuse TLS connections instead of handshaking every time;
+- a timeout on every call;
+- bounded retries with full-jitter exponential backoff for transient errors
+  (timeouts, connection errors, 429 and 5xx);
+- a circuit breaker that fails fast while the upstream is down, so hung calls
+  do not pile up and tie up workers.
+- an "llm.invoke"/"llm.stream" trace span per call with the attempts and
+  token usage.
+"""
+import asyncio
+import os
+import random
+import threading
+import time
+import weakref
+
+import httpx
+import openai
+from langchain_core.messages import HumanMessage
+from langchain_openai import ChatOpenAI
+
+from . import tracing
+
+LLM_MODEL = "deepseek-chat"
+LLM_BASE_URL = "https://api.deepseek.com"
+
+LLM_TIMEOUT_SECONDS = float(os.getenv("LLM_TIMEOUT_SECONDS", "60"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "2"))
+LLM_BACKOFF_BASE_SECONDS = float(os.getenv("LLM_BACKOFF_BASE_SECONDS", "0.5"))
+LLM_BACKOFF_MAX_SECONDS = float(os.getenv("LLM_BACKOFF_MAX_SECONDS", "8"))
+LLM_POOL_SIZE = int(os.getenv("LLM_POOL_SIZE", "20"))
+LLM_BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", "5"))
+LLM_BREAKER_RESET_SECONDS = float(os.getenv("LLM_BREAKER_RESET_SECONDS", "30"))
+
+RETRYABLE_ERRORS = (
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+    openai.RateLimitError,
+    openai.InternalServerError,
+    httpx.TransportError,
+)
+
+
+class CircuitOpenError(Exception):
+    """Raised without calling the upstream while the circuit breaker is open."""
+
+
+# Everything a caller may see from a failed gateway call
+LLM_ERRORS = (openai.OpenAIError, httpx.HTTPError, CircuitOpenError)
+
+
+class CircuitBreaker:
+    """
+    Opens after `failure_threshold` consecutive failures. While open, calls fail
+    fast; after `reset_timeout` one trial call is let through (half-open) and
+    its outcome closes or re-opens the circuit.
+    """
+
+    def __init__(self, name: str, failure_threshold: int, reset_timeout: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    def before_call(self):
+        with self._lock:
+            state = self.state
+            if state == "open" or (state == "half-open" and self.trial_in_flight):
+                raise CircuitOpenError(f"{self.name} circuit is open, failing fast")
+            if state == "half-open":
+                self.trial_in_flight = True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_in_flight = False
+
+    def release(self):
+        """Call outcome says nothing about upstream health (e.g. a 400 or a cancelled stream)."""
+        with self._lock:
+            self.trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self.trial_in_flight = False
+            if self.opened_at is not None or self.failures >= self.failure_threshold:
+                # Re-open (or open) and restart the reset timer
+                self.opened_at = time.monotonic()
+                print(f"{self.name} circuit opened after {self.failures} failures")
+
+
+breaker = CircuitBreaker("deepseek", LLM_BREAKER_FAILURES, LLM_BREAKER_RESET_SECONDS)
+
+_http_client = httpx.Client(
+    limits=httpx.Limits(max_connections=LLM_POOL_SIZE, max_keepalive_connections=LLM_POOL_SIZE),
+    timeout=LLM_TIMEOUT_SECONDS
+)
+_chat_model = None
+_chat_model_lock = threading.Lock()
+# httpx.AsyncClient connections belong to the loop that opened them
+_async_chat_models = weakref.WeakKeyDictionary()
+
+
+def _build_chat_model(**client_kwargs) -> ChatOpenAI:
+    api_key = os.getenv("OPEN_ROUTER_API_KEY")
+    if not api_key:
+        raise ValueError("OPEN_ROUTER_API_KEY not found in environment variables")
+    return ChatOpenAI(
+        model=LLM_MODEL,
+        api_key=api_key,
+        base_url=LLM_BASE_URL,
+        temperature=0,
+        timeout=LLM_TIMEOUT_SECONDS,
+        max_retries=0,  # Retries are handled here, with jitter and the circuit breaker
+        **client_kwargs
+    )
+
+
+def get_chat_model() -> ChatOpenAI:
+    global _chat_model
+    if _chat_model is None:
+        with _chat_model_lock:
+            if _chat_model is None:
+                _chat_model = _build_chat_model(http_client=_http_client)
+    return _chat_model
+
+
+def aget_chat_model() -> ChatOpenAI:
+    """Chat model for the running event loop, with its own async connection pool."""
+    loop = asyncio.get_running_loop()
+    model = _async_chat_models.get(loop)
+    if model is None:
+        model = _build_chat_model(http_async_client=httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=LLM_POOL_SIZE, max_keepalive_connections=LLM_POOL_SIZE),
+            timeout=LLM_TIMEOUT_SECONDS
+        ))
+        _async_chat_models[loop] = model
+    return model
+
+
+def _backoff(attempt: int) -> float:
+    # Full jitter: uniform in [0, min(max, base * 2^attempt)]
+    return random.uniform(0, min(LLM_BACKOFF_MAX_SECONDS, LLM_BACKOFF_BASE_SECONDS * 2 ** attempt))
+
+
+def _llm_span(operation: str, timeout: float):
+    return tracing.client_span(f"llm.{operation}", {
+        "gen_ai.system": "deepseek",
+        "gen_ai.operation.name": "chat",
+        "gen_ai.request.model": LLM_MODEL,
+        "llm.timeout_seconds": timeout,
+    })
+
+
+def invoke(messages: list, timeout: float = LLM_TIMEOUT_SECONDS, cancelled: threading.Event = None):
+    """
+    Returns the AIMessage for messages, retrying transient failures.
+    Once cancelled is set no further attempt is made; a request already in
+    flight cannot be interrupted and runs until it finishes or times out.
+    """
+    with _llm_span("invoke", timeout):
+        attempt = 0
+        while True:
+            breaker.before_call()
+            try:
+                response = get_chat_model().invoke(messages, timeout=timeout)
+            except RETRYABLE_ERRORS as e:
+                breaker.record_failure()
+                if attempt >= LLM_MAX_RETRIES or (cancelled is not None and cancelled.is_set()):
+                    raise
+                delay = _backoff(attempt)
+                print(f"LLM call failed ({type(e).__name__}), retrying in {delay:.2f}s")
+                if cancelled is None:
+                    time.sleep(delay)
+                elif cancelled.wait(delay):
+                    raise
+                attempt += 1
+                continue
+            except BaseException:
+                breaker.release()
+                raise
+            breaker.record_success()
+            tracing.set_attributes({"llm.attempts": attempt + 1})
+            tracing.record_usage(response)
+            return response
+
+
+async def ainvoke(messages: list, timeout: float = LLM_TIMEOUT_SECONDS):
+    """Async version of invoke."""
+    with _llm_span("invoke", timeout):
+        attempt = 0
+        while True:
+            breaker.before_call()
+            try:
+                response = await aget_chat_model().ainvoke(messages, timeout=timeout)
+            except RETRYABLE_ERRORS as e:
+                breaker.record_failure()
+                if attempt >= LLM_MAX_RETRIES:
+                    raise
+                delay = _backoff(attempt)
+                print(f"LLM call failed ({type(e).__name__}), retrying in {delay:.2f}s")
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+            except BaseException:
+                breaker.release()
+                raise
+            breaker.record_success()
+            tracing.set_attributes({"llm.attempts": attempt + 1})
+            tracing.record_usage(response)
+            return response
+
+
+async def astream(messages: list, timeout: float = LLM_TIMEOUT_SECONDS):
+    """
+    Yields answer chunks. Retries only happen before the first chunk was
+    produced; a failure mid-stream is raised to the caller.
+    """
+    with _llm_span("stream", timeout):
+        attempt = 0
+        chunks = 0
+        while True:
+            breaker.before_call()
+            started = False
+            try:
+                async for chunk in aget_chat_model().astream(messages, timeout=timeout):
+                    started = True
+                    chunks += 1
+                    yield chunk
+            except RETRYABLE_ERRORS as e:
+                breaker.record_failure()
+                if started or attempt >= LLM_MAX_RETRIES:
+                    raise
+                delay = _backoff(attempt)
+                print(f"LLM stream failed ({type(e).__name__}), retrying in {delay:.2f}s")
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+            except BaseException:
+                breaker.release()
+                raise
+            breaker.record_success()
+            tracing.set_attributes({"llm.attempts": attempt + 1, "llm.stream_chunks": chunks})
+            return
+
+
+def complete(prompt: str, timeout: float = LLM_TIMEOUT_SECONDS) -> str:
+    """Single-turn completion for a plain user prompt."""
+    return invoke([HumanMessage(content=prompt)], timeout=timeout).content
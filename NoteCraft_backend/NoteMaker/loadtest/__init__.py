@@ -0,0 +1,10 @@
+"""
+Offline load testing for /ask_ai/, /generate_note/ and /add_pdf/.
+
+`python manage.py loadtest` replaces Pinecone, DeepSeek, Cloudinary and Google
+Images with in-process stand-ins (stubs.py) whose latency and payload sizes are
+drawn from configurable distributions, seeds a local vector store, docstore and
+lexical index in a temporary directory, and drives the real ASGI application
+with concurrent virtual users (runner.py). Nothing leaves the machine and the
+project's databases and indexes are not touched.
+"""
@@ -0,0 +1,291 @@
+"""
+Virtual users driving the ASGI application in-process.
+
+Every virtual user is an asyncio task that picks an endpoint by weight, sends
+the request through httpx's ASGI transport (the same application object
+uvicorn serves, so sync views share Django's single sync thread exactly as in
+production), records the latency and status, and waits a sampled think time.
+
+GenerateNoteView enqueues generate_notes_task and DocumentUploadView enqueues
+ingest_document_task. The report has both the request latency
+("generate_note", "add_pdf") and the time from sending the request until the
+task is done ("generate_note:task", "add_pdf:task"). By default the tasks run
+as settings.py configures Celery (eagerly, inside the request) and are waited
+for by polling /task_status/<id>/ like the frontend; with an InProcessWorker
+they run on a thread pool instead, and the task time includes waiting for a
+free thread.
+"""
+import asyncio
+import math
+import random
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import httpx
+
+from .stubs import Distribution, make_pdf, random_question
+
+ENDPOINTS = ("ask_ai", "generate_note", "add_pdf")
+
+
+def percentile(sorted_values: list, pct: float) -> float:
+    """Nearest-rank percentile of an ascending list."""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, math.ceil(pct / 100 * len(sorted_values)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def parse_server_timing(header: str) -> dict:
+    """'embed;dur=12.3, total;dur=80.2' -> {"embed": 12.3} (milliseconds, total dropped)."""
+    stages = {}
+    for entry in header.split(","):
+        name, _, params = entry.strip().partition(";")
+        if not name or name == "total":
+            continue
+        for param in params.split(";"):
+            key, _, value = param.partition("=")
+            if key.strip() == "dur":
+                try:
+                    stages[name] = stages.get(name, 0.0) + float(value)
+                except ValueError:
+                    pass
+    return stages
+
+
+class EndpointStats:
+
+    def __init__(self, name: str):
+        self.name = name
+        self.latencies = []
+        self.errors = 0
+        self.statuses = {}
+        self.stages = {}
+
+    def record(self, seconds: float, status, ok: bool, server_timing: str = None):
+        self.latencies.append(seconds)
+        self.statuses[str(status)] = self.statuses.get(str(status), 0) + 1
+        if not ok:
+            self.errors += 1
+        if server_timing:
+            for stage, ms in parse_server_timing(server_timing).items():
+                self.stages.setdefault(stage, []).append(ms)
+
+    def summary(self, elapsed: float) -> dict:
+        latencies = sorted(self.latencies)
+        count = len(latencies)
+        stages = {}
+        for stage, values in self.stages.items():
+            values = sorted(values)
+            stages[stage] = {
+                "count": len(values),
+                "mean_ms": round(sum(values) / len(values), 1),
+                "p95_ms": round(percentile(values, 95), 1),
+            }
+        return {
+            "requests": count,
+            "errors": self.errors,
+            "error_rate": round(self.errors / count, 4) if count else 0.0,
+            "throughput_rps": round(count / elapsed, 2) if elapsed else 0.0,
+            "p50_ms": round(percentile(latencies, 50) * 1000, 1),
+            "p95_ms": round(percentile(latencies, 95) * 1000, 1),
+            "p99_ms": round(percentile(latencies, 99) * 1000, 1),
+            "max_ms": round(latencies[-1] * 1000, 1) if latencies else 0.0,
+            "statuses": self.statuses,
+            "stages": stages,
+        }
+
+
+class InProcessWorker:
+    """Runs enqueued tasks on a thread pool the size of the Celery worker's concurrency."""
+
+    def __init__(self, task, concurrency: int):
+        self.task = task
+        self.executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="loadtest-worker")
+        self.jobs = {}
+
+    def delay(self, *args, **kwargs):
+        return self.apply_async(args, kwargs)
+
+    def apply_async(self, args=(), kwargs=None, task_id=None):
+        task_id = task_id or str(uuid.uuid4())
+        kwargs = kwargs or {}
+        future = self.executor.submit(self.task.apply, args=args, kwargs=kwargs, task_id=task_id)
+        self.jobs[task_id] = (future, time.perf_counter())
+        return SimpleNamespace(id=task_id)
+
+    async def wait(self, client, task_id: str):
+        """Returns the task's result."""
+        # Not popped: coalesced generate_note requests wait on the same task id
+        future, _ = self.jobs[task_id]
+        result = await asyncio.wrap_future(future)
+        return result.result
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+
+class TaskStatusPoller:
+    """Waits for a task run by the configured Celery setup by polling /task_status/<id>/."""
+
+    def __init__(self, interval: float = 0.2):
+        self.interval = interval
+
+    async def wait(self, client, task_id: str):
+        """Returns the task's result."""
+        while True:
+            response = await client.get(f"/task_status/{task_id}/")
+            response.raise_for_status()
+            data = response.json()
+            if data["state"] in ("SUCCESS", "FAILURE", "REVOKED"):
+                return data["result"]
+            await asyncio.sleep(self.interval)
+
+
+class LoadTest:
+    """
+    worker and ingest_worker run generate_notes_task and ingest_document_task
+    when the views were pointed at InProcessWorkers; None means the tasks run
+    as configured and are polled through /task_status/<id>/.
+    """
+
+    def __init__(self, app, token: str, worker: InProcessWorker, ingest_worker: InProcessWorker, users: int, mix: dict,
+                 duration: float = None, max_requests: int = None, think_time: str = "fixed:0",
+                 pdf_pages: str = "lognormal:6,0.5", pdf_page_chars: int = 2500, pdf_pool: int = 8,
+                 unique_queries: bool = True, timeout: float = 300):
+        self.app = app
+        self.headers = {"Authorization": f"Bearer {token}"}
+        poller = TaskStatusPoller()
+        self.worker = worker or poller
+        self.ingest_worker = ingest_worker or poller
+        self.task_runner = "in-process threads" if worker else "configured Celery (task_status polling)"
+        self.users = users
+        self.mix = {name: weight for name, weight in mix.items() if weight > 0}
+        self.duration = duration
+        self.max_requests = max_requests
+        self.think_time = Distribution(think_time)
+        self.unique_queries = unique_queries
+        self.timeout = timeout
+        self.stats = {}
+        self.sent = 0
+        self.pdfs = []
+        if "add_pdf" in self.mix:
+            pages = Distribution(pdf_pages)
+            self.pdfs = [make_pdf(pages.sample_int(), pdf_page_chars) for _ in range(pdf_pool)]
+
+    def _stats(self, name: str) -> EndpointStats:
+        if name not in self.stats:
+            self.stats[name] = EndpointStats(name)
+        return self.stats[name]
+
+    def _question(self) -> str:
+        question = random_question()
+        # A unique suffix keeps the semantic answer cache from short-circuiting the pipeline
+        return f"{question}（{uuid.uuid4().hex[:6]}）" if self.unique_queries else question
+
+    async def _timed(self, name: str, send, ok_statuses: tuple):
+        start = time.perf_counter()
+        try:
+            response = await send()
+        except Exception as e:
+            self._stats(name).record(time.perf_counter() - start, type(e).__name__, False)
+            return None
+        self._stats(name).record(
+            time.perf_counter() - start,
+            response.status_code,
+            response.status_code in ok_statuses,
+            response.headers.get("server-timing"),
+        )
+        return response
+
+    async def ask_ai(self, client):
+        await self._timed("ask_ai", lambda: client.post("/ask_ai/", json={"query": self._question()}), (200,))
+
+    async def _wait_task(self, name: str, worker, client, response, started: float):
+        try:
+            result = await worker.wait(client, response.json()["task_id"])
+            ok = isinstance(result, dict) and result.get("success", False)
+            self._stats(name).record(time.perf_counter() - started, "done" if ok else "failed", ok)
+        except Exception as e:
+            self._stats(name).record(time.perf_counter() - started, type(e).__name__, False)
+
+    async def generate_note(self, client):
+        started = time.perf_counter()
+        response = await self._timed(
+            "generate_note",
+            lambda: client.post("/generate_note/", json={"params": {"query": self._question()}}),
+            (200,)
+        )
+        if response is not None and response.status_code == 200:
+            await self._wait_task("generate_note:task", self.worker, client, response, started)
+
+    async def add_pdf(self, client):
+        name = f"loadtest-{uuid.uuid4().hex[:8]}"
+        pdf = random.choice(self.pdfs)
+        started = time.perf_counter()
+        response = await self._timed(
+            "add_pdf",
+            lambda: client.post("/add_pdf/", files={name: (f"{name}.pdf", pdf, "application/pdf")}),
+            (201,)
+        )
+        if response is not None and response.status_code == 201:
+            await self._wait_task("add_pdf:task", self.ingest_worker, client, response, started)
+
+    def _next_endpoint(self):
+        if self.max_requests is not None:
+            if self.sent >= self.max_requests:
+                return None
+        elif time.perf_counter() >= self.deadline:
+            return None
+        self.sent += 1
+        names = list(self.mix)
+        return random.choices(names, weights=[self.mix[n] for n in names])[0]
+
+    async def _user(self, client):
+        while True:
+            endpoint = self._next_endpoint()
+            if endpoint is None:
+                return
+            await getattr(self, endpoint)(client)
+            think = self.think_time.sample() / 1000
+            if think:
+                await asyncio.sleep(think)
+
+    async def run(self) -> dict:
+        transport = httpx.ASGITransport(app=self.app, client=("127.0.0.1", 50000))
+        async with httpx.AsyncClient(transport=transport, base_url="http://loadtest",
+                                     headers=self.headers, timeout=self.timeout) as client:
+            start = time.perf_counter()
+            self.deadline = start + (self.duration or 0)
+            await asyncio.gather(*(self._user(client) for _ in range(self.users)))
+            elapsed = time.perf_counter() - start
+        return {
+            "elapsed_seconds": round(elapsed, 2),
+            "users": self.users,
+            "task_runner": self.task_runner,
+            "endpoints": {name: stats.summary(elapsed) for name, stats in sorted(self.stats.items())},
+        }
+
+
+def format_report(results: dict) -> str:
+    lines = [
+        f"{results['users']} virtual users, {results['elapsed_seconds']}s, tasks run by {results['task_runner']}",
+        "",
+        f"{'endpoint':<22}{'requests':>9}{'errors':>8}{'err%':>7}{'rps':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}",
+    ]
+    for name, s in results["endpoints"].items():
+        lines.append(
+            f"{name:<22}{s['requests']:>9}{s['errors']:>8}{s['error_rate'] * 100:>6.1f}%{s['throughput_rps']:>8.2f}"
+            f"{s['p50_ms']:>10.1f}{s['p95_ms']:>10.1f}{s['p99_ms']:>10.1f}{s['max_ms']:>10.1f}"
+        )
+    for name, s in results["endpoints"].items():
+        if not s["stages"]:
+            continue
+        lines.append("")
+        lines.append(f"{name} stages (Server-Timing)")
+        ranked = sorted(s["stages"].items(), key=lambda item: -item[1]["mean_ms"])
+        for stage, t in ranked:
+            lines.append(f"  {stage:<20}{t['count']:>8}  mean {t['mean_ms']:>9.1f} ms  p95 {t['p95_ms']:>9.1f} ms")
+    return "\n".join(lines)
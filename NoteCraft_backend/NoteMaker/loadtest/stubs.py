@@ -0,0 +1,417 @@
+"""
+In-process stand-ins for the external services, with sampled latency and
+payload sizes, and the throwaway knowledge base they serve.
+
+install_stubs() patches every place the request path reaches Pinecone
+(embeddings and the vector store), DeepSeek (llm_gateway), Cloudinary and
+Google Images, and points the docstore, lexical index and chunk embedding
+cache at a temporary directory. It must run before the first request is served.
+"""
+import asyncio
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+import uuid
+
+import fitz
+import httpx
+import numpy as np
+import openai
+from langchain_core.messages import AIMessage, AIMessageChunk
+
+from .. import chunk_embedding_cache, docstore, lexical_index, llm_gateway
+from ..namespaces import NAMESPACES
+from ..prompts import EXPANSION_PROMPT
+from ..vector_store import LocalVectorStore, TracedVectorStore, VectorStore
+
+EMBED_DIMENSION = 1024  # llama-text-embed-v2
+
+# Vocabulary for synthetic chunks, questions and notes
+TFT_TERMS = [
+    "阿狸", "亚索", "金克丝", "无尽之刃", "鬼索的狂暴之刃", "蓝霸符", "法师", "斗士", "狙神",
+    "5费卡", "4费卡", "经济", "利息", "连胜", "连败", "搜牌", "升级", "人口", "站位",
+    "阵容", "运营", "海克斯", "棱彩", "黄金", "白银", "羁绊", "纹章", "装备", "合成",
+    "版本", "削弱", "加强", "前排", "后排", "主C", "过渡", "上分", "吃鸡", "前四",
+]
+QUESTION_TEMPLATES = [
+    "{a}应该怎么玩？",
+    "{a}和{b}哪个更强？",
+    "{a}出什么装备？",
+    "当前版本{a}阵容怎么运营？",
+    "{a}前期怎么过渡到{b}？",
+    "{a}站位有什么讲究？",
+    "{a}适合搭配哪些海克斯？",
+]
+NOTE_TOPICS = ["早期运营", "阵容选择", "装备思路", "站位技巧", "海克斯选择", "经济管理"]
+
+
+class Distribution:
+    """
+    A sampler parsed from "fixed:V", "uniform:LO,HI", "normal:MEAN,SD" or
+    "lognormal:MEDIAN,SIGMA". Samples are clamped at zero.
+    """
+
+    def __init__(self, spec: str):
+        self.spec = spec
+        kind, _, params = spec.partition(":")
+        try:
+            values = [float(v) for v in params.split(",")] if params else []
+        except ValueError:
+            raise ValueError(f"Invalid distribution parameters: {spec}")
+        expected = {"fixed": 1, "uniform": 2, "normal": 2, "lognormal": 2}
+        if kind not in expected or len(values) != expected[kind]:
+            raise ValueError(f"Invalid distribution '{spec}', use fixed:V, uniform:LO,HI, normal:MEAN,SD or lognormal:MEDIAN,SIGMA")
+        self.kind = kind
+        self.values = values
+
+    def sample(self, rng=random) -> float:
+        if self.kind == "fixed":
+            value = self.values[0]
+        elif self.kind == "uniform":
+            value = rng.uniform(*self.values)
+        elif self.kind == "normal":
+            value = rng.gauss(*self.values)
+        else:
+            median, sigma = self.values
+            value = median * rng.lognormvariate(0, sigma)
+        return max(0.0, value)
+
+    def sample_int(self, minimum: int = 1) -> int:
+        return max(minimum, int(round(self.sample())))
+
+    def __str__(self):
+        return self.spec
+
+
+class StubConfig:
+    """Latency distributions in milliseconds; payload sizes in tokens, pages and characters."""
+
+    def __init__(self, embed_latency="lognormal:60,0.3", query_latency="lognormal:40,0.3",
+                 upsert_latency="lognormal:80,0.3", llm_latency="lognormal:1200,0.5",
+                 llm_tokens="lognormal:350,0.4", notes_tokens="lognormal:1500,0.3",
+                 cloudinary_latency="lognormal:400,0.4", image_latency="lognormal:300,0.4",
+                 error_rate=0.0):
+        self.embed_latency = Distribution(embed_latency)
+        self.query_latency = Distribution(query_latency)
+        self.upsert_latency = Distribution(upsert_latency)
+        self.llm_latency = Distribution(llm_latency)
+        self.llm_tokens = Distribution(llm_tokens)
+        self.notes_tokens = Distribution(notes_tokens)
+        self.cloudinary_latency = Distribution(cloudinary_latency)
+        self.image_latency = Distribution(image_latency)
+        # Share of stubbed upstream calls that fail, to exercise retries and error paths
+        self.error_rate = error_rate
+
+    def maybe_fail(self, service: str):
+        if self.error_rate and random.random() < self.error_rate:
+            raise StubError(f"Injected {service} failure")
+
+    def maybe_fail_llm(self):
+        # A transient error llm_gateway retries and counts against the circuit breaker
+        if self.error_rate and random.random() < self.error_rate:
+            raise openai.APIConnectionError(request=httpx.Request("POST", f"{llm_gateway.LLM_BASE_URL}/chat/completions"))
+
+
+class StubError(Exception):
+    """Failure injected by a stub (StubConfig.error_rate)."""
+
+
+def _seconds(distribution: Distribution) -> float:
+    return distribution.sample() / 1000
+
+
+def fake_text(tokens: int) -> str:
+    """Chinese-looking filler of roughly the given token count (about 1.5 characters per token)."""
+    words = []
+    length = 0
+    while length < tokens * 1.5:
+        word = random.choice(TFT_TERMS)
+        words.append(word)
+        length += len(word) + 1
+    return "，".join(words) + "。"
+
+
+def fake_vector(text: str, dimension: int = EMBED_DIMENSION) -> list:
+    """Deterministic unit vector for a text, so identical texts embed identically."""
+    seed = int.from_bytes(hashlib.sha1(text.encode("utf-8")).digest()[:8], "little")
+    vector = np.random.default_rng(seed).standard_normal(dimension).astype(np.float32)
+    return (vector / np.linalg.norm(vector)).tolist()
+
+
+def random_question() -> str:
+    a, b = random.sample(TFT_TERMS, 2)
+    return random.choice(QUESTION_TEMPLATES).format(a=a, b=b)
+
+
+# --- Pinecone Inference ---
+
+class _Embedding(dict):
+    """Supports both embedding["values"] and embedding.values, like the SDK's objects."""
+
+    @property
+    def values(self):
+        return self["values"]
+
+
+class _FakeInference:
+    def __init__(self, config: StubConfig):
+        self.config = config
+
+    def _response(self, inputs: list) -> list:
+        self.config.maybe_fail("Pinecone embed")
+        return [_Embedding(values=fake_vector(text)) for text in inputs]
+
+    def embed(self, model: str, inputs: list, parameters: dict = None) -> list:
+        time.sleep(_seconds(self.config.embed_latency))
+        return self._response(inputs)
+
+
+class _FakeAsyncInference(_FakeInference):
+    async def embed(self, model: str, inputs: list, parameters: dict = None) -> list:
+        await asyncio.sleep(_seconds(self.config.embed_latency))
+        return self._response(inputs)
+
+
+class FakePinecone:
+    def __init__(self, config: StubConfig):
+        self.inference = _FakeInference(config)
+
+
+class FakePineconeAsyncio:
+    """Stands in for the PineconeAsyncio class; ai_module builds one per event loop."""
+    config = None
+
+    def __init__(self, api_key: str = None):
+        self.inference = _FakeAsyncInference(self.config)
+
+    async def close(self):
+        pass
+
+
+# --- Vector store ---
+
+class LatencyVectorStore(VectorStore):
+    """Adds sampled network latency to a (local) store's queries and writes."""
+
+    def __init__(self, store: VectorStore, config: StubConfig):
+        self.store = store
+        self.config = config
+
+    def upsert(self, vectors: list, namespace: str = "") -> int:
+        time.sleep(_seconds(self.config.upsert_latency))
+        self.config.maybe_fail("vector upsert")
+        return self.store.upsert(vectors, namespace)
+
+    def query(self, vector, top_k: int = 10, namespace: str = "", filter: dict = None,
+              include_metadata: bool = True) -> list:
+        time.sleep(_seconds(self.config.query_latency))
+        self.config.maybe_fail("vector query")
+        return self.store.query(vector, top_k, namespace, filter, include_metadata)
+
+    async def aquery(self, vector, top_k: int = 10, namespace: str = "", filter: dict = None,
+                     include_metadata: bool = True) -> list:
+        await asyncio.sleep(_seconds(self.config.query_latency))
+        self.config.maybe_fail("vector query")
+        # The engine itself is a local matrix product; keep it off the event loop
+        return await asyncio.to_thread(self.store.query, vector, top_k, namespace, filter, include_metadata)
+
+    def fetch(self, ids: list, namespace: str = "") -> dict:
+        time.sleep(_seconds(self.config.query_latency))
+        return self.store.fetch(ids, namespace)
+
+    def delete(self, ids: list, namespace: str = ""):
+        return self.store.delete(ids, namespace)
+
+    def stats(self) -> dict:
+        return self.store.stats()
+
+    async def aclose(self):
+        await self.store.aclose()
+
+
+# --- DeepSeek ---
+
+class FakeChatModel:
+    """
+    Replaces the ChatOpenAI client behind llm_gateway. The reply has the shape
+    the caller parses (expansion keyword lines, the ```json topic list, the
+    ```markdown notes with image markers, the ```text rewrite) and a sampled
+    length; the latency is sampled per call and spread over streamed chunks.
+    """
+
+    def __init__(self, config: StubConfig):
+        self.config = config
+
+    def _reply(self, messages: list) -> str:
+        system = messages[0].content if len(messages) > 1 else ""
+        prompt = messages[-1].content
+        if system == EXPANSION_PROMPT:
+            return "\n".join(random.sample(TFT_TERMS, 3))
+        if "namespace list" in prompt:
+            namespace = random.choice(NAMESPACES)
+            topics = random.sample(NOTE_TOPICS, 3)
+            return f"```json\n{json.dumps({'namespace': namespace, 'topics': topics}, ensure_ascii=False)}\n```"
+        if "```markdown" in prompt:
+            tokens = self.config.notes_tokens.sample_int()
+            sections = []
+            for topic in NOTE_TOPICS[:4]:
+                image = f"&&&image:(TFT {random.choice(TFT_TERMS)})&&&"
+                sections.append(f"## {topic}\n{fake_text(tokens // 4)}{image}")
+            return "```markdown\n" + "\n".join(sections) + "\n```"
+        if "```text" in prompt:
+            return f"```text\n{fake_text(self.config.llm_tokens.sample_int())}\n```"
+        return fake_text(self.config.llm_tokens.sample_int())
+
+    def _message(self, messages: list) -> AIMessage:
+        content = self._reply(messages)
+        input_tokens = sum(len(m.content) for m in messages) * 2 // 3
+        output_tokens = len(content) * 2 // 3
+        return AIMessage(content=content, usage_metadata={
+            "input_tokens": input_tokens,
+            "output_tokens": output_tokens,
+            "total_tokens": input_tokens + output_tokens,
+        })
+
+    def invoke(self, messages: list, timeout: float = None):
+        time.sleep(_seconds(self.config.llm_latency))
+        self.config.maybe_fail_llm()
+        return self._message(messages)
+
+    async def ainvoke(self, messages: list, timeout: float = None):
+        await asyncio.sleep(_seconds(self.config.llm_latency))
+        self.config.maybe_fail_llm()
+        return self._message(messages)
+
+    async def astream(self, messages: list, timeout: float = None):
+        content = self._reply(messages)
+        chunks = [content[i:i + 8] for i in range(0, len(content), 8)] or [""]
+        delay = _seconds(self.config.llm_latency) / len(chunks)
+        self.config.maybe_fail_llm()
+        for chunk in chunks:
+            await asyncio.sleep(delay)
+            yield AIMessageChunk(content=chunk)
+
+
+# --- Cloudinary and Google Images ---
+
+class FakeCloudinary:
+    """Keeps uploaded files in memory; fetch() serves them back to the ingestion task."""
+
+    def __init__(self, config: StubConfig):
+        self.config = config
+        self.files = {}
+        self._lock = threading.Lock()
+
+    def upload(self, file=None, resource_type=None, folder=None, public_id=None, **kwargs):
+        time.sleep(_seconds(self.config.cloudinary_latency))
+        self.config.maybe_fail("Cloudinary")
+        url = f"https://res.cloudinary.com/loadtest/raw/upload/{folder}/{public_id}"
+        with self._lock:
+            self.files[url] = file
+        return {"secure_url": url}
+
+    def fetch(self, url: str) -> bytes:
+        time.sleep(_seconds(self.config.cloudinary_latency))
+        self.config.maybe_fail("Cloudinary")
+        # Each file is ingested once
+        with self._lock:
+            return self.files.pop(url)
+
+
+class _ImageResult:
+    def __init__(self, url: str):
+        self.url = url
+
+
+class FakeImageSearch:
+    """Stands in for GoogleImagesSearch (search() then results())."""
+
+    def __init__(self, config: StubConfig):
+        self.config = config
+        self._local = threading.local()
+
+    def search(self, search_params: dict = None):
+        time.sleep(_seconds(self.config.image_latency))
+        self.config.maybe_fail("Google Images")
+        # new_image() picks one of six results
+        self._local.results = [_ImageResult(f"https://game.gtimg.cn/loadtest/{uuid.uuid4().hex}.png") for _ in range(6)]
+
+    def results(self) -> list:
+        return getattr(self._local, "results", [])
+
+
+# --- Knowledge base ---
+
+def seed_corpus(store: VectorStore, chunks_per_namespace: int, batch_size: int = 500):
+    """Fills every namespace with synthetic chunks: vectors, docstore text and BM25 postings."""
+    for namespace in NAMESPACES:
+        for start in range(0, chunks_per_namespace, batch_size):
+            documents = []
+            vectors = []
+            for i in range(start, min(start + batch_size, chunks_per_namespace)):
+                chunk_id = f"loadtest-{namespace}-{i}"
+                text = fake_text(random.randint(150, 600))
+                documents.append({"id": chunk_id, "text": text, "source": "loadtest", "page": 0, "category": namespace})
+                vectors.append({"id": chunk_id, "values": fake_vector(text), "metadata": {"source": "loadtest"}})
+            docstore.put_documents(documents, namespace=namespace)
+            lexical_index.add_chunks(documents, namespace=namespace)
+            store.upsert(vectors, namespace=namespace)
+
+
+def make_pdf(pages: int, chars_per_page: int) -> bytes:
+    """A PDF of synthetic English text (the built-in font has no CJK glyphs that pypdf can extract)."""
+    words = ["carry", "items", "level", "board", "econ", "streak", "augment", "trait", "frontline",
+             "backline", "reroll", "positioning", "tempo", "comp", "champion", "emblem"]
+    document = fitz.open()
+    for _ in range(pages):
+        page = document.new_page()
+        text = " ".join(random.choice(words) for _ in range(chars_per_page // 6))
+        page.insert_textbox(fitz.Rect(36, 36, page.rect.width - 36, page.rect.height - 36), text, fontsize=8)
+    data = document.tobytes()
+    document.close()
+    return data
+
+
+def install_stubs(config: StubConfig, workdir: str, chunks_per_namespace: int):
+    """
+    Points every external dependency of the request path at the stubs and
+    seeds a local knowledge base in workdir.
+    """
+    # Redirect the knowledge base files before any thread opens a connection
+    docstore.DOCSTORE_PATH = os.path.join(workdir, "docstore.sqlite3")
+    lexical_index.LEXICAL_INDEX_PATH = os.path.join(workdir, "lexical_index.sqlite3")
+    chunk_embedding_cache.CHUNK_EMBED_CACHE_PATH = os.path.join(workdir, "chunk_embeddings.sqlite3")
+
+    # Keep the shared Redis (embedding and answer caches) out of the measurement
+    from .. import embedding_cache
+    os.environ.pop("REDIS_URL", None)
+    embedding_cache._redis_client = None
+
+    from .. import ai_module, myutils, vector_store
+    import cloudinary.uploader
+    from UserData import tasks as user_tasks
+
+    local_store = LocalVectorStore(os.path.join(workdir, "vector_store"))
+    seed_corpus(local_store, chunks_per_namespace)
+    store = TracedVectorStore(LatencyVectorStore(local_store, config), "local")
+    vector_store._store = store
+
+    pc = FakePinecone(config)
+    FakePineconeAsyncio.config = config
+    ai_module.pc = pc
+    ai_module.PineconeAsyncio = FakePineconeAsyncio
+    ai_module._async_clients.clear()
+    myutils.pc = pc
+    myutils.index = store
+    myutils.gis = FakeImageSearch(config)
+
+    chat_model = FakeChatModel(config)
+    llm_gateway.get_chat_model = lambda: chat_model
+    llm_gateway.aget_chat_model = lambda: chat_model
+
+    fake_cloudinary = FakeCloudinary(config)
+    cloudinary.uploader.upload = fake_cloudinary.upload
+    user_tasks.fetch_pdf = fake_cloudinary.fetch
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from NoteMaker.entities import load_tft_entities
+from NoteMaker.glossary import TFT_GLOSSARY_DIRS
+
+
+class Command(BaseCommand):
+    help = "Loads the scraped champion, item, augment and composition JSON into the structured entity tables"
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"Reading scraped records from {TFT_GLOSSARY_DIRS}")
+        counts = load_tft_entities()
+        self.stdout.write(self.style.SUCCESS(
+            ", ".join(f"{name}: {count}" for name, count in counts.items())
+        ))
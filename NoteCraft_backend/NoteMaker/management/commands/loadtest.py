@@ -0,0 +1,191 @@
+import asyncio
+import json
+import os
+import random
+import shutil
+import tempfile
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from NoteMaker.loadtest.runner import ENDPOINTS, InProcessWorker, LoadTest, format_report
+from NoteMaker.loadtest.stubs import StubConfig, install_stubs
+
+
+def parse_weights(value: str) -> dict:
+    """"ask_ai=6,add_pdf=1" -> {"ask_ai": 6.0, "add_pdf": 1.0}"""
+    weights = {}
+    for item in value.split(","):
+        name, _, weight = item.partition("=")
+        name = name.strip()
+        if name not in ENDPOINTS:
+            raise CommandError(f"Unknown endpoint '{name}', expected one of {', '.join(ENDPOINTS)}")
+        try:
+            weights[name] = float(weight or 1)
+        except ValueError:
+            raise CommandError(f"Invalid weight for {name}: {weight}")
+    return weights
+
+
+class Command(BaseCommand):
+    help = (
+        "Load-tests /ask_ai/, /generate_note/ and /add_pdf/ offline: Pinecone, DeepSeek, Cloudinary and "
+        "Google Images are replaced by stubs with sampled latency, and the real ASGI application is driven "
+        "by concurrent virtual users against a throwaway database and knowledge base"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=10, help="Concurrent virtual users")
+        parser.add_argument("--duration", type=float, default=30, help="Seconds to run (ignored with --requests)")
+        parser.add_argument("--requests", type=int, help="Stop after this many requests in total")
+        parser.add_argument("--mix", default="ask_ai=6,generate_note=2,add_pdf=1", help="Endpoint weights")
+        parser.add_argument("--think-time", default="fixed:0", help="Pause between a user's requests (ms)")
+        parser.add_argument("--in-process-worker", action="store_true",
+                            help="Run generate_notes_task and ingest_document_task on in-process thread pools instead of "
+                                 "the Celery configuration in settings.py (not a deployed setup; labelled in the report)")
+        parser.add_argument("--worker-concurrency", type=int, default=4,
+                            help="Threads per task with --in-process-worker")
+        parser.add_argument("--corpus-size", type=int, default=500, help="Synthetic chunks per namespace")
+        parser.add_argument("--admission", action="store_true",
+                            help="Apply admission limits (all virtual users share one account, so per-user limits bind)")
+        parser.add_argument("--repeat-queries", action="store_true", help="Allow identical questions (answer cache hits)")
+        parser.add_argument("--pdf-pages", default="lognormal:6,0.5", help="Pages per uploaded PDF")
+        parser.add_argument("--pdf-page-chars", type=int, default=2500, help="Characters per PDF page")
+        parser.add_argument("--embed-latency", default="lognormal:60,0.3", help="Pinecone embed call (ms)")
+        parser.add_argument("--query-latency", default="lognormal:40,0.3", help="Vector query (ms)")
+        parser.add_argument("--upsert-latency", default="lognormal:80,0.3", help="Vector upsert (ms)")
+        parser.add_argument("--llm-latency", default="lognormal:1200,0.5", help="DeepSeek call (ms)")
+        parser.add_argument("--llm-tokens", default="lognormal:350,0.4", help="Answer length (tokens)")
+        parser.add_argument("--notes-tokens", default="lognormal:1500,0.3", help="Generated notes length (tokens)")
+        parser.add_argument("--cloudinary-latency", default="lognormal:400,0.4", help="Cloudinary upload (ms)")
+        parser.add_argument("--image-latency", default="lognormal:300,0.4", help="Google Images search (ms)")
+        parser.add_argument("--error-rate", type=float, default=0.0, help="Share of stubbed upstream calls that fail")
+        parser.add_argument("--timeout", type=float, default=300, help="Client timeout per request (s)")
+        parser.add_argument("--seed", type=int, help="Random seed for a reproducible workload")
+        parser.add_argument("--json", help="Also write the results to this file")
+        parser.add_argument("--max-error-rate", type=float, help="Exit with an error above this error rate on any endpoint")
+        parser.add_argument("--max-p95", action="append", default=[], metavar="ENDPOINT=MS",
+                            help="Exit with an error when the endpoint's p95 exceeds MS (repeatable)")
+
+    def handle(self, *args, **options):
+        if options["seed"] is not None:
+            random.seed(options["seed"])
+        mix = parse_weights(options["mix"])
+        max_p95 = {}
+        for item in options["max_p95"]:
+            name, _, ms = item.partition("=")
+            try:
+                max_p95[name.strip()] = float(ms)
+            except ValueError:
+                raise CommandError(f"Invalid --max-p95 {item}, expected ENDPOINT=MS")
+
+        try:
+            config = StubConfig(
+                embed_latency=options["embed_latency"],
+                query_latency=options["query_latency"],
+                upsert_latency=options["upsert_latency"],
+                llm_latency=options["llm_latency"],
+                llm_tokens=options["llm_tokens"],
+                notes_tokens=options["notes_tokens"],
+                cloudinary_latency=options["cloudinary_latency"],
+                image_latency=options["image_latency"],
+                error_rate=options["error_rate"],
+            )
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        workdir = tempfile.mkdtemp(prefix="notecraft-loadtest-")
+        # A throwaway database: the test database of the configured backend
+        old_name = connection.settings_dict["NAME"]
+        if connection.vendor == "sqlite":
+            connection.settings_dict["TEST"]["NAME"] = f"{workdir}/loadtest.sqlite3"
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            self.stdout.write(f"Seeding {options['corpus_size']} chunks per namespace in {workdir}")
+            self.redirect_task_results(workdir)
+            install_stubs(config, workdir, options["corpus_size"])
+            results = self.run(options, mix)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            shutil.rmtree(workdir, ignore_errors=True)
+
+        self.stdout.write(format_report(results))
+        if options["json"]:
+            with open(options["json"], "w", encoding="utf-8") as f:
+                json.dump(results, f, ensure_ascii=False, indent=2)
+
+        failures = []
+        for name, summary in results["endpoints"].items():
+            if options["max_error_rate"] is not None and summary["error_rate"] > options["max_error_rate"]:
+                failures.append(f"{name} error rate {summary['error_rate']:.2%} > {options['max_error_rate']:.2%}")
+            if name in max_p95 and summary["p95_ms"] > max_p95[name]:
+                failures.append(f"{name} p95 {summary['p95_ms']} ms > {max_p95[name]} ms")
+        if failures:
+            raise CommandError("; ".join(failures))
+
+    async def run_load_test(self, load_test: LoadTest) -> dict:
+        from NoteMaker.ai_module import aclose_async_clients
+        try:
+            return await load_test.run()
+        finally:
+            await aclose_async_clients()
+
+    def redirect_task_results(self, workdir: str):
+        """Keeps the file result backend's task results in workdir rather than celery_results/."""
+        # Celery reads its CELERY_ settings from django.conf.settings; the backend is created on first use
+        if str(settings.CELERY_RESULT_BACKEND).startswith("file://"):
+            results_dir = f"{workdir}/celery_results"
+            os.makedirs(results_dir, exist_ok=True)
+            settings.CELERY_RESULT_BACKEND = "file://" + results_dir
+
+    def run(self, options: dict, mix: dict) -> dict:
+        from django.core.asgi import get_asgi_application
+        from NoteCraft_backend.celery import app as celery_app
+        from NoteMaker import admission, views
+        from NoteMaker.tasks import generate_notes_task
+        from UserData import views as user_views
+        from UserData.tasks import ingest_document_task
+
+        admission.ADMISSION_ENABLED = options["admission"]
+
+        worker = ingest_worker = None
+        if options["in_process_worker"]:
+            # Keep the thread pools' results out of the file backend
+            generate_notes_task.store_eager_result = False
+            ingest_document_task.store_eager_result = False
+            worker = InProcessWorker(generate_notes_task, options["worker_concurrency"])
+            ingest_worker = InProcessWorker(ingest_document_task, options["worker_concurrency"])
+            views.generate_notes_task = worker
+            user_views.ingest_document_task = ingest_worker
+        elif not celery_app.conf.task_always_eager:
+            # A separate worker process sees neither the stubs nor the throwaway database
+            raise CommandError(
+                "Celery is configured with a broker; run the load test with CELERY_TASK_ALWAYS_EAGER=True "
+                "or with --in-process-worker"
+            )
+
+        user = get_user_model().objects.create_user(username="loadtest")
+        token = str(RefreshToken.for_user(user).access_token)
+
+        load_test = LoadTest(
+            get_asgi_application(), token, worker, ingest_worker,
+            users=options["users"],
+            mix=mix,
+            duration=None if options["requests"] else options["duration"],
+            max_requests=options["requests"],
+            think_time=options["think_time"],
+            pdf_pages=options["pdf_pages"],
+            pdf_page_chars=options["pdf_page_chars"],
+            unique_queries=not options["repeat_queries"],
+            timeout=options["timeout"],
+        )
+        self.stdout.write(f"Running {options['users']} virtual users, mix {mix}")
+        try:
+            return asyncio.run(self.run_load_test(load_test))
+        finally:
+            for pool in (worker, ingest_worker):
+                if pool is not None:
+                    pool.shutdown()
@@ -0,0 +1,173 @@
+"""
+Per-stage latency metrics for the RAG pipeline.
+
+Every stage of query_ai, get_context, generate_notes_task and the PDF upload
+runs inside `with stage(pipeline, name):`, which records its duration in the
+notecraft_stage_seconds histogram and, while a request is being served, in the
+request's Server-Timing list. Token and match counts go to their own
+histograms. ServerTimingMiddleware writes the list into the response's
+Server-Timing header, and MetricsView serves everything in the Prometheus text
+format at /metrics/.
+
+Under several uvicorn workers, set PROMETHEUS_MULTIPROC_DIR to a shared empty
+directory so the histograms of all processes are aggregated in one scrape.
+Process-local counters (embedding cache, query expansion, circuit breaker) are
+exported as gauges labelled with the pid of the process that answered.
+"""
+import contextvars
+import os
+import time
+from contextlib import contextmanager
+
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Histogram, generate_latest
+from prometheus_client.core import GaugeMetricFamily
+
+from . import tracing
+
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+SERVER_TIMING_ENABLED = os.getenv("SERVER_TIMING_ENABLED", "True") == "True"
+PROMETHEUS_MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+
+STAGE_SECONDS = Histogram(
+    "notecraft_stage_seconds",
+    "Duration of one pipeline stage",
+    ["pipeline", "stage", "outcome"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 80, 160)
+)
+REQUEST_SECONDS = Histogram(
+    "notecraft_request_seconds",
+    "Duration of an HTTP request, by route",
+    ["route", "method", "status"],
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 80)
+)
+TOKENS = Histogram(
+    "notecraft_tokens",
+    "Tokens per request: context sent to the LLM, context saved by packing, answer",
+    ["pipeline", "kind"],
+    buckets=(16, 64, 256, 512, 1024, 2048, 4096, 8192, 16384, 32768)
+)
+MATCHES = Histogram(
+    "notecraft_matches",
+    "Matches returned by a retrieval stage",
+    ["pipeline", "stage"],
+    buckets=(0, 1, 3, 5, 10, 20, 30, 60, 120, 240)
+)
+
+# Stage timings of the request being served; None outside a request (Celery, scripts)
+_timings = contextvars.ContextVar("stage_timings", default=None)
+
+
+@contextmanager
+def stage(pipeline: str, name: str, **attributes):
+    """
+    Times the enclosed block as one stage of a pipeline, inside a
+    "<pipeline>.<name>" trace span carrying the given attributes.
+    """
+    start = time.perf_counter()
+    outcome = "ok"
+    try:
+        with tracing.span(f"{pipeline}.{name}", attributes):
+            yield
+    except Exception:
+        outcome = "error"
+        raise
+    except BaseException:
+        # asyncio cancellation, generator close
+        outcome = "cancelled"
+        raise
+    finally:
+        observe_stage(pipeline, name, time.perf_counter() - start, outcome)
+
+
+def observe_stage(pipeline: str, name: str, seconds: float, outcome: str = "ok"):
+    """Records a stage measured by the caller (e.g. time to the first streamed token)."""
+    STAGE_SECONDS.labels(pipeline, name, outcome).observe(seconds)
+    timings = _timings.get()
+    if timings is not None:
+        timings.append((name, seconds))
+
+
+def record_tokens(pipeline: str, kind: str, count):
+    if count is not None:
+        TOKENS.labels(pipeline, kind).observe(count)
+
+
+def record_llm_usage(pipeline: str, response):
+    """Prompt and completion tokens reported by the provider on an AIMessage, if any."""
+    usage = getattr(response, "usage_metadata", None) or {}
+    record_tokens(pipeline, "prompt", usage.get("input_tokens"))
+    record_tokens(pipeline, "completion", usage.get("output_tokens"))
+
+
+def record_matches(pipeline: str, stage_name: str, count: int):
+    MATCHES.labels(pipeline, stage_name).observe(count)
+
+
+def submit_in_context(executor, fn, *args, **kwargs):
+    """
+    executor.submit() that runs fn in a copy of the caller's context, so stages
+    timed in worker threads still reach the request's Server-Timing list.
+    """
+    return executor.submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+
+def begin_request():
+    """Starts collecting stage timings for the current request; returns the reset token."""
+    return _timings.set([])
+
+
+def end_request(token) -> list:
+    """Stops collecting and returns the [(stage, seconds)] recorded since begin_request."""
+    timings = _timings.get() or []
+    _timings.reset(token)
+    return timings
+
+
+def format_server_timing(timings: list, total: float = None) -> str:
+    """[(stage, seconds)] -> 'embed;dur=12.3, vector_search;dur=40.1, total;dur=80.2'."""
+    entries = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in timings]
+    if total is not None:
+        entries.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(entries)
+
+
+# Process-local stats exported as gauges: prefix -> callable returning {name: number}
+_gauge_sources = {}
+
+
+def register_gauges(prefix: str, source):
+    """Exports the numeric values of source() as notecraft_<prefix>_<key> gauges."""
+    _gauge_sources[prefix] = source
+
+
+class _ProcessStatsCollector:
+    def collect(self):
+        pid = str(os.getpid())
+        for prefix, source in list(_gauge_sources.items()):
+            try:
+                values = source()
+            except Exception as e:
+                print(f"Metrics source {prefix} failed: {e}")
+                continue
+            for key, value in values.items():
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+                gauge = GaugeMetricFamily(f"notecraft_{prefix}_{key}", f"{prefix} {key} of this process", labels=["pid"])
+                gauge.add_metric([pid], value)
+                yield gauge
+
+
+_process_stats = _ProcessStatsCollector()
+REGISTRY.register(_process_stats)
+
+
+def render_metrics() -> tuple:
+    """Returns (body, content_type) for a Prometheus scrape."""
+    if PROMETHEUS_MULTIPROC_DIR:
+        from prometheus_client import multiprocess
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        registry.register(_process_stats)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -0,0 +1,261 @@
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.http import JsonResponse
+from django.urls import Resolver404, resolve
+from django.utils.functional import LazyObject
+from opentelemetry import context, propagate, trace
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken
+from rest_framework_simplejwt.settings import api_settings as jwt_settings
+
+from . import admission, metrics
+from .tracing import tracer
+
+
+class ServerTimingMiddleware:
+    """
+    Collects the pipeline stages timed while a request is served, adds them as
+    a Server-Timing header and records the request duration per route.
+    Streaming responses only carry the stages that ran before the first byte.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        token = metrics.begin_request()
+        start = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            timings = metrics.end_request(token)
+        return self.finish(request, response, timings, time.perf_counter() - start)
+
+    async def __acall__(self, request):
+        token = metrics.begin_request()
+        start = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            timings = metrics.end_request(token)
+        return self.finish(request, response, timings, time.perf_counter() - start)
+
+    def finish(self, request, response, timings: list, elapsed: float):
+        match = getattr(request, "resolver_match", None)
+        route = match.route if match else "unmatched"
+        metrics.REQUEST_SECONDS.labels(route, request.method, str(response.status_code)).observe(elapsed)
+        if metrics.SERVER_TIMING_ENABLED:
+            response["Server-Timing"] = metrics.format_server_timing(timings, elapsed)
+            # Cross-origin pages only see the timings when the origin is allowed to
+            origin = request.headers.get("Origin")
+            if origin and origin in getattr(settings, "CORS_ALLOWED_ORIGINS", ()):
+                response["Timing-Allow-Origin"] = origin
+        return response
+
+
+class TracingMiddleware:
+    """
+    Opens a SERVER span for every request, continuing the caller's trace when
+    it sends a traceparent header. The span is named after the matched route
+    (e.g. "POST ask_ai/") once the view has run.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        request_span, token = self.start(request)
+        response = error = None
+        try:
+            response = self.get_response(request)
+            return response
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            self.end(request_span, token, request, response=response, error=error)
+
+    async def __acall__(self, request):
+        request_span, token = self.start(request)
+        response = error = None
+        try:
+            response = await self.get_response(request)
+            return response
+        except BaseException as e:
+            # Including CancelledError when an ASGI client disconnects
+            error = e
+            raise
+        finally:
+            self.end(request_span, token, request, response=response, error=error)
+
+    def start(self, request):
+        parent = propagate.extract(request.headers)
+        request_span = tracer.start_span(
+            f"{request.method} {request.path}",
+            context=parent,
+            kind=trace.SpanKind.SERVER,
+            attributes={"http.request.method": request.method, "url.path": request.path},
+        )
+        token = context.attach(trace.set_span_in_context(request_span, parent))
+        return request_span, token
+
+    def end(self, request_span, token, request, response=None, error=None):
+        try:
+            self.annotate(request_span, request, response, error)
+        finally:
+            request_span.end()
+            context.detach(token)
+
+    def annotate(self, request_span, request, response=None, error=None):
+        match = getattr(request, "resolver_match", None)
+        if match:
+            request_span.update_name(f"{request.method} {match.route}")
+            request_span.set_attribute("http.route", match.route)
+            view = getattr(match.func, "view_class", match.func)
+            request_span.set_attribute("code.function", getattr(view, "__name__", ""))
+        # Only a user set by the view's JWT authentication; evaluating the lazy
+        # session user would query the database (not allowed under async)
+        user = request.__dict__.get("user")
+        if user is not None and not issubclass(type(user), LazyObject) and user.is_authenticated:
+            request_span.set_attribute("enduser.id", str(user.pk))
+        if response is not None:
+            request_span.set_attribute("http.response.status_code", response.status_code)
+            if response.status_code >= 500:
+                request_span.set_status(trace.StatusCode.ERROR)
+        if error is not None:
+            request_span.record_exception(error)
+            request_span.set_status(trace.StatusCode.ERROR, str(error) or type(error).__name__)
+
+
+class AdmissionMiddleware:
+    """
+    Applies admission control to views that set an admission_class (see
+    admission.py). The user is read from the JWT without a database query;
+    callers without a valid token (several of these views allow anonymous
+    access) are limited per client IP instead. Over the
+    limit, the client gets 429 with a Retry-After header. The admitted
+    request's lease is available to the view as request.admission_lease.
+    A streaming response holds its lease until the stream ends or the client
+    disconnects.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+        self.auth = JWTAuthentication()
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        endpoint, user = self.identify(request)
+        if endpoint is None:
+            return self.get_response(request)
+        try:
+            with metrics.stage(endpoint, "admission"):
+                lease = admission.admit(endpoint, user)
+        except admission.Rejected as e:
+            return self.reject(e)
+        request.admission_lease = lease
+        response = None
+        try:
+            response = self.get_response(request)
+            return self.hold_until_streamed(response, lease)
+        finally:
+            if response is None or not response.streaming:
+                lease.release()
+
+    async def __acall__(self, request):
+        endpoint, user = self.identify(request)
+        if endpoint is None:
+            return await self.get_response(request)
+        try:
+            with metrics.stage(endpoint, "admission"):
+                lease = await admission.aadmit(endpoint, user)
+        except admission.Rejected as e:
+            return self.reject(e)
+        request.admission_lease = lease
+        response = None
+        try:
+            response = await self.get_response(request)
+            return self.hold_until_streamed(response, lease)
+        finally:
+            if response is None or not response.streaming:
+                lease.release()
+
+    def hold_until_streamed(self, response, lease):
+        """Moves the lease release of a streaming response to the end of its body."""
+        if not response.streaming:
+            return response
+        content = response.streaming_content
+        if response.is_async:
+            async def released_after():
+                try:
+                    async for part in content:
+                        yield part
+                finally:
+                    lease.release()
+        else:
+            def released_after():
+                try:
+                    yield from content
+                finally:
+                    lease.release()
+        response.streaming_content = released_after()
+        return response
+
+    def identify(self, request) -> tuple:
+        """(endpoint class, user id) of a limited request, else (None, None)."""
+        if not admission.ADMISSION_ENABLED or request.method == "OPTIONS":
+            return None, None
+        try:
+            view = getattr(resolve(request.path_info).func, "view_class", None)
+        except Resolver404:
+            return None, None
+        endpoint = getattr(view, "admission_class", None)
+        if endpoint is None:
+            return None, None
+        header = self.auth.get_header(request)
+        raw_token = self.auth.get_raw_token(header) if header else None
+        if raw_token is not None:
+            try:
+                token = self.auth.get_validated_token(raw_token)
+                return endpoint, str(token.get(jwt_settings.USER_ID_CLAIM))
+            except InvalidToken:
+                pass
+        return endpoint, f"ip:{self.client_ip(request)}"
+
+    def client_ip(self, request) -> str:
+        # X-Forwarded-For is set by clients too; only trust it behind a proxy that overwrites it
+        if admission.ADMISSION_TRUST_FORWARDED_FOR:
+            forwarded = request.META.get("HTTP_X_FORWARDED_FOR", "")
+            if forwarded:
+                return forwarded.split(",")[0].strip()
+        return request.META.get("REMOTE_ADDR") or "unknown"
+
+    def reject(self, rejected):
+        response = JsonResponse(
+            {"error": "请求过于频繁，请稍后再试", "reason": rejected.reason, "retry_after": rejected.retry_after},
+            status=429,
+        )
+        response["Retry-After"] = str(rejected.retry_after)
+        return response
@@ -0,0 +1,92 @@
+# Generated by Django 5.1.7 on 2026-10-16 22:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('NoteMaker', '0002_conversation_is_marked'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Augment',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, unique=True)),
+                ('season', models.CharField(blank=True, max_length=20)),
+                ('level', models.PositiveSmallIntegerField(db_index=True, null=True)),
+                ('quality', models.CharField(blank=True, db_index=True, max_length=20)),
+                ('hex_type', models.CharField(blank=True, max_length=50)),
+                ('effect', models.TextField(blank=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'ordering': ['level', 'name'],
+            },
+        ),
+        migrations.CreateModel(
+            name='Composition',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source_id', models.CharField(max_length=255, unique=True)),
+                ('name', models.CharField(db_index=True, max_length=255)),
+                ('tier', models.CharField(blank=True, db_index=True, max_length=10)),
+                ('avg_rank', models.FloatField(null=True)),
+                ('top4_rate', models.FloatField(null=True)),
+                ('win_rate', models.FloatField(null=True)),
+                ('pick_rate', models.FloatField(null=True)),
+                ('units', models.JSONField(blank=True, default=list)),
+                ('traits', models.JSONField(blank=True, default=list)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'ordering': ['tier', 'avg_rank'],
+            },
+        ),
+        migrations.CreateModel(
+            name='Item',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, unique=True)),
+                ('recipe', models.CharField(blank=True, max_length=255)),
+                ('avg_rank', models.FloatField(null=True)),
+                ('top4_rate', models.FloatField(null=True)),
+                ('win_rate', models.FloatField(null=True)),
+                ('pick_count', models.IntegerField(null=True)),
+                ('recommended_champions', models.JSONField(blank=True, default=list)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'ordering': ['avg_rank'],
+            },
+        ),
+        migrations.CreateModel(
+            name='Trait',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, unique=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Champion',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, unique=True)),
+                ('cost', models.PositiveSmallIntegerField(db_index=True, null=True)),
+                ('base_stats', models.JSONField(blank=True, default=dict)),
+                ('avg_rank', models.FloatField(null=True)),
+                ('top4_rate', models.FloatField(null=True)),
+                ('win_rate', models.FloatField(null=True)),
+                ('pick_count', models.IntegerField(null=True)),
+                ('recommended_items', models.JSONField(blank=True, default=list)),
+                ('skill_description', models.TextField(blank=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('traits', models.ManyToManyField(blank=True, related_name='champions', to='NoteMaker.trait')),
+            ],
+            options={
+                'ordering': ['cost', 'avg_rank'],
+            },
+        ),
+    ]
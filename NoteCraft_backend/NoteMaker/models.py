@@ -25,3 +25,80 @@ class Message(models.Model):
 
     def __str__(self):
         return f"{self.role}: {self.content[:50]}..."
+
+
+# --- Structured TFT entities, loaded from the scraped JSON by `manage.py load_tft_entities` ---
+
+class Trait(models.Model):
+    name = models.CharField(max_length=100, unique=True)
+
+    def __str__(self):
+        return self.name
+
+class Champion(models.Model):
+    name = models.CharField(max_length=100, unique=True)
+    cost = models.PositiveSmallIntegerField(null=True, db_index=True)
+    traits = models.ManyToManyField(Trait, related_name='champions', blank=True)
+    base_stats = models.JSONField(default=dict, blank=True)
+    avg_rank = models.FloatField(null=True)
+    top4_rate = models.FloatField(null=True)
+    win_rate = models.FloatField(null=True)
+    pick_count = models.IntegerField(null=True)
+    recommended_items = models.JSONField(default=list, blank=True)
+    skill_description = models.TextField(blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ['cost', 'avg_rank']
+
+    def __str__(self):
+        return self.name
+
+class Item(models.Model):
+    name = models.CharField(max_length=100, unique=True)
+    recipe = models.CharField(max_length=255, blank=True)
+    avg_rank = models.FloatField(null=True)
+    top4_rate = models.FloatField(null=True)
+    win_rate = models.FloatField(null=True)
+    pick_count = models.IntegerField(null=True)
+    recommended_champions = models.JSONField(default=list, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ['avg_rank']
+
+    def __str__(self):
+        return self.name
+
+class Augment(models.Model):
+    name = models.CharField(max_length=100, unique=True)
+    season = models.CharField(max_length=20, blank=True)
+    level = models.PositiveSmallIntegerField(null=True, db_index=True)
+    quality = models.CharField(max_length=20, blank=True, db_index=True)
+    hex_type = models.CharField(max_length=50, blank=True)
+    effect = models.TextField(blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ['level', 'name']
+
+    def __str__(self):
+        return self.name
+
+class Composition(models.Model):
+    source_id = models.CharField(max_length=255, unique=True)
+    name = models.CharField(max_length=255, db_index=True)
+    tier = models.CharField(max_length=10, blank=True, db_index=True)
+    avg_rank = models.FloatField(null=True)
+    top4_rate = models.FloatField(null=True)
+    win_rate = models.FloatField(null=True)
+    pick_rate = models.FloatField(null=True)
+    units = models.JSONField(default=list, blank=True)
+    traits = models.JSONField(default=list, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ['tier', 'avg_rank']
+
+    def __str__(self):
+        return self.name
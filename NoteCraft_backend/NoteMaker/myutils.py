@@ -13,6 +13,12 @@ except ImportError:
 from requests.exceptions import RequestException
 from django.core.cache import cache
 import random
+from .embedding_cache import get_embeddings
+from . import llm_gateway
+from .vector_store import get_vector_store
+from . import docstore
+from .namespaces import normalize_namespace
+from .metrics import record_matches, stage
 load_dotenv()
 global gis
 if GoogleImagesSearch:
@@ -20,12 +26,12 @@ if GoogleImagesSearch:
 else:
     gis = None
 
-OR_API_KEY=os.getenv("OPEN_ROUTER_API_KEY")
 try:
     pc = Pinecone(api_key=os.getenv("PINECONE_API_KEY"))
-    index = pc.Index("teamfight-tactics-knowledges")
+    index = get_vector_store()
 except Exception as e:
     print(f"Warning: Pinecone initialization failed: {e}")
+    pc = None
     index = None
 
 topics_query:str="Generate key gameplay aspects for Teamfight Tactics (Golden Spatula) related to this topic. " \
@@ -36,49 +42,34 @@ topics_query:str="Generate key gameplay aspects for Teamfight Tactics (Golden Sp
     "eg-{'namespace': 'compositions', 'topics': ['level_8_board', 'carry_items', ....]}"\
     "namespace list-compositions,items,champions,traits,augments,economy_leveling,positioning,patch_notes,game_mechanics"
 
-def request_OpenRouter(query:str)->str:
-    response = requests.post(
-        url="https://api.deepseek.com/chat/completions",
-        headers={
-            "Authorization": f"Bearer {OR_API_KEY}",
-            "Content-Type": "application/json",
-        },
-        data=json.dumps({
-            "model": "deepseek-chat",
-            "messages": [
-            {
-                "role": "user",
-                "content": f"{query}"
-            }
-            ],
-            "parameters": {
-        "language": "en"  # Specify language preference
-    }
-
-        })
-        )
-    return response.json()['choices'][0]['message']['content']
+def request_OpenRouter(query:str,timeout:float=llm_gateway.LLM_TIMEOUT_SECONDS)->str:
+    # Pooled connection, per-call timeout, retries and circuit breaker live in llm_gateway
+    return llm_gateway.complete(query,timeout=timeout)
 
 
 
 def get_context(topic:str,namespace:str)->Dict:
 
+    namespace=normalize_namespace(namespace)
     try:
-        query_embedding=pc.inference.embed(
-                model="llama-text-embed-v2",
-                inputs=[topic],
-                parameters={"input_type": "query"},
-            )[0].values
-        results = index.query(
-                namespace=namespace,
-                vector=query_embedding,
-                top_k=3,
-                include_metadata=True
-            )
-        if results.matches: # type: ignore
-                # Fetch relevant documents from Pinecone
+        with stage("generate_note", "embed"):
+            query_embedding=get_embeddings(pc,[topic],input_type="query")[0]
+        if query_embedding is None:
+            return {"message": "Error querying Pinecone", "error": "Failed to embed topic"}
+        with stage("generate_note", "vector_search", namespace=namespace, top_k=3):
+            matches = index.query(
+                    namespace=namespace,
+                    vector=query_embedding,
+                    top_k=3,
+                    include_metadata=False
+                )
+        with stage("generate_note", "hydrate"):
+            matches = docstore.hydrate(matches, index, namespace)
+        record_matches("generate_note", "vector_search", len(matches))
+        if matches:
+                # Fetch relevant documents from the vector store
                 relevant_docs = [
-                    match.metadata["text"] for match in results.matches # type: ignore
+                    match["metadata"]["text"] for match in matches
                 ]
                 return {"message": "Relevant documents found", "documents": relevant_docs}
         else:
@@ -0,0 +1,121 @@
+"""
+Namespace layout of the knowledge base.
+
+Records are partitioned by the taxonomy of script.py so a search only scans
+the relevant part of the index. namespace_for() picks the namespace of a
+record at upsert time from its "type"/"category" metadata; route_query() picks
+the one to three namespaces a (sub-)query is searched in, from the glossary
+entities it mentions and a few keyword rules. Documents uploaded by users go
+to UPLOAD_NAMESPACE, which is searched for every query.
+
+This module does not import Django so the offline scripts can use it.
+"""
+import os
+import re
+
+from .glossary import get_glossary
+
+NAMESPACES = (
+    "compositions",
+    "items",
+    "champions",
+    "traits",
+    "augments",
+    "game_mechanics",
+    "patch_notes",
+)
+
+# Tutorials, guides, videos and other general knowledge
+GENERAL_NAMESPACE = "game_mechanics"
+
+# Names the note generation prompt (myutils.topics_query) may produce
+NAMESPACE_ALIASES = {
+    "economy_leveling": "game_mechanics",
+    "positioning": "compositions",
+}
+
+# Lowercased "type" or "category" metadata value -> namespace
+_RECORD_NAMESPACES = {
+    "champion": "champions",
+    "tft_champion_stats": "champions",
+    "item": "items",
+    "tft_item_stats": "items",
+    "augment": "augments",
+    "composition": "compositions",
+    "tft_comp_stats": "compositions",
+    "trait": "traits",
+    "patch_notes": "patch_notes",
+}
+
+# Glossary entity type -> namespace
+_ENTITY_NAMESPACES = {
+    "champion": "champions",
+    "item": "items",
+    "augment": "augments",
+    "trait": "traits",
+    "composition": "compositions",
+}
+
+_KEYWORD_RULES = [
+    (re.compile(r"装备|出装|神器|光明|合成|散件"), "items"),
+    (re.compile(r"阵容|运营|站位|上分|吃鸡|玩法"), "compositions"),
+    (re.compile(r"海克斯|强化符文|符文"), "augments"),
+    (re.compile(r"羁绊|纹章|转职"), "traits"),
+    (re.compile(r"\d\s*费|英雄|弈子|棋子|技能|卡牌"), "champions"),
+    (re.compile(r"经济|利息|等级|升级|人口|搜牌|概率|刷新|连胜|连败|机制|选秀|商店"), "game_mechanics"),
+    (re.compile(r"版本|补丁|更新|削弱|加强|改动|patch", re.IGNORECASE), "patch_notes"),
+]
+
+MAX_ROUTED_NAMESPACES = int(os.getenv("MAX_ROUTED_NAMESPACES", "3"))
+# Uploaded PDFs are patch notes and guides for the current set
+UPLOAD_NAMESPACE = os.getenv("UPLOAD_NAMESPACE", "patch_notes")
+# Searched when a query gives no routing signal at all
+ROUTING_FALLBACK_NAMESPACES = [
+    ns for ns in os.getenv("ROUTING_FALLBACK_NAMESPACES", "game_mechanics,patch_notes").split(",") if ns
+]
+
+
+def normalize_namespace(namespace: str) -> str:
+    """Maps prompt aliases onto the taxonomy; unknown names are returned unchanged."""
+    return NAMESPACE_ALIASES.get(namespace, namespace)
+
+
+def namespace_for(metadata: dict, default: str = GENERAL_NAMESPACE) -> str:
+    """Namespace of a record from its "type" metadata, then its "category"."""
+    for field in ("type", "category"):
+        namespace = _RECORD_NAMESPACES.get(str(metadata.get(field, "")).strip().lower())
+        if namespace:
+            return namespace
+    return default
+
+
+def route_query(query: str) -> list:
+    """
+    Returns the one to MAX_ROUTED_NAMESPACES namespaces to search for a query,
+    most relevant first, plus UPLOAD_NAMESPACE if it was not picked.
+    Recognized entities weigh more than keywords.
+    """
+    scores = {}
+    try:
+        entities = get_glossary().extract_entities(query)
+    except Exception as e:
+        print(f"Glossary extraction failed during routing: {e}")
+        entities = []
+    for _, entity_type in entities:
+        namespace = _ENTITY_NAMESPACES.get(entity_type)
+        if namespace:
+            scores[namespace] = scores.get(namespace, 0) + 2
+    for pattern, namespace in _KEYWORD_RULES:
+        if pattern.search(query):
+            scores[namespace] = scores.get(namespace, 0) + 1
+
+    if not scores:
+        routes = list(ROUTING_FALLBACK_NAMESPACES)
+    else:
+        # Ties keep the taxonomy order
+        ranked = sorted(scores, key=lambda ns: (-scores[ns], NAMESPACES.index(ns)))
+        routes = ranked[:MAX_ROUTED_NAMESPACES]
+    # User uploads are not classified, so any query may need them
+    if UPLOAD_NAMESPACE not in routes:
+        routes.append(UPLOAD_NAMESPACE)
+    return routes
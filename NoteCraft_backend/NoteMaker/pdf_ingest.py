@@ -0,0 +1,347 @@
+"""
+Streaming PDF ingestion.
+
+ingest_pdf() reads a PDF one page at a time, splits the text incrementally
+(the unfinished last chunk of a page is carried into the next one, so chunks
+and their overlap cross page boundaries) and hands fixed-size batches of chunks to the caller's
+thread through a bounded queue. That thread embeds and upserts each batch
+while the producer thread is still parsing later pages, so peak memory is
+bounded by INGEST_BATCH_SIZE * (INGEST_QUEUE_BATCHES + 2) chunks rather than
+by the size of the document.
+
+Progress callbacks and the embed/upsert calls all run on the caller's thread
+(Celery keeps the current task's request in a thread local).
+
+Text extraction is CPU-bound. For documents of at least
+INGEST_PARALLEL_MIN_PAGES pages, blocks of pages are extracted by a pool of
+INGEST_EXTRACT_WORKERS processes, each with its own fitz document, and
+yielded in page order. Daemonic processes cannot have children, so Celery's
+prefork pool children (which already ingest documents in parallel) extract
+sequentially; run the worker with --pool threads to use the process pool.
+
+This module does not import Django.
+"""
+import contextvars
+import multiprocessing
+import os
+import queue
+import tempfile
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import fitz
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+from . import docstore, lexical_index
+from .chunk_embedding_cache import EMBED_MODEL, CacheRunStats, embed_passages
+from .metrics import observe_stage, record_matches, stage
+
+CHUNK_SIZE = 1000
+CHUNK_OVERLAP = 200
+# Pinecone inference accepts at most 96 passages per embed call
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "96"))
+# Parsed batches waiting to be embedded; the parser blocks when the queue is full
+INGEST_QUEUE_BATCHES = int(os.getenv("INGEST_QUEUE_BATCHES", "2"))
+INGEST_EXTRACT_WORKERS = int(os.getenv("INGEST_EXTRACT_WORKERS", str(min(8, os.cpu_count() or 1))))
+INGEST_PARALLEL_MIN_PAGES = int(os.getenv("INGEST_PARALLEL_MIN_PAGES", "64"))
+# Pages per extraction job; each worker keeps its document open between jobs
+INGEST_EXTRACT_BLOCK_PAGES = int(os.getenv("INGEST_EXTRACT_BLOCK_PAGES", "8"))
+
+
+def open_pdf(pdf):
+    """A fitz document for a path or for the PDF's bytes."""
+    return fitz.open(pdf) if isinstance(pdf, str) else fitz.open(stream=pdf, filetype="pdf")
+
+
+def iter_pdf_pages(pdf):
+    """
+    Yields (page number, text) one page at a time, in order; pages are
+    numbered from 0. Large documents are extracted by the process pool.
+    """
+    with open_pdf(pdf) as doc:
+        workers = extract_workers()
+        if workers < 2 or doc.page_count < INGEST_PARALLEL_MIN_PAGES:
+            for number in range(doc.page_count):
+                yield number, doc.load_page(number).get_text()
+            return
+        page_count = doc.page_count
+    yield from _iter_pages_parallel(pdf, page_count, workers)
+
+
+def extract_workers() -> int:
+    """Extraction processes this process may use; 1 means sequential."""
+    if INGEST_EXTRACT_WORKERS < 2:
+        return 1
+    # Celery prefork children are daemonic and may not start processes
+    if multiprocessing.current_process().daemon:
+        return 1
+    return INGEST_EXTRACT_WORKERS
+
+
+_extract_pool = None
+_extract_pool_lock = threading.Lock()
+
+
+def _get_extract_pool(workers: int) -> ProcessPoolExecutor:
+    global _extract_pool
+    with _extract_pool_lock:
+        if _extract_pool is None:
+            # spawn: forking a process that runs threads (uvicorn, the ingest producer) is unsafe
+            _extract_pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+        return _extract_pool
+
+
+# The document opened by this extraction worker process: (ingestion id, fitz document)
+_worker_doc = (None, None)
+
+
+def _extract_pages(job: str, path: str, start: int, stop: int) -> list:
+    """Runs in an extraction worker: [(page number, text)] of pages start..stop-1."""
+    global _worker_doc
+    if _worker_doc[0] != job:
+        if _worker_doc[1] is not None:
+            _worker_doc[1].close()
+        _worker_doc = (job, fitz.open(path))
+    doc = _worker_doc[1]
+    return [(number, doc.load_page(number).get_text()) for number in range(start, stop)]
+
+
+def _iter_pages_parallel(pdf, page_count: int, workers: int):
+    # Workers open the file themselves rather than receiving the bytes with every job
+    temp_path = None
+    if not isinstance(pdf, str):
+        with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as temp_pdf:
+            temp_pdf.write(pdf)
+            temp_path = temp_pdf.name
+    path = temp_path or pdf
+    job = uuid.uuid4().hex
+    pending = deque()
+    try:
+        pool = _get_extract_pool(workers)
+        blocks = iter(range(0, page_count, INGEST_EXTRACT_BLOCK_PAGES))
+
+        def submit_next():
+            start = next(blocks, None)
+            if start is not None:
+                stop = min(start + INGEST_EXTRACT_BLOCK_PAGES, page_count)
+                pending.append(pool.submit(_extract_pages, job, path, start, stop))
+
+        # A bounded window of jobs keeps the extracted text ahead of chunking, not the whole document
+        for _ in range(2 * workers):
+            submit_next()
+        while pending:
+            pages = pending.popleft().result()
+            submit_next()
+            yield from pages
+    finally:
+        # Ingestion stopped early: drop the jobs not started yet
+        for future in pending:
+            future.cancel()
+        if temp_path:
+            os.remove(temp_path)
+
+
+def iter_chunks(pages, chunk_size: int = CHUNK_SIZE, chunk_overlap: int = CHUNK_OVERLAP):
+    """
+    Yields (page number, chunk text) for (page number, text) pages. Each chunk
+    is attributed to the page it starts on.
+    """
+    splitter = RecursiveCharacterTextSplitter(
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap,
+        add_start_index=True
+    )
+    carry, carry_page = "", None
+    for number, text in pages:
+        if not text.strip():
+            continue
+        buffer = f"{carry}\n{text}" if carry else text
+        pieces = splitter.create_documents([buffer])
+        page_of = lambda piece: carry_page if carry and piece.metadata["start_index"] < len(carry) else number
+        for piece in pieces[:-1]:
+            yield page_of(piece), piece.page_content
+        # The last chunk may continue on the next page; split it again with that page
+        carry, carry_page = pieces[-1].page_content, page_of(pieces[-1])
+    if carry:
+        yield carry_page, carry
+
+
+_DONE = object()
+
+
+class _Stopped(Exception):
+    pass
+
+
+class _Producer:
+    """Parses and chunks a PDF on its own thread, putting (chunk batch, pages parsed) on a bounded queue."""
+
+    def __init__(self, pdf, batch_size: int):
+        self.pdf = pdf
+        self.batch_size = batch_size
+        self.batches = queue.Queue(maxsize=max(1, INGEST_QUEUE_BATCHES))
+        self.stop = threading.Event()
+        self.pages_parsed = 0
+        self.extract_seconds = 0.0
+        self.chunk_seconds = 0.0
+        # A copy of the caller's context, so its stage timings reach the same trace
+        self.thread = threading.Thread(
+            target=contextvars.copy_context().run, args=(self.run,),
+            name="pdf-ingest", daemon=True
+        )
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def pages(self):
+        for page in iter_pdf_pages(self.pdf):
+            self.pages_parsed += 1
+            yield page
+
+    def timed(self, iterator, attribute: str):
+        # Accumulates the time spent producing each item of iterator
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                setattr(self, attribute, getattr(self, attribute) + time.perf_counter() - start)
+            yield item
+
+    def run(self):
+        try:
+            pages = self.timed(self.pages(), "extract_seconds")
+            batch = []
+            for chunk in self.timed(iter_chunks(pages), "chunk_seconds"):
+                batch.append(chunk)
+                if len(batch) >= self.batch_size:
+                    self.put((batch, self.pages_parsed))
+                    batch = []
+            self.put((batch, self.pages_parsed))
+            self.put(_DONE)
+        except _Stopped:
+            return
+        except BaseException as e:
+            try:
+                self.put(e)
+            except _Stopped:
+                return
+
+    def put(self, item):
+        # Stops parsing once the consumer has given up (e.g. an embed call failed)
+        while not self.stop.is_set():
+            try:
+                self.batches.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+        raise _Stopped()
+
+    def __iter__(self):
+        while True:
+            item = self.batches.get()
+            if item is _DONE:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+
+    def close(self):
+        self.stop.set()
+        self.thread.join()
+
+
+def delete_stale_chunks(store, namespace: str, id_prefix: str, chunk_count: int) -> int:
+    """
+    Deletes the "<id_prefix>_<n>" chunks with n >= chunk_count from the
+    docstore, the lexical index and the vector store. Returns how many.
+    """
+    stale = []
+    for doc_id in docstore.ids_with_prefix(f"{id_prefix}_", namespace=namespace):
+        suffix = doc_id[len(id_prefix) + 1:]
+        if suffix.isdigit() and int(suffix) >= chunk_count:
+            stale.append(doc_id)
+    if not stale:
+        return 0
+    # Vectors first, so a search never finds a vector without its chunk
+    with stage("ingest", "delete_stale", chunks=len(stale), namespace=namespace):
+        for i in range(0, len(stale), 1000):
+            store.delete(stale[i:i + 1000], namespace=namespace)
+        lexical_index.delete_chunks(stale)
+        docstore.delete_documents(stale)
+    print(f"Deleted {len(stale)} stale chunks of {id_prefix} from {namespace}")
+    return len(stale)
+
+
+def ingest_pdf(pc, store, pdf, namespace: str, metadata: dict = None, id_prefix: str = None,
+               on_progress=None, batch_size: int = INGEST_BATCH_SIZE, cache_stats: CacheRunStats = None) -> int:
+    """
+    Streams a PDF (path or bytes) into `namespace`: each chunk is embedded
+    and stored once, with metadata added to it. With id_prefix the chunk ids
+    are "<id_prefix>_<n>", so indexing the same document again replaces them.
+    Chunks left over from a longer earlier version of the document are
+    deleted. on_progress(event, count) is called with "pages", "chunks",
+    "embedded" and "upserted" increments. Chunk embedding cache hits are added to
+    cache_stats. Returns the number of chunks.
+    """
+    cache_stats = cache_stats if cache_stats is not None else CacheRunStats()
+    report = on_progress or (lambda event, count: None)
+    source = pdf if isinstance(pdf, str) else "upload"
+    metadata = {"source": source, **(metadata or {})}
+
+    producer = _Producer(pdf, batch_size).start()
+    chunk_count = 0
+    pages_reported = 0
+    try:
+        for batch, pages_parsed in producer:
+            report("pages", pages_parsed - pages_reported)
+            pages_reported = pages_parsed
+            if not batch:
+                continue
+            report("chunks", len(batch))
+            batch_texts = [text for _, text in batch]
+
+            # Unchanged chunks come from the chunk embedding cache, the rest from Pinecone inference
+            with stage("ingest", "embed", batch_size=len(batch_texts)):
+                embeddings = embed_passages(pc, batch_texts, model=EMBED_MODEL, stats=cache_stats)
+            report("embedded", len(batch_texts))
+
+            vectors = []
+            documents = []
+            for (page, text), embedding in zip(batch, embeddings):
+                doc_id = f"{id_prefix}_{chunk_count}" if id_prefix else str(uuid.uuid4())
+                chunk_count += 1
+                # The text goes to the docstore, not the vector
+                document, vector_metadata = docstore.split_metadata({**metadata, "text": text, "page": page})
+                documents.append({"id": doc_id, **document})
+                vectors.append({
+                    "id": doc_id,
+                    "values": embedding,
+                    "metadata": vector_metadata
+                })
+
+            # Text first, so a search never finds a vector without its chunk
+            with stage("ingest", "upsert", batch_size=len(vectors), namespace=namespace):
+                docstore.put_documents(documents, namespace=namespace)
+                lexical_index.add_chunks(documents, namespace=namespace)
+                store.upsert(vectors, namespace=namespace)
+            report("upserted", len(vectors))
+    finally:
+        producer.close()
+        # Parsing overlapped with embedding; these are its own busy times
+        observe_stage("ingest", "extract", producer.extract_seconds)
+        # Chunking pulls the pages, so its time includes their extraction
+        observe_stage("ingest", "chunk", max(0.0, producer.chunk_seconds - producer.extract_seconds))
+
+    if id_prefix:
+        delete_stale_chunks(store, namespace, id_prefix, chunk_count)
+    record_matches("ingest", "chunk", chunk_count)
+    print(f"Ingested {chunk_count} chunks from {producer.pages_parsed} pages of {metadata['source']} into {namespace}")
+    print(f"  {cache_stats.summary()}")
+    return chunk_count
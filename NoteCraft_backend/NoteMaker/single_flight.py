@@ -0,0 +1,267 @@
+"""
+Coalescing of identical concurrent /ask_ai/ and /generate_note/ requests.
+
+When a patch drops, many users ask the same question within seconds. Requests
+are keyed by their normalized query (embedding_cache.normalize_text), and only
+the first one runs the pipeline:
+
+- ask_ai: inside a process, later callers await the leader's asyncio task.
+  Across uvicorn workers, the leader holds a short Redis lock and publishes
+  its result under a result key, which followers in other workers poll. A
+  follower whose leader fails or disappears runs the pipeline itself.
+- generate_note: the task id of an unfinished generate_notes_task is stored
+  under the query's key, and identical requests get the same task id to poll.
+  Every caller holds a reference; cancelling only revokes the task once no
+  other caller is waiting for it.
+
+Callers still persist their own Message rows; only the upstream work is
+shared. Without Redis, coalescing is per process.
+
+This module does not import Django.
+"""
+import asyncio
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+import weakref
+
+from . import tracing
+from .embedding_cache import get_redis, mark_redis_failed, normalize_text
+
+SINGLE_FLIGHT_ENABLED = os.getenv("SINGLE_FLIGHT_ENABLED", "True") == "True"
+# Longest a follower waits for another worker's result before computing itself
+SINGLE_FLIGHT_WAIT_SECONDS = float(os.getenv("SINGLE_FLIGHT_WAIT_SECONDS", "90"))
+# Lock lifetime; bounds how long a crashed leader blocks followers
+SINGLE_FLIGHT_LOCK_SECONDS = float(os.getenv("SINGLE_FLIGHT_LOCK_SECONDS", "120"))
+# How long a finished result is served to followers that are still polling
+SINGLE_FLIGHT_RESULT_SECONDS = int(os.getenv("SINGLE_FLIGHT_RESULT_SECONDS", "10"))
+SINGLE_FLIGHT_POLL_SECONDS = 0.2
+# Longest a note generation is shared; matches a generous notes run
+SINGLE_FLIGHT_TASK_SECONDS = int(os.getenv("SINGLE_FLIGHT_TASK_SECONDS", "600"))
+
+KEY_PREFIX = "notecraft:single_flight"
+
+_stats = {"leaders": 0, "followers": 0, "remote_followers": 0, "remote_fallbacks": 0,
+          "task_leaders": 0, "task_followers": 0}
+_stats_lock = threading.Lock()
+
+
+def _count(name: str):
+    with _stats_lock:
+        _stats[name] += 1
+
+
+def single_flight_stats() -> dict:
+    """Coalescing counters since process start."""
+    with _stats_lock:
+        stats = dict(_stats)
+    requests = stats["leaders"] + stats["followers"] + stats["remote_followers"]
+    stats["coalesced_rate"] = round((stats["followers"] + stats["remote_followers"]) / requests, 4) if requests else 0.0
+    return stats
+
+
+def coalesce_key(kind: str, query: str) -> str:
+    digest = hashlib.sha1(normalize_text(query).encode("utf-8")).hexdigest()
+    return f"{KEY_PREFIX}:{kind}:{digest}"
+
+
+# --- ask_ai ---
+
+# In-flight leader tasks per event loop (one loop per uvicorn worker)
+_inflight = weakref.WeakKeyDictionary()
+
+
+async def coalesce(kind: str, query: str, compute):
+    """
+    Returns the result of `await compute()`, sharing one computation among
+    concurrent callers with the same normalized query. The result must be
+    JSON-serializable so it can be handed to other workers.
+    """
+    if not SINGLE_FLIGHT_ENABLED:
+        return await compute()
+    key = coalesce_key(kind, query)
+    inflight = _inflight.setdefault(asyncio.get_running_loop(), {})
+    task = inflight.get(key)
+    if task is not None:
+        _count("followers")
+        tracing.set_attributes({"single_flight.role": "follower"})
+        # Shielded: a follower that disconnects must not cancel the leader
+        return await asyncio.shield(task)
+
+    task = asyncio.ensure_future(_lead(key, compute))
+    inflight[key] = task
+    task.add_done_callback(lambda _: inflight.pop(key, None))
+    return await asyncio.shield(task)
+
+
+async def _lead(key: str, compute):
+    """Runs compute() for this process, first waiting for another worker already running it."""
+    lock_key, result_key = f"{key}:lock", f"{key}:result"
+    token = uuid.uuid4().hex
+    client = get_redis()
+    locked = False
+    if client is not None:
+        try:
+            locked = await asyncio.to_thread(
+                client.set, lock_key, token, nx=True, px=int(SINGLE_FLIGHT_LOCK_SECONDS * 1000)
+            )
+        except Exception as e:
+            mark_redis_failed(e)
+            client = None
+
+    if client is not None and not locked:
+        result = await _wait_for_remote(client, lock_key, result_key)
+        if result is not None:
+            _count("remote_followers")
+            tracing.set_attributes({"single_flight.role": "remote_follower"})
+            return result
+        _count("remote_fallbacks")
+
+    _count("leaders")
+    tracing.set_attributes({"single_flight.role": "leader"})
+    try:
+        result = await compute()
+        if locked:
+            await asyncio.to_thread(_publish, client, result_key, result)
+        return result
+    finally:
+        if locked:
+            await asyncio.to_thread(_release, client, lock_key, token)
+
+
+async def _wait_for_remote(client, lock_key: str, result_key: str):
+    """Polls for another worker's result; None when it fails, its lock expires or the wait times out."""
+    deadline = time.monotonic() + SINGLE_FLIGHT_WAIT_SECONDS
+    while time.monotonic() < deadline:
+        try:
+            pipe = client.pipeline(transaction=False)
+            pipe.get(result_key)
+            pipe.exists(lock_key)
+            result, lock_held = await asyncio.to_thread(pipe.execute)
+        except Exception as e:
+            mark_redis_failed(e)
+            return None
+        if result is not None:
+            return json.loads(result)
+        if not lock_held:
+            return None
+        await asyncio.sleep(SINGLE_FLIGHT_POLL_SECONDS)
+    return None
+
+
+def _publish(client, result_key: str, result):
+    try:
+        client.set(result_key, json.dumps(result, ensure_ascii=False, default=str), ex=SINGLE_FLIGHT_RESULT_SECONDS)
+    except Exception as e:
+        mark_redis_failed(e)
+
+
+def _release(client, lock_key: str, token: str):
+    # Only delete our own lock; it may have expired and been taken over
+    try:
+        if client.get(lock_key) == token.encode():
+            client.delete(lock_key)
+    except Exception as e:
+        mark_redis_failed(e)
+
+
+# --- generate_note ---
+
+# Without Redis: key -> (task id, enqueued at) and task id -> [key, references], per process
+_local_tasks = {}
+_local_refs = {}
+_tasks_lock = threading.Lock()
+
+
+def shared_task_id(query: str, is_running, enqueue) -> str:
+    """
+    Returns the id of an unfinished task for the same normalized query, or
+    the id of a new task from enqueue(). is_running(task_id) tells whether a
+    stored task id is still worth waiting for.
+    """
+    if not SINGLE_FLIGHT_ENABLED:
+        return enqueue()
+    key = coalesce_key("generate_note", query)
+    client = get_redis()
+    if client is not None:
+        try:
+            return _shared_task_id_redis(client, key, is_running, enqueue)
+        except Exception as e:
+            mark_redis_failed(e)
+
+    with _tasks_lock:
+        task_id, enqueued = _local_tasks.get(key, (None, 0.0))
+        # An unknown id also reads as PENDING, so entries expire like the Redis keys
+        fresh = time.monotonic() - enqueued < SINGLE_FLIGHT_TASK_SECONDS
+        if task_id is not None and fresh and is_running(task_id):
+            _local_refs[task_id][1] += 1
+            _count("task_followers")
+            return task_id
+        if task_id is not None:
+            _local_refs.pop(task_id, None)
+        task_id = enqueue()
+        _local_tasks[key] = (task_id, time.monotonic())
+        _local_refs[task_id] = [key, 1]
+        _count("task_leaders")
+        return task_id
+
+
+def _shared_task_id_redis(client, key: str, is_running, enqueue) -> str:
+    task_id = client.get(key)
+    if task_id is not None:
+        task_id = task_id.decode()
+        if is_running(task_id):
+            client.incr(f"{KEY_PREFIX}:task:{task_id}:refs")
+            _count("task_followers")
+            return task_id
+    # Two workers racing here both enqueue; the later id wins the key, which only costs one duplicate run
+    task_id = enqueue()
+    pipe = client.pipeline(transaction=False)
+    pipe.set(key, task_id, ex=SINGLE_FLIGHT_TASK_SECONDS)
+    pipe.set(f"{KEY_PREFIX}:task:{task_id}:refs", 1, ex=SINGLE_FLIGHT_TASK_SECONDS)
+    pipe.execute()
+    _count("task_leaders")
+    return task_id
+
+
+# Decrements a task's reference count, keeping its expiry; a missing key (a
+# task that was never shared, or whose count expired) is not recreated
+_RELEASE_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+  return 0
+end
+local remaining = redis.call('DECR', KEYS[1])
+if remaining <= 0 then
+  redis.call('DEL', KEYS[1])
+  return 0
+end
+return remaining
+"""
+
+
+def release_task(task_id: str) -> int:
+    """
+    Drops one caller's reference to a shared task. Returns how many callers
+    are still waiting for it; the task should only be revoked at zero.
+    """
+    client = get_redis()
+    if client is not None:
+        try:
+            return int(client.eval(_RELEASE_SCRIPT, 1, f"{KEY_PREFIX}:task:{task_id}:refs"))
+        except Exception as e:
+            mark_redis_failed(e)
+
+    with _tasks_lock:
+        entry = _local_refs.get(task_id)
+        if entry is None:
+            return 0
+        entry[1] -= 1
+        if entry[1] > 0:
+            return entry[1]
+        _local_refs.pop(task_id, None)
+        if _local_tasks.get(entry[0], (None,))[0] == task_id:
+            _local_tasks.pop(entry[0], None)
+        return 0
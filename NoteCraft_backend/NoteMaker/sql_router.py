@@ -0,0 +1,229 @@
+"""
+Exact-lookup fast path for query_ai.
+
+Enumerations ("5费卡有哪些", "法师羁绊有哪些英雄", "棱彩海克斯有哪些",
+"最强阵容") and attribute lookups about a single champion, item or augment
+("阿狸带什么装备", "无尽之刃怎么合成") are answered from the structured entity
+tables with one indexed query. The answer is rendered from a template, or,
+with SQL_ROUTER_FORMAT_WITH_LLM, polished by a small LLM call that sees only
+the query result. Anything else (comparisons, open-ended questions, entities
+missing from the tables) returns None and goes through RAG.
+"""
+import os
+import re
+
+from langchain_core.messages import HumanMessage, SystemMessage
+
+from . import llm_gateway
+from .glossary import get_glossary
+from .models import Augment, Champion, Composition, Item
+from .prompts import FORMAT_PROMPT
+
+SQL_ROUTER_ENABLED = os.getenv("SQL_ROUTER_ENABLED", "True") == "True"
+SQL_ROUTER_FORMAT_WITH_LLM = os.getenv("SQL_ROUTER_FORMAT_WITH_LLM", "False") == "True"
+SQL_ROUTER_FORMAT_TIMEOUT_SECONDS = float(os.getenv("SQL_ROUTER_FORMAT_TIMEOUT_SECONDS", "15"))
+TOP_COMPOSITIONS = 10
+
+_LIST_RE = re.compile(r"有哪些|有什么|有哪几|哪几个|都有谁|都有|列表|列出|包括|包含")
+_COST_RE = re.compile(r"([1-5])\s*费")
+_QUALITY_RE = re.compile(r"白银|黄金|棱彩")
+_AUGMENT_WORD_RE = re.compile(r"海克斯|强化符文|符文")
+_TOP_COMPS_RE = re.compile(r"(?:最强|强势|热门|上分|推荐|T0|T1)\s*的?阵容|阵容(?:排行|推荐|梯度|榜)", re.IGNORECASE)
+# Comparisons and opinions need reasoning over several sources
+_OPEN_ENDED_RE = re.compile(r"还是|哪个好|哪个强|比较|对比|为什么|怎么玩|思路|克制")
+
+_CHAMPION_ATTRIBUTES = [
+    (re.compile(r"几费|费用|多少费"), "cost"),
+    (re.compile(r"羁绊|职业|种族"), "traits"),
+    (re.compile(r"出装|装备|带什么|神装"), "items"),
+    (re.compile(r"技能|大招"), "skill"),
+    (re.compile(r"胜率|登顶率|前四率|吃鸡率|平均排名|数据|强度"), "stats"),
+    (re.compile(r"属性|血量|攻击力|护甲|魔抗|攻速"), "base_stats"),
+]
+_ITEM_ATTRIBUTES = [
+    (re.compile(r"合成|配方|怎么做|散件"), "recipe"),
+    (re.compile(r"谁用|给谁|适合|哪些英雄|推荐英雄"), "champions"),
+    (re.compile(r"胜率|登顶率|前四率|吃鸡率|平均排名|数据|强度"), "stats"),
+]
+_AUGMENT_ATTRIBUTES = [
+    (re.compile(r"效果|什么用|干什么|是什么|介绍|品质|等级"), "effect"),
+]
+
+
+def _rate(value) -> str:
+    return f"{value:.1%}" if value is not None else "暂无"
+
+
+def _number(value) -> str:
+    return f"{value:g}" if value is not None else "暂无"
+
+
+def _stats_line(obj) -> str:
+    return (
+        f"平均排名 {_number(obj.avg_rank)}，前四率 {_rate(obj.top4_rate)}，"
+        f"登顶率 {_rate(obj.win_rate)}"
+    )
+
+
+def _champion_list(champions, title: str):
+    champions = list(champions)
+    if not champions:
+        return None
+    lines = [f"**{title}**（共 {len(champions)} 个）："]
+    for c in champions:
+        traits = "、".join(t.name for t in c.traits.all()) or "暂无羁绊信息"
+        lines.append(f"- **{c.name}**（{c.cost}费）：{traits}，平均排名 {_number(c.avg_rank)}")
+    return "\n".join(lines)
+
+
+def _augment_list(quality: str):
+    augments = list(Augment.objects.filter(quality=quality))
+    if not augments:
+        return None
+    lines = [f"**{quality}海克斯强化**（共 {len(augments)} 个）："]
+    lines.extend(f"- **{a.name}**：{a.effect}" for a in augments)
+    return "\n".join(lines)
+
+
+def _top_compositions():
+    compositions = list(Composition.objects.all()[:TOP_COMPOSITIONS])
+    if not compositions:
+        return None
+    lines = ["**当前强势阵容**："]
+    for comp in compositions:
+        units = "、".join(u.get("name", "") for u in comp.units if isinstance(u, dict)) or "暂无"
+        lines.append(f"- **{comp.name}**（{comp.tier or '-'}）：{_stats_line(comp)}。核心英雄：{units}")
+    return "\n".join(lines)
+
+
+def _champion_attribute(name: str, attribute: str):
+    champion = Champion.objects.filter(name=name).prefetch_related("traits").first()
+    if champion is None:
+        return None
+    if attribute == "cost":
+        return f"**{champion.name}** 是 {champion.cost} 费英雄。"
+    if attribute == "traits":
+        traits = "、".join(t.name for t in champion.traits.all()) or "暂无羁绊信息"
+        return f"**{champion.name}** 的羁绊：{traits}。"
+    if attribute == "items":
+        items = "、".join(champion.recommended_items) or "暂无数据"
+        return f"**{champion.name}** 推荐装备：{items}。"
+    if attribute == "skill":
+        return f"**{champion.name}** 的技能：{champion.skill_description or '暂无详细描述'}"
+    if attribute == "base_stats":
+        stats = "，".join(f"{k}: {v}" for k, v in champion.base_stats.items()) or "暂无基础属性"
+        return f"**{champion.name}** 的基础属性：{stats}。"
+    return f"**{champion.name}**（{champion.cost}费）：{_stats_line(champion)}。"
+
+
+def _item_attribute(name: str, attribute: str):
+    item = Item.objects.filter(name=name).first()
+    if item is None:
+        return None
+    if attribute == "recipe":
+        return f"**{item.name}** 的合成公式：{item.recipe or '无/不可合成'}。"
+    if attribute == "champions":
+        champions = "、".join(item.recommended_champions) or "暂无数据"
+        return f"**{item.name}** 推荐给：{champions}。"
+    return f"**{item.name}**：{_stats_line(item)}。"
+
+
+def _augment_attribute(name: str, attribute: str):
+    augment = Augment.objects.filter(name=name).first()
+    if augment is None:
+        return None
+    return f"**{augment.name}**（{augment.quality}，{augment.hex_type}）：{augment.effect}"
+
+
+def _match_attribute(query: str, rules: list):
+    for pattern, attribute in rules:
+        if pattern.search(query):
+            return attribute
+    return None
+
+
+def lookup(query: str):
+    """
+    Returns (facts_text, source) when the question can be answered from the
+    entity tables, otherwise None.
+    """
+    if _OPEN_ENDED_RE.search(query):
+        return None
+    entities = get_glossary().extract_entities(query)
+    is_list = bool(_LIST_RE.search(query))
+
+    cost = _COST_RE.search(query)
+    if cost and is_list and not entities:
+        facts = _champion_list(
+            Champion.objects.filter(cost=int(cost.group(1))).prefetch_related("traits"),
+            f"{cost.group(1)}费英雄"
+        )
+        return (facts, "structured:champions") if facts else None
+
+    quality = _QUALITY_RE.search(query)
+    if quality and is_list and _AUGMENT_WORD_RE.search(query) and not entities:
+        facts = _augment_list(quality.group())
+        return (facts, "structured:augments") if facts else None
+
+    if _TOP_COMPS_RE.search(query) and not entities:
+        facts = _top_compositions()
+        return (facts, "structured:compositions") if facts else None
+
+    if len(entities) != 1:
+        return None
+    name, entity_type = entities[0]
+
+    if entity_type == "trait" and is_list:
+        facts = _champion_list(
+            Champion.objects.filter(traits__name=name).prefetch_related("traits"),
+            f"{name}羁绊英雄"
+        )
+        return (facts, "structured:champions") if facts else None
+
+    handlers = {
+        "champion": (_CHAMPION_ATTRIBUTES, _champion_attribute, "structured:champions"),
+        "item": (_ITEM_ATTRIBUTES, _item_attribute, "structured:items"),
+        "augment": (_AUGMENT_ATTRIBUTES, _augment_attribute, "structured:augments"),
+    }
+    if entity_type not in handlers:
+        return None
+    rules, handler, source = handlers[entity_type]
+    attribute = _match_attribute(query, rules)
+    if attribute is None:
+        return None
+    facts = handler(name, attribute)
+    return (facts, source) if facts else None
+
+
+def format_answer(query: str, facts: str) -> str:
+    """Templated facts, optionally rephrased by a small LLM call that only sees them."""
+    if not SQL_ROUTER_FORMAT_WITH_LLM:
+        return facts
+    try:
+        response = llm_gateway.invoke([
+            SystemMessage(content=FORMAT_PROMPT),
+            HumanMessage(content=f"【数据】：\n{facts}\n\n用户问题：{query}")
+        ], timeout=SQL_ROUTER_FORMAT_TIMEOUT_SECONDS)
+        return response.content
+    except Exception as e:
+        print(f"SQL router formatting failed, returning raw facts: {e}")
+        return facts
+
+
+def answer_structured(query: str):
+    """
+    Returns {"answer", "sources", "route"} when the structured fast path can
+    answer the question, otherwise None (the caller falls back to RAG).
+    """
+    if not SQL_ROUTER_ENABLED:
+        return None
+    try:
+        result = lookup(query)
+    except Exception as e:
+        print(f"SQL router failed, falling back to RAG: {e}")
+        return None
+    if result is None:
+        return None
+    facts, source = result
+    print(f"SQL router answered from {source}")
+    return {"answer": format_answer(query, facts), "sources": [source], "route": "sql"}
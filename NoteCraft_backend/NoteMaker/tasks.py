@@ -1,19 +1,30 @@
 # tasks.py
 import json
+import os
 from .myutils import get_context, google_search_image, request_OpenRouter
+from .context_packer import count_tokens
+from .metrics import record_tokens, stage
+from . import admission
 from celery import shared_task
+from celery.signals import task_postrun
+
+# Full notes are long generations; allow more time than a chat answer
+NOTES_TIMEOUT_SECONDS = float(os.getenv("NOTES_TIMEOUT_SECONDS", "180"))
 
 @shared_task
 def generate_notes_task(prompt_1:str) -> dict:
     try:
-        response_1 = request_OpenRouter(prompt_1)
+        with stage("generate_note", "topics_llm"):
+            response_1 = request_OpenRouter(prompt_1)
         # Extract JSON
         start = response_1.find("```json") + len("```json")
         end = response_1.find("```", start)
         json_str = response_1[start:end].strip()
         fresponse = json.loads(json_str)
         
-        context = get_context(prompt_1, namespace=fresponse['namespace'])
+        with stage("generate_note", "context"):
+            context = get_context(prompt_1, namespace=fresponse['namespace'])
+        record_tokens("generate_note", "context", count_tokens("".join(context.get("documents", []))))
 
         prompt_2:str= "Objective: Act as an expert Challenger-rank Teamfight Tactics (Golden Spatula) coach. " \
         f"Generate comprehensive, strategic guides on {fresponse['topics']} based on the provided context. If context is irrelevant, ignore it.\
@@ -23,7 +34,10 @@ def generate_notes_task(prompt_1:str) -> dict:
         example- &&&image:(TFT Kai'Sa positioning)&&& use 2-3 images per heading at max\
         output should be in ```markdown box keep the markup syntax the notes should have plenty text \
         examples where applicable.Context: {context}"
-        notes = request_OpenRouter(prompt_2)
+        record_tokens("generate_note", "prompt", count_tokens(prompt_2))
+        with stage("generate_note", "notes_llm"):
+            notes = request_OpenRouter(prompt_2, timeout=NOTES_TIMEOUT_SECONDS)
+        record_tokens("generate_note", "completion", count_tokens(notes))
         start = notes.find("```markdown") + len("```markdown")
         end = notes.find("```", start)
         notes = notes[start:end].strip()
@@ -33,7 +47,8 @@ def generate_notes_task(prompt_1:str) -> dict:
         for line in arr:
             if line.startswith("image:"):
                 image_query = line.split("image:", 1)[1].strip()
-                image_url = google_search_image(image_query)
+                with stage("generate_note", "image_search"):
+                    image_url = google_search_image(image_query)
                 processed_notes.append(f"![{image_query}]({image_url})")
             else:
                 processed_notes.append(line)
@@ -41,3 +56,10 @@ def generate_notes_task(prompt_1:str) -> dict:
         return {"success": True, "notes": "".join(processed_notes)}
     except Exception as e:
         return {"success": False, "error": str(e)}
+
+
+@task_postrun.connect(weak=False, dispatch_uid="admission_release_notes_task")
+def release_notes_admission(task_id=None, task=None, **kwargs):
+    # Frees the generate_note admission slot GenerateNoteView handed to this task
+    if task is not None and task.name == generate_notes_task.name:
+        admission.release_task(task_id)
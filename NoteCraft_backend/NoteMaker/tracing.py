@@ -0,0 +1,156 @@
+"""
+OpenTelemetry tracing.
+
+setup_tracing() installs a tracer provider once per process (the web workers
+and the Celery worker both call it from NotemakerConfig.ready()). The exporter
+is chosen with OTEL_TRACES_EXPORTER:
+
+- none (default): spans are not recorded, span() is a no-op;
+- otlp: OTLP/gRPC to OTEL_EXPORTER_OTLP_ENDPOINT (the standard OTel variable);
+- console: one JSON span per line on stdout;
+- file: one JSON span per line appended to OTEL_TRACES_FILE, for offline runs.
+
+Every metrics.stage() opens a span, and the embedding, vector store, LLM and
+Cloudinary calls open child spans with their parameters (top_k, namespace,
+batch size, token counts) as attributes. Request spans come from
+TracingMiddleware; instrument_celery() carries the trace context in the task
+message headers so a generate_notes_task span continues the request's trace.
+
+This module does not import Django.
+"""
+import os
+import threading
+from contextlib import contextmanager
+
+from opentelemetry import context, propagate, trace
+
+OTEL_TRACES_EXPORTER = os.getenv("OTEL_TRACES_EXPORTER", "none").lower()
+OTEL_SERVICE_NAME = os.getenv("OTEL_SERVICE_NAME", "notecraft-backend")
+OTEL_TRACES_FILE = os.getenv("OTEL_TRACES_FILE", "traces.jsonl")
+
+tracer = trace.get_tracer("notecraft")
+
+_setup_lock = threading.Lock()
+_configured = False
+
+
+def _build_exporter():
+    if OTEL_TRACES_EXPORTER == "otlp":
+        from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
+        return OTLPSpanExporter()
+    from opentelemetry.sdk.trace.export import ConsoleSpanExporter
+    formatter = lambda span: span.to_json(indent=None) + os.linesep
+    if OTEL_TRACES_EXPORTER == "console":
+        return ConsoleSpanExporter(formatter=formatter)
+    if OTEL_TRACES_EXPORTER == "file":
+        # Line buffered, so the file can be tailed while the process runs
+        return ConsoleSpanExporter(out=open(OTEL_TRACES_FILE, "a", buffering=1), formatter=formatter)
+    raise ValueError(f"Unknown OTEL_TRACES_EXPORTER: {OTEL_TRACES_EXPORTER}")
+
+
+def setup_tracing():
+    """Installs the tracer provider for OTEL_TRACES_EXPORTER; safe to call more than once."""
+    global _configured
+    if OTEL_TRACES_EXPORTER == "none":
+        return
+    with _setup_lock:
+        if _configured:
+            return
+        _configured = True
+        try:
+            from opentelemetry.sdk.resources import Resource
+            from opentelemetry.sdk.trace import TracerProvider
+            from opentelemetry.sdk.trace.export import BatchSpanProcessor
+
+            provider = TracerProvider(resource=Resource.create({"service.name": OTEL_SERVICE_NAME}))
+            provider.add_span_processor(BatchSpanProcessor(_build_exporter()))
+            trace.set_tracer_provider(provider)
+            print(f"Tracing enabled: {OTEL_TRACES_EXPORTER} exporter, service {OTEL_SERVICE_NAME}")
+        except Exception as e:
+            print(f"Warning: tracing setup failed, spans are not exported: {e}")
+
+
+def _clean(attributes: dict) -> dict:
+    # OTel attributes must be str, bool, int, float or sequences of them
+    return {k: v for k, v in attributes.items() if v is not None}
+
+
+@contextmanager
+def span(name: str, attributes: dict = None, kind=trace.SpanKind.INTERNAL):
+    """Child span of the current one; exceptions are recorded on it and re-raised."""
+    with tracer.start_as_current_span(name, kind=kind, attributes=_clean(attributes or {})) as current:
+        yield current
+
+
+def client_span(name: str, attributes: dict = None):
+    """Span for a call to an external service (Pinecone, DeepSeek, Cloudinary)."""
+    return span(name, attributes, kind=trace.SpanKind.CLIENT)
+
+
+def set_attributes(attributes: dict):
+    """Adds attributes to the current span (no-op when tracing is off)."""
+    current = trace.get_current_span()
+    if current.is_recording():
+        current.set_attributes(_clean(attributes))
+
+
+def record_usage(response):
+    """Token usage reported on an AIMessage, as gen_ai attributes of the current span."""
+    usage = getattr(response, "usage_metadata", None) or {}
+    set_attributes({
+        "gen_ai.usage.input_tokens": usage.get("input_tokens"),
+        "gen_ai.usage.output_tokens": usage.get("output_tokens"),
+    })
+
+
+class _AttributeGetter:
+    """Reads propagation fields from a Celery task request (custom headers become attributes)."""
+
+    def get(self, carrier, key):
+        value = getattr(carrier, key, None)
+        if value is None and isinstance(getattr(carrier, "headers", None), dict):
+            value = carrier.headers.get(key)
+        return [value] if isinstance(value, str) else value
+
+    def keys(self, carrier):
+        return []
+
+
+# task_id -> (span, context token) of the tasks running in this worker process
+_task_spans = {}
+
+
+def instrument_celery():
+    """
+    Injects the trace context into every published task's headers and runs
+    each task inside a CONSUMER span that continues the publisher's trace.
+    """
+    from celery import signals
+
+    @signals.before_task_publish.connect(weak=False, dispatch_uid="tracing_inject_task_headers")
+    def inject_task_headers(headers=None, **kwargs):
+        if headers is not None:
+            propagate.inject(headers)
+
+    @signals.task_prerun.connect(weak=False, dispatch_uid="tracing_start_task_span")
+    def start_task_span(task_id=None, task=None, **kwargs):
+        parent = propagate.extract(task.request, getter=_AttributeGetter())
+        task_span = tracer.start_span(
+            f"celery.run {task.name}",
+            context=parent,
+            kind=trace.SpanKind.CONSUMER,
+            attributes={"celery.task_name": task.name, "celery.task_id": task_id},
+        )
+        token = context.attach(trace.set_span_in_context(task_span, parent))
+        _task_spans[task_id] = (task_span, token)
+
+    @signals.task_postrun.connect(weak=False, dispatch_uid="tracing_end_task_span")
+    def end_task_span(task_id=None, state=None, **kwargs):
+        entry = _task_spans.pop(task_id, None)
+        if entry is None:
+            return
+        task_span, token = entry
+        if state:
+            task_span.set_attribute("celery.state", state)
+        task_span.end()
+        context.detach(token)
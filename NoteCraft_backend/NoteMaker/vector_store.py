@@ -0,0 +1,566 @@
+"""
+Vector store backends behind one interface.
+
+Every reader and writer of the knowledge base (query_ai, get_context, the PDF
+ingestion paths, the document upload view and UpsertItemsScript) goes through
+get_vector_store(). VECTOR_STORE_BACKEND selects the implementation:
+
+- "pinecone" (default): the hosted "teamfight-tactics-knowledges" index.
+- "local": an in-process engine for load tests, CI and offline replicas. Each
+  namespace is a directory of float32 shards saved as .npy files and opened
+  memory-mapped; a query is one matrix-vector product per shard followed by
+  an argpartition top-k. Rows are L2-normalized on upsert so the dot product
+  is the cosine similarity, the metric of the Pinecone index.
+
+Matches are returned as {"id", "score", "metadata"} dicts by both backends,
+and every call is traced (TracedVectorStore).
+This module does not import Django so the offline scripts can use it.
+"""
+import asyncio
+import json
+import os
+import re
+import threading
+import weakref
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+from pinecone import Pinecone, PineconeAsyncio
+
+from . import tracing
+
+try:
+    import fcntl
+except ImportError:  # Windows: writers are only serialized within a process
+    fcntl = None
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+
+INDEX_NAME = "teamfight-tactics-knowledges"
+VECTOR_STORE_BACKEND = os.getenv("VECTOR_STORE_BACKEND", "pinecone").lower()
+LOCAL_VECTOR_STORE_DIR = os.getenv("LOCAL_VECTOR_STORE_DIR", str(BACKEND_DIR / "vector_store"))
+# Upserts add a shard each; past this many shards a namespace is compacted into one
+LOCAL_VECTOR_MAX_SHARDS = int(os.getenv("LOCAL_VECTOR_MAX_SHARDS", "16"))
+
+_NAMESPACE_RE = re.compile(r"^[\w-]*$")
+# Directory name of the default ("") namespace
+DEFAULT_NAMESPACE_DIR = "__default__"
+
+
+class VectorStore:
+    """Interface shared by the Pinecone and local backends."""
+
+    def upsert(self, vectors: list, namespace: str = "") -> int:
+        """Inserts or replaces {"id", "values", "metadata"} dicts; returns the count."""
+        raise NotImplementedError
+
+    def query(self, vector, top_k: int = 10, namespace: str = "", filter: dict = None,
+              include_metadata: bool = True) -> list:
+        """Returns up to top_k {"id", "score", "metadata"} dicts, best first."""
+        raise NotImplementedError
+
+    async def aquery(self, vector, top_k: int = 10, namespace: str = "", filter: dict = None,
+                     include_metadata: bool = True) -> list:
+        return await asyncio.to_thread(self.query, vector, top_k, namespace, filter, include_metadata)
+
+    def fetch(self, ids: list, namespace: str = "") -> dict:
+        """Returns {id: {"id", "values", "metadata"}} for the ids that exist."""
+        raise NotImplementedError
+
+    def delete(self, ids: list, namespace: str = ""):
+        raise NotImplementedError
+
+    def stats(self) -> dict:
+        """Returns {"dimension", "total_vector_count", "namespaces": {name: {"vector_count"}}}."""
+        raise NotImplementedError
+
+    async def aclose(self):
+        """Releases the running event loop's async clients, if the backend has any."""
+
+
+def _to_match(match) -> dict:
+    return {"id": match.id, "score": match.score, "metadata": match.metadata or {}}
+
+
+class PineconeVectorStore(VectorStore):
+
+    def __init__(self, api_key: str, index_name: str = INDEX_NAME):
+        self.api_key = api_key
+        self.index_name = index_name
+        self.pc = Pinecone(api_key=api_key)
+        self.index = self.pc.Index(index_name)
+        self._host = None
+        # Async clients are bound to the event loop that created them (aiohttp sessions)
+        self._async_indexes = weakref.WeakKeyDictionary()
+
+    def upsert(self, vectors: list, namespace: str = "") -> int:
+        self.index.upsert(vectors=vectors, namespace=namespace)
+        return len(vectors)
+
+    def query(self, vector, top_k: int = 10, namespace: str = "", filter: dict = None,
+              include_metadata: bool = True) -> list:
+        response = self.index.query(
+            vector=vector,
+            top_k=top_k,
+            namespace=namespace,
+            filter=filter,
+            include_metadata=include_metadata
+        )
+        return [_to_match(m) for m in (response.matches or [])]
+
+    def get_host(self) -> str:
+        if self._host is None:
+            self._host = self.pc.describe_index(self.index_name).host
+        return self._host
+
+    async def _get_async_index(self):
+        loop = asyncio.get_running_loop()
+        clients = self._async_indexes.get(loop)
+        if clients is None:
+            host = await asyncio.to_thread(self.get_host)
+            pc = PineconeAsyncio(api_key=self.api_key)
+            clients = (pc, pc.IndexAsyncio(host=host))
+            self._async_indexes[loop] = clients
+        return clients[1]
+
+    async def aclose(self):
+        clients = self._async_indexes.pop(asyncio.get_running_loop(), None)
+        if clients is None:
+            return
+        # The index and the client each own an aiohttp session
+        for client in reversed(clients):
+            try:
+                await client.close()
+            except Exception as e:
+                print(f"Error closing async Pinecone client: {e}")
+
+    async def aquery(self, vector, top_k: int = 10, namespace: str = "", filter: dict = None,
+                     include_metadata: bool = True) -> list:
+        index = await self._get_async_index()
+        response = await index.query(
+            vector=vector,
+            top_k=top_k,
+            namespace=namespace,
+            filter=filter,
+            include_metadata=include_metadata
+        )
+        return [_to_match(m) for m in (response.matches or [])]
+
+    def fetch(self, ids: list, namespace: str = "") -> dict:
+        if not ids:
+            return {}
+        response = self.index.fetch(ids=ids, namespace=namespace)
+        return {
+            vid: {"id": vid, "values": list(v.values), "metadata": v.metadata or {}}
+            for vid, v in (response.vectors or {}).items()
+        }
+
+    def delete(self, ids: list, namespace: str = ""):
+        if ids:
+            self.index.delete(ids=ids, namespace=namespace)
+
+    def stats(self) -> dict:
+        stats = self.index.describe_index_stats()
+        return {
+            "dimension": stats.dimension,
+            "total_vector_count": stats.total_vector_count,
+            "namespaces": {
+                name: {"vector_count": summary.vector_count}
+                for name, summary in (stats.namespaces or {}).items()
+            }
+        }
+
+
+# --- Metadata filters (the Pinecone operator subset the local engine supports) ---
+
+def _compare(value, op: str, operand) -> bool:
+    if op == "$eq":
+        return value == operand
+    if op == "$ne":
+        return value != operand
+    if op == "$in":
+        return value in operand
+    if op == "$nin":
+        return value not in operand
+    if op == "$exists":
+        return (value is not None) == bool(operand)
+    if value is None:
+        return False
+    try:
+        if op == "$gt":
+            return value > operand
+        if op == "$gte":
+            return value >= operand
+        if op == "$lt":
+            return value < operand
+        if op == "$lte":
+            return value <= operand
+    except TypeError:
+        return False
+    raise ValueError(f"Unsupported filter operator: {op}")
+
+
+def matches_filter(metadata: dict, filter: dict) -> bool:
+    """Evaluates a Pinecone-style metadata filter ($eq/$ne/$in/$nin/$gt/$gte/$lt/$lte/$exists/$and/$or)."""
+    for key, condition in filter.items():
+        if key == "$and":
+            if not all(matches_filter(metadata, f) for f in condition):
+                return False
+        elif key == "$or":
+            if not any(matches_filter(metadata, f) for f in condition):
+                return False
+        elif isinstance(condition, dict):
+            value = metadata.get(key)
+            if isinstance(value, list) and all(op in ("$in", "$eq") for op in condition):
+                # List fields match when any element matches, as in Pinecone
+                if not any(_compare(v, op, operand) for v in value for op, operand in condition.items()):
+                    return False
+            elif not all(_compare(value, op, operand) for op, operand in condition.items()):
+                return False
+        elif not matches_filter(metadata, {key: {"$eq": condition}}):
+            return False
+    return True
+
+
+# --- Local engine ---
+
+def _normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def _write_json(path: Path, data):
+    # Atomic replace so readers in other processes never see a partial file
+    tmp_path = path.with_suffix(path.suffix + ".tmp")
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+class _Shard:
+    """One .npy matrix (memory-mapped) plus its ids, metadata and deleted rows."""
+
+    def __init__(self, directory: Path, name: str):
+        self.directory = directory
+        self.name = name
+        self.matrix = np.load(directory / f"{name}.npy", mmap_mode="r")
+        with open(directory / f"{name}.json", 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        self.ids = data["ids"]
+        self.metadata = data["metadata"]
+        self.live = np.ones(len(self.ids), dtype=bool)
+        self.live[data.get("deleted", [])] = False
+
+    @staticmethod
+    def write(directory: Path, name: str, matrix: np.ndarray, ids: list, metadata: list):
+        tmp_path = directory / f"{name}.tmp.npy"
+        np.save(tmp_path, matrix.astype(np.float32, copy=False))
+        os.replace(tmp_path, directory / f"{name}.npy")
+        _write_json(directory / f"{name}.json", {"ids": ids, "metadata": metadata, "deleted": []})
+
+    def save_deleted(self):
+        _write_json(self.directory / f"{self.name}.json", {
+            "ids": self.ids,
+            "metadata": self.metadata,
+            "deleted": np.flatnonzero(~self.live).tolist()
+        })
+
+
+class _Namespace:
+    """The shards of one namespace as listed by its manifest.json."""
+
+    def __init__(self, directory: Path):
+        self.directory = directory
+        self.manifest_path = directory / "manifest.json"
+        self.shards = []
+        self.next_shard = 0
+        self.positions = {}  # id -> (shard, row) of the live copy
+        self.mtime = None
+        if self.manifest_path.exists():
+            self.mtime = os.stat(self.manifest_path).st_mtime_ns
+            with open(self.manifest_path, 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+            self.next_shard = manifest["next_shard"]
+            self.shards = [_Shard(directory, name) for name in manifest["shards"]]
+        self.index_positions()
+
+    def index_positions(self):
+        self.positions = {}
+        for shard in self.shards:
+            for row in np.flatnonzero(shard.live):
+                self.positions[shard.ids[row]] = (shard, int(row))
+
+    @property
+    def dimension(self):
+        return self.shards[0].matrix.shape[1] if self.shards else None
+
+    def is_stale(self) -> bool:
+        try:
+            mtime = os.stat(self.manifest_path).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        return mtime != self.mtime
+
+    def save_manifest(self):
+        _write_json(self.manifest_path, {
+            "shards": [s.name for s in self.shards],
+            "next_shard": self.next_shard
+        })
+        self.mtime = os.stat(self.manifest_path).st_mtime_ns
+
+
+class LocalVectorStore(VectorStore):
+
+    def __init__(self, root: str = LOCAL_VECTOR_STORE_DIR):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self._namespaces = {}
+        self._lock = threading.RLock()
+
+    def _directory(self, namespace: str) -> Path:
+        if not _NAMESPACE_RE.match(namespace):
+            raise ValueError(f"Invalid namespace: {namespace!r}")
+        return self.root / (namespace or DEFAULT_NAMESPACE_DIR)
+
+    def _get(self, namespace: str) -> _Namespace:
+        """Current state of a namespace, reloaded when another process changed it."""
+        ns = self._namespaces.get(namespace)
+        if ns is None or ns.is_stale():
+            with self._lock:
+                ns = self._namespaces.get(namespace)
+                if ns is None or ns.is_stale():
+                    ns = _Namespace(self._directory(namespace))
+                    self._namespaces[namespace] = ns
+        return ns
+
+    @contextmanager
+    def _writing(self, namespace: str):
+        """Serializes writers (across processes where fcntl exists) and yields a fresh state."""
+        directory = self._directory(namespace)
+        directory.mkdir(parents=True, exist_ok=True)
+        with self._lock:
+            with open(directory / ".lock", 'w') as lock_file:
+                if fcntl:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    ns = _Namespace(directory)
+                    yield ns
+                    # The writer added or compacted shards; fetch() and stats() use the positions
+                    ns.index_positions()
+                    ns.save_manifest()
+                    self._namespaces[namespace] = ns
+                finally:
+                    if fcntl:
+                        fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _tombstone(self, ns: _Namespace, ids) -> int:
+        touched = set()
+        for vid in ids:
+            position = ns.positions.pop(vid, None)
+            if position:
+                shard, row = position
+                shard.live[row] = False
+                touched.add(shard)
+        for shard in touched:
+            shard.save_deleted()
+        return len(touched)
+
+    def upsert(self, vectors: list, namespace: str = "") -> int:
+        if not vectors:
+            return 0
+        # Last write wins within a batch
+        latest = {v["id"]: v for v in vectors}
+        ids = list(latest)
+        matrix = _normalize_rows(np.asarray([latest[i]["values"] for i in ids], dtype=np.float32))
+        metadata = [latest[i].get("metadata") or {} for i in ids]
+
+        with self._writing(namespace) as ns:
+            if ns.dimension is not None and matrix.shape[1] != ns.dimension:
+                raise ValueError(f"Vector dimension {matrix.shape[1]} does not match index dimension {ns.dimension}")
+            self._tombstone(ns, ids)
+            name = f"shard_{ns.next_shard:06d}"
+            ns.next_shard += 1
+            _Shard.write(ns.directory, name, matrix, ids, metadata)
+            ns.shards.append(_Shard(ns.directory, name))
+            if len(ns.shards) > LOCAL_VECTOR_MAX_SHARDS:
+                self._compact(ns)
+        return len(ids)
+
+    def _compact(self, ns: _Namespace):
+        """Rewrites the live rows of every shard into a single new shard."""
+        old_shards = ns.shards
+        live = [(s, np.flatnonzero(s.live)) for s in old_shards]
+        ns.shards = []
+        if any(len(rows) for _, rows in live):
+            name = f"shard_{ns.next_shard:06d}"
+            ns.next_shard += 1
+            _Shard.write(
+                ns.directory, name,
+                np.concatenate([np.asarray(s.matrix[rows]) for s, rows in live if len(rows)]),
+                [s.ids[r] for s, rows in live for r in rows],
+                [s.metadata[r] for s, rows in live for r in rows]
+            )
+            ns.shards.append(_Shard(ns.directory, name))
+        ns.save_manifest()
+        for shard in old_shards:
+            shard.matrix = None  # Release the mmap before deleting the file
+            for suffix in (".npy", ".json"):
+                try:
+                    os.remove(ns.directory / f"{shard.name}{suffix}")
+                except OSError as e:
+                    print(f"Could not remove compacted shard {shard.name}{suffix}: {e}")
+
+    def query(self, vector, top_k: int = 10, namespace: str = "", filter: dict = None,
+              include_metadata: bool = True) -> list:
+        ns = self._get(namespace)
+        if not ns.shards or top_k <= 0:
+            return []
+        q = np.asarray(vector, dtype=np.float32)
+        q = q / (np.linalg.norm(q) or 1.0)
+
+        all_scores = []
+        owners = []
+        for shard in ns.shards:
+            mask = shard.live
+            if filter:
+                mask = mask & np.fromiter(
+                    (matches_filter(m, filter) for m in shard.metadata), dtype=bool, count=len(shard.metadata)
+                )
+            if not mask.any():
+                continue
+            scores = shard.matrix @ q
+            all_scores.append(np.where(mask, scores, -np.inf))
+            owners.append(shard)
+        if not all_scores:
+            return []
+
+        scores = np.concatenate(all_scores)
+        k = min(top_k, int(np.isfinite(scores).sum()))
+        if k == 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+
+        offsets = np.cumsum([len(s) for s in all_scores])
+        results = []
+        for flat in top:
+            shard_idx = int(np.searchsorted(offsets, flat, side="right"))
+            shard = owners[shard_idx]
+            row = int(flat - (offsets[shard_idx - 1] if shard_idx else 0))
+            results.append({
+                "id": shard.ids[row],
+                "score": float(scores[flat]),
+                "metadata": shard.metadata[row] if include_metadata else {}
+            })
+        return results
+
+    def fetch(self, ids: list, namespace: str = "") -> dict:
+        ns = self._get(namespace)
+        result = {}
+        for vid in ids:
+            position = ns.positions.get(vid)
+            if position:
+                shard, row = position
+                result[vid] = {"id": vid, "values": shard.matrix[row].tolist(), "metadata": shard.metadata[row]}
+        return result
+
+    def delete(self, ids: list, namespace: str = ""):
+        if not ids:
+            return
+        with self._writing(namespace) as ns:
+            self._tombstone(ns, ids)
+
+    def stats(self) -> dict:
+        namespaces = {}
+        dimension = None
+        for directory in sorted(self.root.iterdir()):
+            if not (directory / "manifest.json").exists():
+                continue
+            name = "" if directory.name == DEFAULT_NAMESPACE_DIR else directory.name
+            ns = self._get(name)
+            namespaces[name] = {"vector_count": len(ns.positions)}
+            dimension = dimension or ns.dimension
+        return {
+            "dimension": dimension,
+            "total_vector_count": sum(n["vector_count"] for n in namespaces.values()),
+            "namespaces": namespaces
+        }
+
+
+class TracedVectorStore(VectorStore):
+    """Wraps a backend so every call runs in a "vector_store.<operation>" span."""
+
+    def __init__(self, store: VectorStore, system: str):
+        self.store = store
+        self.system = system
+
+    def _span(self, operation: str, namespace: str, **attributes):
+        return tracing.client_span(f"vector_store.{operation}", {
+            "db.system": self.system,
+            "db.operation.name": operation,
+            "db.namespace": namespace,
+            **attributes
+        })
+
+    def upsert(self, vectors: list, namespace: str = "") -> int:
+        with self._span("upsert", namespace, **{"vector.batch_size": len(vectors)}):
+            return self.store.upsert(vectors, namespace)
+
+    def query(self, vector, top_k: int = 10, namespace: str = "", filter: dict = None,
+              include_metadata: bool = True) -> list:
+        with self._span("query", namespace, **{"vector.top_k": top_k, "vector.filtered": filter is not None}) as span:
+            matches = self.store.query(vector, top_k, namespace, filter, include_metadata)
+            span.set_attribute("vector.matches", len(matches))
+            return matches
+
+    async def aquery(self, vector, top_k: int = 10, namespace: str = "", filter: dict = None,
+                     include_metadata: bool = True) -> list:
+        with self._span("query", namespace, **{"vector.top_k": top_k, "vector.filtered": filter is not None}) as span:
+            matches = await self.store.aquery(vector, top_k, namespace, filter, include_metadata)
+            span.set_attribute("vector.matches", len(matches))
+            return matches
+
+    def fetch(self, ids: list, namespace: str = "") -> dict:
+        with self._span("fetch", namespace, **{"vector.batch_size": len(ids)}):
+            return self.store.fetch(ids, namespace)
+
+    def delete(self, ids: list, namespace: str = ""):
+        with self._span("delete", namespace, **{"vector.batch_size": len(ids)}):
+            return self.store.delete(ids, namespace)
+
+    def stats(self) -> dict:
+        return self.store.stats()
+
+    async def aclose(self):
+        await self.store.aclose()
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_vector_store() -> VectorStore:
+    """The process-wide store selected by VECTOR_STORE_BACKEND."""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                if VECTOR_STORE_BACKEND == "local":
+                    _store = LocalVectorStore(LOCAL_VECTOR_STORE_DIR)
+                elif VECTOR_STORE_BACKEND == "pinecone":
+                    api_key = os.getenv("PINECONE_API_KEY")
+                    if not api_key:
+                        raise ValueError("Pinecone not initialized")
+                    _store = PineconeVectorStore(api_key)
+                else:
+                    raise ValueError(f"Unknown VECTOR_STORE_BACKEND: {VECTOR_STORE_BACKEND}")
+                _store = TracedVectorStore(_store, VECTOR_STORE_BACKEND)
+    return _store
+
+
+async def aclose_vector_store():
+    """Closes the running event loop's async clients of the store, if it was created."""
+    if _store is not None:
+        await _store.aclose()
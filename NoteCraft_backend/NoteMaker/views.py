@@ -5,22 +5,32 @@ from typing import Dict
 from .myutils import request_OpenRouter,google_search_image,get_context,topics_query,new_image
 from requests.exceptions import RequestException
 import requests
-from django.http import HttpResponse
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.views import View
+from asgiref.sync import sync_to_async
 from django.views.decorators.csrf import csrf_exempt
 from django.utils.decorators import method_decorator
 from rest_framework import status, generics, permissions
+from rest_framework.exceptions import AuthenticationFailed, NotAuthenticated
+from rest_framework_simplejwt.authentication import JWTAuthentication
 import json
 import logging
 from urllib.parse import urlparse
 from .tasks import generate_notes_task
 from celery.result import AsyncResult
+from celery.states import READY_STATES
 from NoteCraft_backend.celery import app
-from .ai_module import query_ai
+from .ai_module import aquery_ai, astream_query_ai
+from .llm_gateway import LLM_ERRORS
 from .models import Conversation, Message
+from . import admission, metrics, single_flight
 from .serializers import ConversationSerializer, MessageSerializer
 
 logger = logging.getLogger(__name__)
 
+metrics.register_gauges("single_flight", single_flight.single_flight_stats)
+metrics.register_gauges("admission", admission.admission_stats)
+
 class HelloWorldView(APIView):
     def get(self, request:Request)->Response:
         return Response({"message": "Hello, world!"})
@@ -51,56 +61,142 @@ class MessageListView(generics.ListAPIView):
         conversation_id = self.kwargs['conversation_id']
         return Message.objects.filter(conversation_id=conversation_id, conversation__user=self.request.user).order_by('created_at')
 
-class AskAIView(APIView):
-    permission_classes = [permissions.IsAuthenticated]
+class AsyncJWTView(View):
+    """
+    Base class for async views served under ASGI. DRF's APIView is sync-only,
+    so this performs the same JWT authentication and exposes the parsed JSON
+    body as request.data.
+    """
+
+    async def dispatch(self, request, *args, **kwargs):
+        try:
+            auth = await sync_to_async(JWTAuthentication().authenticate)(request)
+        except AuthenticationFailed as e:
+            return JsonResponse({"detail": e.detail}, status=401)
+        if auth is None:
+            return JsonResponse({"detail": str(NotAuthenticated.default_detail)}, status=401)
+        request.user = auth[0]
+
+        try:
+            request.data = json.loads(request.body or b"{}")
+        except ValueError:
+            return JsonResponse({"error": "Invalid JSON body"}, status=400)
+
+        return await super().dispatch(request, *args, **kwargs)
+
+async def aget_or_create_conversation(user, query: str, conversation_id):
+    """
+    Returns the user's conversation, creating one titled after the query when
+    no id is given. Returns None if the id does not belong to the user.
+    """
+    if conversation_id:
+        try:
+            return await Conversation.objects.aget(id=conversation_id, user=user)
+        except Conversation.DoesNotExist:
+            return None
+    # Create new conversation with the first query as title (truncated)
+    title = query[:30] + "..." if len(query) > 30 else query
+    return await Conversation.objects.acreate(user=user, title=title)
 
-    def post(self, request: Request) -> Response:
+@method_decorator(csrf_exempt, name='dispatch')
+class AskAIView(AsyncJWTView):
+    admission_class = "ask_ai"
+
+    async def post(self, request) -> JsonResponse:
         query = request.data.get("query", "")
         conversation_id = request.data.get("conversation_id")
 
         if not query:
-            return Response({"error": "Query is required"}, status=400)
-        
-        user = request.user
+            return JsonResponse({"error": "Query is required"}, status=400)
         
         # Handle Conversation
-        if conversation_id:
-            try:
-                conversation = Conversation.objects.get(id=conversation_id, user=user)
-            except Conversation.DoesNotExist:
-                return Response({"error": "Conversation not found"}, status=404)
-        else:
-            # Create new conversation with the first query as title (truncated)
-            title = query[:30] + "..." if len(query) > 30 else query
-            conversation = Conversation.objects.create(user=user, title=title)
+        conversation = await aget_or_create_conversation(request.user, query, conversation_id)
+        if conversation is None:
+            return JsonResponse({"error": "Conversation not found"}, status=404)
 
         # Save User Message
-        Message.objects.create(conversation=conversation, role='user', content=query)
+        await Message.objects.acreate(conversation=conversation, role='user', content=query)
         
         try:
-            result = query_ai(query)
+            # Identical concurrent questions share one pipeline run; each still gets its own messages
+            result = await single_flight.coalesce("ask_ai", query, lambda: aquery_ai(query))
             
             ai_content = result.get('answer', '') if isinstance(result, dict) else str(result)
             
             # Save AI Message
-            Message.objects.create(conversation=conversation, role='assistant', content=ai_content)
+            await Message.objects.acreate(conversation=conversation, role='assistant', content=ai_content)
             
             response_data = {
                 "answer": ai_content,
                 "conversation_id": conversation.id,
                 "sources": result.get('sources', [])
             }
-            return Response(response_data)
+            return JsonResponse(response_data)
         except Exception as e:
             # 记录详细错误到日志，返回通用错误信息给前端
             logger.error(f"AI Query Error: {e}")
-            return Response({
+            return JsonResponse({
                 "error": "AI服务暂时不可用",
                 "conversation_id": conversation.id,
                 "answer": "抱歉，我现在无法连接到大脑，请稍后再试。"
             }, status=500)
 
+def sse_event(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@method_decorator(csrf_exempt, name='dispatch')
+class AskAIStreamView(AsyncJWTView):
+    """
+    Server-sent-events variant of AskAIView. Emits "conversation", "retrieval"
+    and "sources" events, then "token" events as the answer is generated, and
+    finally "done" (or "error"). The assistant message is saved once the stream
+    completes or the client disconnects.
+    """
+    admission_class = "ask_ai"
+
+    async def post(self, request):
+        query = request.data.get("query", "")
+        conversation_id = request.data.get("conversation_id")
+
+        if not query:
+            return JsonResponse({"error": "Query is required"}, status=400)
+
+        conversation = await aget_or_create_conversation(request.user, query, conversation_id)
+        if conversation is None:
+            return JsonResponse({"error": "Conversation not found"}, status=404)
+
+        await Message.objects.acreate(conversation=conversation, role='user', content=query)
+
+        # An async iterator lets ASGI send each event as soon as it is produced
+        response = StreamingHttpResponse(
+            self.event_stream(query, conversation),
+            content_type='text/event-stream; charset=utf-8'
+        )
+        response['Cache-Control'] = 'no-cache'
+        response['X-Accel-Buffering'] = 'no'  # Disable proxy buffering (nginx)
+        return response
+
+    async def event_stream(self, query: str, conversation: Conversation):
+        answer_parts = []
+        try:
+            yield sse_event("conversation", {"conversation_id": conversation.id})
+            async for event, data in astream_query_ai(query):
+                if event == "token":
+                    answer_parts.append(data)
+                yield sse_event(event, data)
+        except Exception as e:
+            logger.error(f"AI Stream Error: {e}")
+            if not answer_parts:
+                answer_parts.append("抱歉，我现在无法连接到大脑，请稍后再试。")
+            yield sse_event("error", {"error": "AI服务暂时不可用"})
+        finally:
+            # Runs on completion, on error and when the client aborts (generator closed)
+            if answer_parts:
+                await Message.objects.acreate(conversation=conversation, role='assistant', content="".join(answer_parts))
+
 class GenerateNoteView(APIView):
+    admission_class = "generate_note"
+
     def post(self, request:Request) -> Response:
         params = request.data.get("params", {}) # type: ignore
         query = params.get("query", "") # type: ignore
@@ -109,8 +205,27 @@ class GenerateNoteView(APIView):
 
         prompt_1 = query + topics_query
 
-        task = generate_notes_task.delay(prompt_1)
-        return Response({"message": "Note generation started", "task_id": task.id})
+        # A new task keeps this request's admission slot until it finishes
+        lease = getattr(request, "admission_lease", None)
+
+        def enqueue():
+            # Detached first: an eager task releases the slot when it finishes inside apply_async
+            task_id = lease.detach() if lease else None
+            try:
+                return generate_notes_task.apply_async((prompt_1,), task_id=task_id).id
+            except Exception:
+                # Broker down or similar: no task will ever release the slot
+                if task_id:
+                    admission.release_task(task_id)
+                raise
+
+        # Identical concurrent requests poll the same task instead of starting another one
+        task_id = single_flight.shared_task_id(
+            query,
+            is_running=lambda existing: AsyncResult(existing).state not in READY_STATES,
+            enqueue=enqueue,
+        )
+        return Response({"message": "Note generation started", "task_id": task_id})
 
 class TaskStatusView(APIView):
     def get(self, request:Request, task_id):
@@ -118,11 +233,15 @@ class TaskStatusView(APIView):
         return Response({
             "task_id": task_id,
             "state": result.state,
-            "result": result.result if result.ready() else None
+            "result": result.result if result.ready() else None,
+            # ProgressTask meta: current/total/percent/status plus task-specific counters
+            "progress": result.info if result.state == "PROGRESS" else None
         })
 
 
 class ModifyTextView(APIView):
+    admission_class = "modify"
+
     def post(self,request:Request)->Response:
         change_text:str=request.data.get("text") # type: ignore
         print(change_text)
@@ -132,10 +251,12 @@ class ModifyTextView(APIView):
             end:int = response.find("```", start)
             new_text:str = response[start:end].strip()
             return Response({"message": "Text modified successfully","modifiedContent": new_text})
-        except (TypeError,RequestException) as e:
+        except (TypeError,RequestException,*LLM_ERRORS) as e:
             return Response({"message": "Error in response from OpenRouter","error": str(e)},status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 class ModifyImageView(APIView):
+    admission_class = "modify"
+
     def post(self,request:Request)->Response:
         change_image:str=request.data.get("imgText") # type: ignore
         try:
@@ -189,5 +310,21 @@ class CancelTaskView(APIView):
         task_id = request.data.get("task_id")  # type: ignore
         if not task_id:
             return Response({"error": "Missing task_id"}, status=400)
-        app.control.revoke(task_id, terminate=True)  
+        # A task shared with other callers keeps running until the last one cancels
+        if single_flight.release_task(task_id) == 0:
+            app.control.revoke(task_id, terminate=True)
+            # A terminated task never reaches task_postrun
+            admission.release_task(task_id)
         return Response({"message": "Task cancelled successfully"}, status=200)
+
+class MetricsView(View):
+    """
+    Prometheus scrape endpoint. When METRICS_TOKEN is set, the scraper must
+    send it as a bearer token.
+    """
+
+    def get(self, request):
+        if metrics.METRICS_TOKEN and request.headers.get("Authorization") != f"Bearer {metrics.METRICS_TOKEN}":
+            return HttpResponse(status=401)
+        body, content_type = metrics.render_metrics()
+        return HttpResponse(body, content_type=content_type)
@@ -0,0 +1,110 @@
+# tasks.py
+import os
+
+import requests
+from celery import Task, shared_task
+
+from NoteMaker.ai_module import process_pdf_to_vector_db
+from NoteMaker.chunk_embedding_cache import CacheRunStats
+from NoteMaker.metrics import stage
+from NoteMaker.namespaces import UPLOAD_NAMESPACE
+from NoteMaker.pdf_ingest import open_pdf
+from .models import Document
+
+PDF_DOWNLOAD_TIMEOUT_SECONDS = float(os.getenv("PDF_DOWNLOAD_TIMEOUT_SECONDS", "120"))
+
+
+class ProgressTask(Task):
+    """
+    支持进度更新的任务基类。
+    适用于文档解析、向量化等长耗时操作。
+    """
+    abstract = True
+
+    def update_progress(self, current, total, status="Processing", **counters):
+        """
+        更新任务进度状态，TaskStatusView 在 PROGRESS 状态下返回 meta
+        """
+        # Eager results that are not stored cannot be polled
+        if self.request.is_eager and not self.store_eager_result:
+            return
+        self.update_state(state='PROGRESS', meta={
+            'current': current,
+            'total': total,
+            'status': status,
+            'percent': int((current / total) * 100) if total > 0 else 0,
+            **counters,
+        })
+
+    def on_failure(self, exc, task_id, args, kwargs, einfo):
+        print(f"Task {task_id} failed: {exc}")
+        super().on_failure(exc, task_id, args, kwargs, einfo)
+
+
+class IngestProgress:
+    """Counts pages parsed, chunks embedded and vectors upserted for a ProgressTask."""
+
+    def __init__(self, task: ProgressTask, pages_total: int):
+        self.task = task
+        self.counters = {
+            "pages_total": pages_total,
+            "pages_parsed": 0,
+            "chunks_total": 0,
+            "chunks_embedded": 0,
+            "vectors_upserted": 0,
+        }
+
+    def __call__(self, event: str, count: int):
+        key = {"pages": "pages_parsed", "chunks": "chunks_total",
+               "embedded": "chunks_embedded", "upserted": "vectors_upserted"}[event]
+        self.counters[key] += count
+        self.report(event)
+
+    def report(self, status: str):
+        c = self.counters
+        # Chunks are counted as pages stream in, so extrapolate the total from the pages parsed so far
+        total = c["chunks_total"]
+        if c["pages_parsed"]:
+            total = max(total, round(c["chunks_total"] * c["pages_total"] / c["pages_parsed"]))
+        self.task.update_progress(c["vectors_upserted"], total, status, **c)
+
+
+def fetch_pdf(url: str) -> bytes:
+    response = requests.get(url, timeout=PDF_DOWNLOAD_TIMEOUT_SECONDS)
+    response.raise_for_status()
+    return response.content
+
+
+@shared_task(bind=True, base=ProgressTask)
+def ingest_document_task(self, document_id: str) -> dict:
+    """
+    Downloads an uploaded PDF from Cloudinary and indexes it for the AI chat.
+    Progress (pages, chunks embedded, vectors upserted) is reported through
+    the PROGRESS state.
+    """
+    try:
+        document = Document.objects.get(id=document_id)
+        self.update_progress(0, 0, "downloading")
+        pdf_bytes = fetch_pdf(document.pdf_public_id)
+        # Opening only reads the page tree; the pages are parsed once, during ingestion
+        with open_pdf(pdf_bytes) as doc:
+            pages_total = doc.page_count
+        progress = IngestProgress(self, pages_total)
+
+        # One extraction, chunking and embedding pass; chunk ids derive from the
+        # document id, so re-indexing replaces the document's vectors
+        cache_stats = CacheRunStats()
+        with stage("upload", "ingest"):
+            process_pdf_to_vector_db(
+                pdf_bytes,
+                namespace=UPLOAD_NAMESPACE,
+                metadata={"source": document.topic, "doc_id": str(document.id), "namespace": UPLOAD_NAMESPACE},
+                id_prefix=str(document.id),
+                on_progress=progress,
+                cache_stats=cache_stats,
+            )
+        print(f"Successfully indexed {progress.counters['vectors_upserted']} chunks for {document.topic}")
+        return {"success": True, "document_id": str(document.id), **progress.counters, **cache_stats.as_dict()}
+    except Exception as e:
+        print(f"Error indexing document {document_id}: {e}")
+        return {"success": False, "document_id": str(document_id), "error": str(e)}
@@ -8,6 +8,7 @@ export const API_ENDPOINTS = {
   logout: `${API_BASE}/logout/`,
   conversations: `${API_BASE}/conversations/`,
   askAi: `${API_BASE}/ask_ai/`,
+  askAiStream: `${API_BASE}/ask_ai/stream/`,
   addPdf: `${API_BASE}/add_pdf/`,
   listPdfs: `${API_BASE}/list_pdfs/`,
   authStatus: `${API_BASE}/auth_status/`,
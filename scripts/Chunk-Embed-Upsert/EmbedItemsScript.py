@@ -1,6 +1,7 @@
 import json
 import time
 import os
+import sys
 from pathlib import Path
 from pinecone import Pinecone
 from dotenv import load_dotenv
@@ -11,6 +12,11 @@ SCRIPT_DIR = Path(__file__).parent
 PROJECT_ROOT = SCRIPT_DIR.parent.parent
 load_dotenv(PROJECT_ROOT / ".env")
 
+# 引入后端的公共模块 (不依赖 Django)
+BACKEND_DIR = PROJECT_ROOT / "NoteCraft_backend"
+sys.path.insert(0, str(BACKEND_DIR))
+from NoteMaker.chunk_embedding_cache import CacheRunStats, embed_passages
+
 # 从环境变量获取 API Key
 PINECONE_API_KEY = os.getenv("PINECONE_API_KEY")
 
@@ -23,9 +29,10 @@ INPUT_DIR = PROJECT_ROOT / "datas" / "ChunkedData"
 # 输出：Embedding 后的数据目录
 OUTPUT_DIR = PROJECT_ROOT / "datas" / "EmbeddedData"
 
-def process_file(pc, file_path):
+def process_file(pc, file_path, stats):
     """
     处理单个 JSON 文件进行 Embedding
+    内容未变的 chunk 直接复用本地缓存中的向量 (chunk_embeddings.sqlite3)，只有新文本才会调用 API
     """
     try:
         with open(file_path, 'r', encoding='utf-8') as f:
@@ -52,23 +59,20 @@ def process_file(pc, file_path):
         texts_to_embed = [item['metadata']['text'] for item in batch_items]
         
         try:
-            # 调用 Pinecone Inference API
+            # 先查缓存，未命中的部分调用 Pinecone Inference API
             # input_type="passage" 表示我们要存储的是文档段落
-            embeddings = pc.inference.embed(
-                model=MODEL_NAME,
-                inputs=texts_to_embed,
-                parameters={"input_type": "passage"}
-            )
+            misses_before = stats.misses
+            embeddings = embed_passages(pc, texts_to_embed, model=MODEL_NAME, input_type="passage", stats=stats)
             
             # 将生成的向量填回对应的 item
-            for j, embedding_obj in enumerate(embeddings):
-                # embedding_obj['values'] 是向量数组
-                batch_items[j]['values'] = embedding_obj['values']
+            for j, values in enumerate(embeddings):
+                batch_items[j]['values'] = values
                 
             print(f"  -> 进度: {min(i + batch_size, total_items)}/{total_items}")
             
-            # 简单的速率限制保护，避免触发 API 限制
-            time.sleep(0.2) 
+            # 简单的速率限制保护，避免触发 API 限制 (全部命中缓存时没有调用 API，无需等待)
+            if stats.misses > misses_before:
+                time.sleep(0.2)
 
         except Exception as e:
             print(f"  -> 批次处理出错 (索引 {i} - {i+batch_size}): {e}")
@@ -112,11 +116,14 @@ def main():
     print("-" * 50)
 
     # 4. 遍历处理
+    stats = CacheRunStats()
     for json_file in json_files:
-        process_file(pc, json_file)
+        process_file(pc, json_file, stats)
         
     print("-" * 50)
     print("所有文件处理完成。")
+    print(f"Embedding 缓存: 命中 {stats.hits} 条，未命中 {stats.misses} 条 (命中率 {stats.hit_rate:.1%})，"
+          f"节省 {stats.bytes_saved / 1024:.1f} KiB 文本的 Embedding 调用")
     print("现在你可以使用 UpsertItemsScript.py 将这些文件上传到 Pinecone。")
 
 
@@ -1,8 +1,8 @@
 import json
 import time
 import os
+import sys
 from pathlib import Path
-from pinecone import Pinecone
 from dotenv import load_dotenv
 
 # --- 配置部分 ---
@@ -11,13 +11,18 @@ SCRIPT_DIR = Path(__file__).parent
 PROJECT_ROOT = SCRIPT_DIR.parent.parent
 load_dotenv(PROJECT_ROOT / ".env")
 
+# 引入后端的公共模块 (不依赖 Django)
+BACKEND_DIR = PROJECT_ROOT / "NoteCraft_backend"
+sys.path.insert(0, str(BACKEND_DIR))
+from NoteMaker.answer_cache import bump_index_generation
+from NoteMaker import docstore, lexical_index
+from NoteMaker.namespaces import namespace_for
+from NoteMaker.vector_store import INDEX_NAME, VECTOR_STORE_BACKEND, get_vector_store
+
 PINECONE_API_KEY = os.getenv("PINECONE_API_KEY")
-if not PINECONE_API_KEY:
+if VECTOR_STORE_BACKEND == "pinecone" and not PINECONE_API_KEY:
     raise SystemExit("错误: 未在项目根目录的 .env 中找到 PINECONE_API_KEY，请添加后重试。")
 
-# 你的 Index 名称
-INDEX_NAME = "teamfight-tactics-knowledges"
-
 # 输入目录 (Embed 脚本生成的输出目录)
 INPUT_DIR = PROJECT_ROOT / "datas" / "EmbeddedData"
 
@@ -74,9 +79,9 @@ def clean_metadata(metadata):
 
     return cleaned
 
-def process_file(index, file_path):
+def process_file(store, file_path):
     """
-    读取单个文件并上传数据到 Pinecone
+    读取单个文件并上传数据到向量库
     """
     print(f"正在处理文件: {file_path.name}")
     try:
@@ -96,9 +101,22 @@ def process_file(index, file_path):
 
     # Pinecone 建议每次 Upsert 的 batch size 在 100-200 左右
     batch_size = 100
-    vectors_to_upsert = []
-
-    for i, item in enumerate(items):
+    # 按命名空间分别缓冲，每个命名空间单独成批上传
+    pending = {}
+
+    def flush(namespace):
+        batch = pending.pop(namespace)
+        try:
+            # 先写 docstore 和本地 BM25 词法索引 (与向量库使用相同的 ID)，再上传向量
+            docstore.put_documents(batch["documents"], namespace=namespace)
+            lexical_index.add_chunks(batch["documents"], namespace=namespace)
+            store.upsert(batch["vectors"], namespace=namespace)
+            print(f"  -> 已上传批次到命名空间 {namespace} (共 {len(batch['vectors'])} 条)")
+            time.sleep(0.2) # 稍微暂停，避免过于频繁请求
+        except Exception as e:
+            print(f"  -> 上传批次失败: {e}")
+
+    for item in items:
         # 检查是否有向量数据
         if not item.get('values'):
             print(f"  -> 警告: ID {item.get('id')} 缺少向量数据，跳过。")
@@ -116,48 +134,51 @@ def process_file(index, file_path):
         # 把原始的可读 ID 存入 metadata，方便以后反查
         cleaned_meta['original_id'] = original_id
 
+        # 根据 type/category 决定命名空间 (英雄、装备、海克斯、阵容...)
+        namespace = namespace_for(cleaned_meta)
+
+        # 正文存入本地 docstore，向量库只保留可过滤的元数据
+        document, vector_meta = docstore.split_metadata(cleaned_meta)
+
         # 构建 Pinecone 向量对象
         vector_record = {
             "id": ascii_id,
             "values": item['values'],
-            "metadata": cleaned_meta
+            "metadata": vector_meta
         }
-        vectors_to_upsert.append(vector_record)
+        batch = pending.setdefault(namespace, {"vectors": [], "documents": []})
+        batch["vectors"].append(vector_record)
+        batch["documents"].append({"id": ascii_id, **document})
 
-        # 当达到 batch_size 或最后一条数据时，执行上传
-        if len(vectors_to_upsert) >= batch_size or i == total_items - 1:
-            try:
-                index.upsert(vectors=vectors_to_upsert)
-                print(f"  -> 已上传批次: {i - len(vectors_to_upsert) + 1} 到 {i} (共 {len(vectors_to_upsert)} 条)")
-                vectors_to_upsert = [] # 清空列表
-                time.sleep(0.2) # 稍微暂停，避免过于频繁请求
-            except Exception as e:
-                print(f"  -> 上传批次失败: {e}")
+        # 当某个命名空间达到 batch_size 时，执行上传
+        if len(batch["vectors"]) >= batch_size:
+            flush(namespace)
+
+    # 上传剩余数据
+    for namespace in list(pending):
+        flush(namespace)
     
     print(f"  -> 文件 {file_path.name} 处理完成。\n")
 
 def main():
-    # 1. 初始化 Pinecone 客户端
-    pc = Pinecone(api_key=PINECONE_API_KEY)
-    
-    # 2. 连接到索引
-    print(f"正在连接到索引: {INDEX_NAME}...")
+    # 1. 连接到向量库 (VECTOR_STORE_BACKEND: pinecone 或 local)
+    print(f"正在连接到索引: {INDEX_NAME} ({VECTOR_STORE_BACKEND})...")
     try:
-        index = pc.Index(INDEX_NAME)
+        store = get_vector_store()
         # 简单检查索引状态
-        stats = index.describe_index_stats()
+        stats = store.stats()
         print(f"索引状态: {stats}")
     except Exception as e:
         print(f"连接索引失败: {e}")
         return
 
-    # 3. 检查输入目录
+    # 2. 检查输入目录
     if not INPUT_DIR.exists():
         print(f"错误: 输入目录不存在 {INPUT_DIR}")
         print("请先运行 EmbedItemsScript.py 生成数据。")
         return
 
-    # 4. 获取所有 JSON 文件
+    # 3. 获取所有 JSON 文件
     json_files = list(INPUT_DIR.glob("*.json"))
     
     if not json_files:
@@ -167,16 +188,20 @@ def main():
     print(f"开始批量上传... 共找到 {len(json_files)} 个文件")
     print("-" * 50)
 
-    # 5. 遍历处理每个文件
+    # 4. 遍历处理每个文件
     for json_file in json_files:
-        process_file(index, json_file)
+        process_file(store, json_file)
 
     print("-" * 50)
     print("所有数据上传完成！")
+
+    # 知识库已更新，使后端的语义答案缓存失效
+    generation = bump_index_generation()
+    print(f"已更新索引版本号: {generation}")
     
-    # 6. 验证上传结果
+    # 5. 验证上传结果
     time.sleep(2) # 等待索引更新
-    final_stats = index.describe_index_stats()
+    final_stats = store.stats()
     print(f"最终索引统计: {final_stats}")
 
 if __name__ == "__main__":